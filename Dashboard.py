@@ -6,6 +6,7 @@ import base64
 import time
 from datetime import datetime
 from utils.ncr_helpers import get_now_vn, init_gspread, get_all_users, register_user
+from core.gsheets import get_worksheet
 
 # --- CONFIG: DEPARTMENT ROUTING ---
 # --- CONFIG: DEPARTMENT ROUTING ---
@@ -98,8 +99,7 @@ def login_user(username, password):
         from utils.security import verify_password, hash_password
         gc = init_gspread()
         if not gc: return None, "Không thể kết nối cơ sở dữ liệu."
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         users_data = ws.get_all_records()
         
         df_users = pd.DataFrame(users_data)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import streamlit as st
+
+from core import local_mirror
+from core.cache_tags import NCR_DATA, DNXL, DNXL_DETAILS, CONFIG
+
+# Chu kỳ làm mới nền (giây) - ngắn hơn TTL 300s cũ: dữ liệu cũ tối đa ~2 phút
+REFRESH_INTERVAL = 120
+# Các tab được giữ mới trên thread nền (NCR_DATA qua NcrRepository, còn lại qua snapshot của local_mirror)
+REFRESH_SHEETS = (NCR_DATA, DNXL, DNXL_DETAILS, CONFIG)
+
+
+class BackgroundRefresher:
+    """
+    Thread nền duy nhất của process đồng bộ lại các tab theo chu kỳ.
+    - Bản mới thay nguyên khối khi tải xong; request của user luôn đọc bản hiện có (có thể hơi cũ),
+      không bao giờ chờ tải toàn bộ sheet, không dồn nhiều user gọi API cùng lúc khi hết TTL.
+    - request(): writer / nút Làm mới yêu cầu làm mới sớm một tab (không chờ).
+    - last_synced(): thời điểm đồng bộ (cũ nhất) để hiển thị cho người dùng.
+    """
+
+    def __init__(self, repository, sheets=REFRESH_SHEETS, interval=REFRESH_INTERVAL):
+        self.repository = repository
+        self.sheets = tuple(sheets)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._requested = []
+        self._thread = None
+        self.synced = {}      # sheet -> datetime (giờ VN) lần đồng bộ thành công gần nhất
+        self.errors = {}      # sheet -> lỗi lần đồng bộ gần nhất
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = local_mirror.start_background(self._run, name="background-refresher")
+        # Hết TTL không còn đồng bộ trên request của user
+        self.repository.background = True
+
+    def request(self, *sheets):
+        """Làm mới sớm các tab (không chờ kết quả)."""
+        with self._lock:
+            for sheet in sheets:
+                if sheet in self.sheets and sheet not in self._requested:
+                    self._requested.append(sheet)
+        self._wake.set()
+
+    def refresh(self, sheet):
+        """Đồng bộ một tab ngay trên thread hiện tại. Trả về True nếu thành công."""
+        try:
+            if sheet == NCR_DATA:
+                self.repository.refresh()
+            else:
+                local_mirror.refresh_snapshot(sheet)
+        except Exception as e:
+            self.errors[sheet] = str(e)
+            print(f"Background refresh error ({sheet}): {e}")
+            return False
+        from utils.ncr_helpers import get_now_vn
+        self.synced[sheet] = get_now_vn()
+        self.errors.pop(sheet, None)
+        return True
+
+    def last_synced(self):
+        """Thời điểm đồng bộ cũ nhất trong các tab (None nếu chưa đồng bộ xong vòng đầu)."""
+        if any(sheet not in self.synced for sheet in self.sheets):
+            return None
+        return min(self.synced[sheet] for sheet in self.sheets)
+
+    def _run(self):
+        next_round = 0.0
+        while True:
+            self._wake.clear()
+            now = time.time()
+            with self._lock:
+                due = list(self._requested)
+                self._requested.clear()
+            if now >= next_round:
+                due = list(self.sheets)
+                next_round = now + self.interval
+            for sheet in due:
+                self.refresh(sheet)
+            self._wake.wait(timeout=max(0.0, next_round - time.time()))
+
+
+@st.cache_resource
+def get_background_refresher():
+    """Refresher duy nhất cho toàn process (Cached resource) - khởi động thread ở lần gọi đầu."""
+    from core.ncr_repository import get_ncr_repository
+    refresher = BackgroundRefresher(get_ncr_repository())
+    refresher.start()
+    return refresher
+
+
+def request_refresh(*sheets):
+    """
+    Yêu cầu làm mới nền các tab vừa thay đổi (dùng trong cache_tags.invalidate).
+    Bỏ qua NCR_DATA: repository tự delta sync ở lần đọc sau invalidate.
+    """
+    sheets = [sheet for sheet in sheets if sheet in REFRESH_SHEETS and sheet != NCR_DATA]
+    if sheets:
+        get_background_refresher().request(*sheets)
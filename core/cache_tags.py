@@ -0,0 +1,68 @@
+import threading
+
+import streamlit as st
+
+# Tag = tên sheet mà loader phụ thuộc
+NCR_DATA = "NCR_DATA"
+USERS = "USERS"
+CONFIG = "CONFIG"
+DNXL = "DNXL"
+DNXL_DETAILS = "DNXL_DETAILS"
+
+_lock = threading.Lock()
+_registry = {}  # tag -> {"module.qualname": hàm cached}
+
+
+def tagged_cache(*tags, **cache_kwargs):
+    """
+    Thay cho @st.cache_data: khai báo loader phụ thuộc sheet nào.
+    Writer gọi invalidate(tag) để chỉ xóa cache của các loader liên quan,
+    thay vì st.cache_data.clear() xóa toàn bộ (CONFIG, USERS... của mọi user).
+    """
+    def decorator(func):
+        return _register(func, st.cache_data(**cache_kwargs)(func), tags)
+    return decorator
+
+
+def tagged_resource(*tags, **cache_kwargs):
+    """
+    Như tagged_cache nhưng dùng @st.cache_resource: mọi request dùng chung CÙNG một object
+    (không pickle/copy mỗi lần đọc) - cho index/store chỉ đọc dựng từ sheet.
+    """
+    def decorator(func):
+        return _register(func, st.cache_resource(**cache_kwargs)(func), tags)
+    return decorator
+
+
+def _register(func, cached, tags):
+    key = f"{func.__module__}.{func.__qualname__}"
+    with _lock:
+        for tag in tags:
+            # Page được exec lại mỗi rerun -> ghi đè theo tên, không nhân bản
+            _registry.setdefault(tag, {})[key] = cached
+    return cached
+
+
+def invalidate(*tags, resync=True):
+    """
+    Xóa cache của các loader gắn các tag đã cho.
+    NCR_DATA + resync=True: snapshot NcrRepository đồng bộ lại (delta) ở lần đọc kế tiếp.
+    resync=True: tab do BackgroundRefresher giữ (DNXL, CONFIG...) được làm mới sớm trên thread nền.
+    resync=False: dùng sau khi ghi qua write queue (snapshot đã được vá tại chỗ).
+    """
+    with _lock:
+        cached_funcs = [fn for tag in tags for fn in _registry.get(tag, {}).values()]
+    for fn in cached_funcs:
+        try:
+            fn.clear()
+        except Exception:
+            pass
+
+    if NCR_DATA in tags and resync:
+        from core.ncr_repository import get_ncr_repository
+        get_ncr_repository().invalidate()
+
+    if resync:
+        # Tab do refresher nền giữ -> tải lại sớm trên thread nền (request không chờ)
+        from core.background_refresher import request_refresh
+        request_refresh(*tags)
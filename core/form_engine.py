@@ -1,19 +1,20 @@
+import uuid
 import streamlit as st
 from core.profile import DeptProfile
 from core.auth import require_dept_access
 from core.master_data import load_config_sheet
-from core.gsheets import get_client, smart_append_batch, open_worksheet
+from core.save_journal import get_save_journal
 from core.state import init_session_state
 from utils.ncr_helpers import (
     get_now_vn, get_now_vn_str,
     format_contract_code, 
     render_input_buffer_mobile, 
-    upload_images_to_cloud,
     LIST_DON_VI_TINH,
     get_initial_status,
     generate_next_pass_id,
     generate_next_ncr_id,
-    is_ncr_id_exists
+    reserve_ncr_id,
+    release_ncr_id
 )
 from utils.aql_manager import get_aql_standard, evaluate_lot_quality
 from utils.config import NCR_DEPARTMENT_PREFIXES
@@ -631,35 +632,25 @@ def run_inspection_page(profile: DeptProfile):
             st.error("⚠️ Vui lòng nhập SỐ ĐUÔI NCR trước khi lưu!")
             st.stop()
             
-        # Validate Duplicate ID
+        if not st.session_state.buffer_errors and not profile.has_aql:
+            st.error("⚠️ Danh sách lỗi trống!")
+            st.stop()
+        
+        # Validate Duplicate ID + giữ chỗ mã (2 người lưu cùng lúc không thể lấy cùng một mã)
         if (not profile.has_aql or inspection_result == 'Fail'):
-             if is_ncr_id_exists(final_ncr_num):
-                 st.error(f"⚠️ Mã phiếu {final_ncr_num} đã tồn tại! Vui lòng kiểm tra lại.")
+             reserved, msg = reserve_ncr_id(final_ncr_num, owner=user_info.get("name", ""))
+             if not reserved:
+                 st.error(f"⚠️ {msg}! Vui lòng kiểm tra lại.")
                  st.stop()
         
-        # Auto-Generate ID for Pass
+        # Auto-Generate ID for Pass (cấp + giữ chỗ)
         if profile.has_aql and inspection_result == 'Pass':
-            final_ncr_num = generate_next_pass_id(dept_prefix)
-        
-        if not st.session_state.buffer_errors and not profile.has_aql:
-            st.error("⚠️ Danh sách lỗi trống!")
-            st.stop()
+            final_ncr_num = generate_next_pass_id(dept_prefix, owner=user_info.get("name", ""))
     
+        saved = False
         try:
+            # Offline-first: ghi phiếu + ảnh vào nhật ký cục bộ, thread nền đẩy lên Cloudinary/Sheet (retry)
             with st.spinner("Đang lưu dữ liệu hệ thống..."):
-                if uploaded_images:
-                    img_links = upload_images_to_cloud(uploaded_images, final_ncr_num if final_ncr_num else "PASS_REC")
-                else:
-                    img_links = ""
-                    
-                gc = get_client()
-                if not gc:
-                    st.error("Lỗi kết nối Google Sheets")
-                    st.stop()
-                
-                ws = open_worksheet(profile.sheet_spreadsheet_id, profile.sheet_worksheet_name)
-                if not ws: st.stop()
-    
                 now = get_now_vn_str()
                 records_to_save = st.session_state.buffer_errors
                 if profile.has_aql and inspection_result == 'Pass' and not records_to_save:
@@ -689,7 +680,7 @@ def run_inspection_page(profile: DeptProfile):
                         'noi_gay_loi': nguon_goc,
                         'trang_thai': current_status,
                         'thoi_gian_cap_nhat': now,
-                        'hinh_anh': img_links,
+                        'hinh_anh': "",  # Điền URL ảnh khi nhật ký upload xong
                         'don_vi_tinh': don_vi_tinh,
                         'ket_qua_kiem_tra': inspection_result,
                         'spec_size': spec_size, 'tol_size': tol_size, 'meas_size': meas_size,
@@ -700,16 +691,28 @@ def run_inspection_page(profile: DeptProfile):
                     }
                     batch_data.append(row_data)
                     
-                success_count = smart_append_batch(ws, batch_data)
-                if success_count > 0:
-                    st.balloons()
-                    if inspection_result == 'Pass':
-                        st.success(f"✅ Đã lưu thành công! Mã phiếu Kiểm Đạt của bạn là: **{final_ncr_num}**")
-                    else:
-                        st.success(f"✅ Đã lưu thành công {success_count} dòng! ({inspection_result})")
-                    st.session_state.buffer_errors = []
-                    st.session_state.header_locked = False
+                if 'journal_session' not in st.session_state:
+                    st.session_state.journal_session = uuid.uuid4().hex
+                get_save_journal().submit(
+                    owner=user_info.get("name", ""),
+                    session=st.session_state.journal_session,
+                    ncr_id=final_ncr_num,
+                    spreadsheet_id=profile.sheet_spreadsheet_id,
+                    worksheet=profile.sheet_worksheet_name,
+                    rows=batch_data,
+                    image_files=uploaded_images,
+                )
+                saved = True
+                st.balloons()
+                if inspection_result == 'Pass':
+                    st.success(f"✅ Đã lưu thành công! Mã phiếu Kiểm Đạt của bạn là: **{final_ncr_num}**")
                 else:
-                    st.error("Lỗi khi lưu dữ liệu vào Sheet.")
+                    st.success(f"✅ Đã lưu thành công {len(batch_data)} dòng! ({inspection_result})")
+                st.caption("📤 Phiếu đang được đồng bộ lên hệ thống (xem trạng thái ở trang NCR Của Tôi).")
+                st.session_state.buffer_errors = []
+                st.session_state.header_locked = False
         except Exception as e:
             st.error(f"System Error: {e}")
+        finally:
+            if not saved:
+                release_ncr_id(final_ncr_num)
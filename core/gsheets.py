@@ -1,36 +1,118 @@
 import streamlit as st
 import gspread
 import json
+import threading
 import pandas as pd
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
+from core.quota_governor import GovernedHTTPClient
+
+# Kết nối HTTP dùng lại (keep-alive) cho request song song từ các thread nền
+HTTP_POOL_SIZE = 16
+
 
 @st.cache_resource
 def get_client():
-    """Initialize gspread client from secrets (Cached)."""
+    """Initialize gspread client from secrets (Cached, dùng chung toàn hệ thống)."""
     try:
         creds_str = st.secrets["connections"]["gsheets"]["service_account"]
         if isinstance(creds_str, str):
             creds_dict = json.loads(creds_str, strict=False)
         else:
             creds_dict = creds_str
-        gc = gspread.service_account_from_dict(creds_dict)
+        # Mọi request đi qua quota governor (token bucket + ưu tiên)
+        gc = gspread.service_account_from_dict(creds_dict, http_client=GovernedHTTPClient)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        gc.http_client.session.mount("https://", adapter)
         return gc
     except Exception as e:
         st.error(f"Lỗi khởi tạo gspread: {e}")
         return None
 
-def open_worksheet(spreadsheet_id, worksheet_name):
-    """Open a specific worksheet."""
+
+class SheetConnection:
+    """
+    Giữ Spreadsheet và map tên -> Worksheet đã mở, tránh 2 request metadata
+    (open_by_key + worksheet) cho mỗi lần đọc/ghi.
+    Không thấy tên sheet trong cache -> tải lại metadata một lần rồi mới báo lỗi.
+    """
+
+    def __init__(self, gc):
+        self.gc = gc
+        self._lock = threading.Lock()
+        self._spreadsheets = {}  # spreadsheet_id -> Spreadsheet
+        self._worksheets = {}    # spreadsheet_id -> {title: Worksheet}
+
+    def spreadsheet(self, spreadsheet_id):
+        with self._lock:
+            sh = self._spreadsheets.get(spreadsheet_id)
+            if sh is None:
+                sh = self.gc.open_by_key(spreadsheet_id)
+                self._spreadsheets[spreadsheet_id] = sh
+            return sh
+
+    def worksheet(self, spreadsheet_id, worksheet_name):
+        ws = self._worksheets.get(spreadsheet_id, {}).get(worksheet_name)
+        if ws is not None:
+            return ws
+        sh = self.spreadsheet(spreadsheet_id)
+        with self._lock:
+            titles = {w.title: w for w in sh.worksheets()}
+            self._worksheets[spreadsheet_id] = titles
+        if worksheet_name not in titles:
+            raise gspread.exceptions.WorksheetNotFound(worksheet_name)
+        return titles[worksheet_name]
+
+    def invalidate(self, spreadsheet_id=None):
+        """Bỏ handle đã cache (vd: sheet bị đổi tên/xóa)."""
+        with self._lock:
+            if spreadsheet_id is None:
+                self._spreadsheets.clear()
+                self._worksheets.clear()
+            else:
+                self._spreadsheets.pop(spreadsheet_id, None)
+                self._worksheets.pop(spreadsheet_id, None)
+
+
+@st.cache_resource
+def get_connection():
+    """SheetConnection duy nhất cho toàn process (Cached resource)."""
     gc = get_client()
-    if not gc: return None
+    return SheetConnection(gc) if gc else None
+
+
+def default_spreadsheet_id():
+    return st.secrets["connections"]["gsheets"]["spreadsheet"]
+
+
+def get_spreadsheet(spreadsheet_id=None):
+    """Spreadsheet đã mở (mặc định: spreadsheet chính trong secrets). Raise nếu lỗi."""
+    conn = get_connection()
+    if not conn:
+        raise RuntimeError("Không khởi tạo được gspread client")
+    return conn.spreadsheet(spreadsheet_id or default_spreadsheet_id())
+
+
+def get_worksheet(worksheet_name, spreadsheet_id=None):
+    """Worksheet đã mở theo tên (dùng lại handle). Raise nếu lỗi."""
+    conn = get_connection()
+    if not conn:
+        raise RuntimeError("Không khởi tạo được gspread client")
+    return conn.worksheet(spreadsheet_id or default_spreadsheet_id(), worksheet_name)
+
+
+def open_worksheet(spreadsheet_id, worksheet_name):
+    """Open a specific worksheet (handle dùng lại qua SheetConnection)."""
     try:
-        sh = gc.open_by_key(spreadsheet_id)
-        ws = sh.worksheet(worksheet_name)
-        return ws
+        return get_worksheet(worksheet_name, spreadsheet_id)
     except Exception as e:
         st.error(f"Lỗi mở Sheet '{worksheet_name}': {e}")
         return None
 
+def align_rows(header_row, rows_data):
+    """Dict theo tên cột -> list giá trị đúng thứ tự header (cột thiếu để trống)."""
+    return [[row_dict.get(col_name, "") for col_name in header_row] for row_dict in rows_data]
+
 def smart_append_batch(worksheet, rows_data):
     """
     Append multiple rows to sheet, aligning with header.
@@ -53,14 +135,7 @@ def smart_append_batch(worksheet, rows_data):
             return 0
             
         # 2. Prepare matched rows
-        rows_to_append = []
-        for row_dict in rows_data:
-            ordered_row = []
-            for col_name in header_row:
-                val = row_dict.get(col_name, "")
-                # Convert basic types to string if needed
-                ordered_row.append(val)
-            rows_to_append.append(ordered_row)
+        rows_to_append = align_rows(header_row, rows_data)
             
         # 3. Batch Append
         worksheet.append_rows(rows_to_append, value_input_option="USER_ENTERED")
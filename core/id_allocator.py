@@ -0,0 +1,188 @@
+import os
+import re
+import sqlite3
+import time
+
+import streamlit as st
+
+from core.local_mirror import get_data_dir
+
+# Bộ đếm số phiếu + mã đã giữ chỗ (SQLite cục bộ, dùng chung mọi session/process của server)
+DB_FILENAME = "id_allocator.sqlite3"
+# Mã giữ chỗ quá hạn này mà vẫn chưa thấy trên Sheet -> coi như bỏ (lưu lỗi / tab đóng)
+RESERVATION_TTL = 7 * 24 * 3600
+# Số lần thử compare-and-set trước khi báo lỗi
+CAS_RETRIES = 20
+
+# [PREFIX]-[MM]-[XX] / [PREFIX]KD-[MM]-[XX] -> series = phần trước số đuôi
+_ID_RE = re.compile(r'^(.*-\d{2}-)(\d+)$')
+
+
+def split_id(ncr_id):
+    """'FI-01-07' -> ('FI-01-', 7); không đúng định dạng -> (None, None)."""
+    match = _ID_RE.match(str(ncr_id).strip())
+    if not match:
+        return None, None
+    return match.group(1), int(match.group(2))
+
+
+def build_id_index(snapshot, tickets):
+    """Tập mã phiếu hiện có + số đuôi lớn nhất theo series (dựng 1 lần / version snapshot)."""
+    ids = set()
+    if not tickets.empty and 'so_phieu' in tickets.columns:
+        ids = {str(v).strip() for v in tickets['so_phieu'].dropna().astype(str).unique()}
+    ids.discard('')
+    series_max = {}
+    for ncr_id in ids:
+        series, number = split_id(ncr_id)
+        if series is not None and number > series_max.get(series, 0):
+            series_max[series] = number
+    return ids, series_max
+
+
+class IdAllocator:
+    """
+    Cấp số phiếu NCR / Kiểm Đạt không trùng khi nhiều người lưu cùng lúc.
+    - counters(series, last): số đuôi lớn nhất đã cấp của series, tăng bằng compare-and-set.
+    - reservations(ncr_id): mã đã giữ chỗ (PRIMARY KEY -> 2 người không giữ được cùng một mã).
+    - Mã đã có trên Sheet: tập hash dựng từ bảng phiếu của NcrRepository (kiểm tra O(1)).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (series TEXT PRIMARY KEY, last INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reservations ("
+                " ncr_id TEXT PRIMARY KEY, series TEXT, number INTEGER, owner TEXT, reserved_at REAL)"
+            )
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    # --- Mã hiện có ---
+    def _index(self):
+        from core.ncr_repository import get_ncr_repository
+        return get_ncr_repository().derived('id_index', build_id_index)
+
+    def exists(self, ncr_id):
+        """Mã đã có trên Sheet hoặc đang được giữ chỗ bởi một lần lưu khác."""
+        ncr_id = str(ncr_id).strip()
+        if ncr_id in self._index()[0]:
+            return True
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT 1 FROM reservations WHERE ncr_id = ?", (ncr_id,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None
+
+    def _last(self, conn, series):
+        row = conn.execute("SELECT last FROM counters WHERE series = ?", (series,)).fetchone()
+        return row[0] if row else None
+
+    def _cas(self, conn, series, expected, new):
+        """Compare-and-set bộ đếm: chỉ ghi khi giá trị hiện tại vẫn là expected."""
+        if expected is None:
+            cur = conn.execute("INSERT OR IGNORE INTO counters (series, last) VALUES (?, ?)", (series, new))
+        else:
+            cur = conn.execute(
+                "UPDATE counters SET last = ? WHERE series = ? AND last = ?", (new, series, expected)
+            )
+        return cur.rowcount == 1
+
+    # --- Gợi ý / cấp mã ---
+    def peek(self, series):
+        """Số đuôi tiếp theo của series (chỉ gợi ý, không giữ chỗ)."""
+        conn = self._connect()
+        try:
+            last = self._last(conn, series) or 0
+        finally:
+            conn.close()
+        return max(last, self._index()[1].get(series, 0)) + 1
+
+    def reserve(self, ncr_id, owner=""):
+        """
+        Giữ chỗ một mã cụ thể (vd số đuôi người dùng tự nhập).
+        Returns: (True, ncr_id) hoặc (False, lý do)
+        """
+        ncr_id = str(ncr_id).strip()
+        if ncr_id in self._index()[0]:
+            return False, f"Mã phiếu {ncr_id} đã tồn tại"
+        series, number = split_id(ncr_id)
+        conn = self._connect()
+        try:
+            self._prune(conn)
+            try:
+                conn.execute(
+                    "INSERT INTO reservations (ncr_id, series, number, owner, reserved_at) VALUES (?, ?, ?, ?, ?)",
+                    (ncr_id, series, number, owner, time.time()),
+                )
+            except sqlite3.IntegrityError:
+                return False, f"Mã phiếu {ncr_id} đang được người khác lưu"
+            if series is not None:
+                # Đẩy bộ đếm lên >= number để lần cấp tự động sau không đụng mã này
+                for _ in range(CAS_RETRIES):
+                    last = self._last(conn, series)
+                    if last is not None and last >= number:
+                        break
+                    if self._cas(conn, series, last, number):
+                        break
+            return True, ncr_id
+        finally:
+            conn.close()
+
+    def allocate(self, series, owner="", width=2):
+        """
+        Cấp mã mới tiếp theo của series (vd 'FIKD-01-') và giữ chỗ luôn.
+        Returns: (True, ncr_id) hoặc (False, lý do)
+        """
+        conn = self._connect()
+        try:
+            self._prune(conn)
+            for _ in range(CAS_RETRIES):
+                last = self._last(conn, series)
+                number = max(last or 0, self._index()[1].get(series, 0)) + 1
+                if not self._cas(conn, series, last, number):
+                    continue  # Session khác vừa cấp -> đọc lại bộ đếm
+                ncr_id = f"{series}{number:0{width}d}"
+                if ncr_id in self._index()[0]:
+                    continue
+                try:
+                    conn.execute(
+                        "INSERT INTO reservations (ncr_id, series, number, owner, reserved_at) VALUES (?, ?, ?, ?, ?)",
+                        (ncr_id, series, number, owner, time.time()),
+                    )
+                except sqlite3.IntegrityError:
+                    continue
+                return True, ncr_id
+            return False, "Không cấp được mã phiếu (quá nhiều lượt lưu đồng thời), vui lòng thử lại"
+        finally:
+            conn.close()
+
+    def release(self, ncr_id):
+        """Bỏ giữ chỗ khi lưu thất bại; trả lại số đuôi nếu đó vẫn là số cấp sau cùng."""
+        ncr_id = str(ncr_id).strip()
+        series, number = split_id(ncr_id)
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM reservations WHERE ncr_id = ?", (ncr_id,))
+            if series is not None:
+                self._cas(conn, series, number, number - 1)
+        finally:
+            conn.close()
+
+    def _prune(self, conn):
+        conn.execute("DELETE FROM reservations WHERE reserved_at < ?", (time.time() - RESERVATION_TTL,))
+
+
+@st.cache_resource
+def get_id_allocator():
+    """Bộ cấp số phiếu duy nhất cho toàn process (Cached resource)."""
+    data_dir = get_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    return IdAllocator(os.path.join(data_dir, DB_FILENAME))
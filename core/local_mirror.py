@@ -0,0 +1,317 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import gspread
+import pandas as pd
+import streamlit as st
+
+from core.gsheets import get_worksheet, get_spreadsheet
+from core.quota_governor import quota_priority, PRIORITY_BACKGROUND
+
+# Mirror cục bộ (SQLite) của các tab Google Sheets.
+# Mỗi tab lưu một dòng: header + toàn bộ rows (JSON, giữ nguyên kiểu số/chuỗi như get_all_records).
+_DEFAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".local_data")
+DB_FILENAME = "sheets_mirror.sqlite3"
+
+_state_lock = threading.Lock()
+_warm_sheets = set()        # Các tab đã được đọc ít nhất một lần trong process này
+_refreshing = set()         # Các tab đang làm mới nền
+_refresh_callbacks = {}     # sheet_name -> [callable] (vd: hàm cached.clear)
+_fetched_at = {}            # sheet_name -> thời điểm đọc Sheets gần nhất
+_prefetched = {}            # sheet_name -> (frame, fetched_at) do bootstrap_sheets tải sẵn
+_snapshots = {}             # sheet_name -> (frame, synced_at) do BackgroundRefresher giữ mới
+
+# Bootstrap: tab đọc Sheets quá thời gian này (khớp TTL 300s của loader) -> tải lại trong request gộp
+STALE_AFTER = 300
+# Frame tải sẵn mà loader chưa dùng sau khoảng này -> bỏ (loader tự đọc lại)
+PREFETCH_MAX_AGE = 120
+
+
+def get_data_dir():
+    """Thư mục dữ liệu: secrets [local_mirror] data_dir > env NCR_DATA_DIR > .local_data/"""
+    try:
+        data_dir = st.secrets.get("local_mirror", {}).get("data_dir")
+    except Exception:
+        data_dir = None
+    return data_dir or os.environ.get("NCR_DATA_DIR") or _DEFAULT_DIR
+
+
+def _connect():
+    data_dir = get_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(data_dir, DB_FILENAME), timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sheets ("
+        " name TEXT PRIMARY KEY, synced_at REAL, header TEXT, rows TEXT)"
+    )
+    return conn
+
+
+def save_sheet(sheet_name, header, rows):
+    """Ghi đè mirror của một tab. Lỗi ghi đĩa không được làm hỏng luồng chính."""
+    try:
+        conn = _connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sheets (name, synced_at, header, rows) VALUES (?, ?, ?, ?)",
+                (sheet_name, time.time(), json.dumps(list(header)), json.dumps(rows, default=str)),
+            )
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Local mirror save error ({sheet_name}): {e}")
+        return False
+
+
+def load_sheet(sheet_name):
+    """Đọc mirror của một tab. Trả về (header, rows, synced_at) hoặc None."""
+    try:
+        conn = _connect()
+        row = conn.execute(
+            "SELECT header, rows, synced_at FROM sheets WHERE name = ?", (sheet_name,)
+        ).fetchone()
+        conn.close()
+        if not row:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+    except Exception as e:
+        print(f"Local mirror load error ({sheet_name}): {e}")
+        return None
+
+
+def mirror_synced_at(sheet_name):
+    """Thời điểm đồng bộ mirror của một tab (None nếu chưa có) - không đọc rows."""
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT synced_at FROM sheets WHERE name = ?", (sheet_name,)).fetchone()
+        conn.close()
+        return row[0] if row else None
+    except Exception:
+        return None
+
+
+def save_frame(sheet_name, df):
+    """Ghi mirror từ DataFrame dạng records."""
+    return save_sheet(sheet_name, list(df.columns), df.values.tolist())
+
+
+def load_frame(sheet_name):
+    """Đọc mirror dưới dạng DataFrame (rỗng nếu chưa có)."""
+    cached = load_sheet(sheet_name)
+    if not cached:
+        return pd.DataFrame()
+    header, rows, _ = cached
+    return pd.DataFrame(rows, columns=header)
+
+
+def frame_from_values(values):
+    """Giá trị thô của một tab (dòng đầu là header) -> DataFrame như get_all_records (pad + numericise)."""
+    if not values or not values[0]:
+        return pd.DataFrame()
+    header = list(values[0])
+    width = len(header)
+    rows = [
+        gspread.utils.numericise_all(list(row)[:width] + [""] * (width - len(row)))
+        for row in values[1:]
+    ]
+    return pd.DataFrame(rows, columns=header)
+
+
+def _fetch_frame(sheet_name):
+    df = pd.DataFrame(get_worksheet(sheet_name).get_all_records())
+    save_frame(sheet_name, df)
+    with _state_lock:
+        _fetched_at[sheet_name] = time.time()
+    return df
+
+
+def _take_prefetched(sheet_name):
+    with _state_lock:
+        item = _prefetched.pop(sheet_name, None)
+    if item is None or time.time() - item[1] > PREFETCH_MAX_AGE:
+        return None
+    return item[0]
+
+
+def _needs_fetch(sheet_name):
+    """Lần đọc kế tiếp của tab có phải gọi Sheets không (cold start có mirror -> đọc đĩa)."""
+    with _state_lock:
+        if sheet_name in _prefetched or sheet_name in _snapshots:
+            return False
+        warm = sheet_name in _warm_sheets
+        fetched = _fetched_at.get(sheet_name)
+    if fetched is None:
+        return warm or mirror_synced_at(sheet_name) is None
+    return time.time() - fetched >= STALE_AFTER
+
+
+def bootstrap_sheets(*sheet_names):
+    """
+    Tải sẵn các tab một trang cần trong MỘT request spreadsheet.values_batch_get
+    (thay cho mỗi loader một lần open_by_key + get_all_records).
+    Chỉ tải các tab mà lần đọc kế tiếp sẽ phải gọi Sheets; frame được ghi mirror và
+    giao cho read_sheet_frame của loader tương ứng. NCR_DATA nạp thẳng vào NcrRepository
+    khi repository sắp tải toàn bộ (delta sync vẫn chạy như cũ).
+    Lỗi -> bỏ qua, các loader tự đọc như bình thường.
+    """
+    from core.ncr_repository import get_ncr_repository, NCR_SHEET
+
+    repo = get_ncr_repository() if NCR_SHEET in sheet_names else None
+    names = [
+        name for name in dict.fromkeys(sheet_names)
+        if (repo.needs_full_values() if name == NCR_SHEET else _needs_fetch(name))
+    ]
+    if not names:
+        return []
+    try:
+        res = get_spreadsheet().values_batch_get(
+            [gspread.utils.absolute_range_name(name) for name in names]
+        )
+    except Exception as e:
+        print(f"Bootstrap batch read error ({', '.join(names)}): {e}")
+        return []
+
+    now = time.time()
+    for name, value_range in zip(names, res.get('valueRanges', [])):
+        values = value_range.get('values', [])
+        if name == NCR_SHEET:
+            repo.apply_values(values)
+            continue
+        df = frame_from_values(values)
+        save_frame(name, df)
+        with _state_lock:
+            _fetched_at[name] = now
+            _prefetched[name] = (df, now)
+        # Loader đang giữ bản cũ -> xóa để lần gọi kế tiếp dùng frame vừa tải
+        _run_refresh_callbacks(name)
+    return names
+
+
+def publish_frame(sheet_name, df):
+    """
+    Thay snapshot của tab bằng frame mới (nguyên khối) rồi báo loader dựng lại.
+    Từ đây read_sheet_frame trả snapshot trong bộ nhớ, không gọi Sheets trên request của user.
+    """
+    save_frame(sheet_name, df)
+    now = time.time()
+    with _state_lock:
+        _snapshots[sheet_name] = (df, now)
+        _fetched_at[sheet_name] = now
+        _warm_sheets.add(sheet_name)
+    _run_refresh_callbacks(sheet_name)
+
+
+def refresh_snapshot(sheet_name):
+    """Tải lại một tab và publish (gọi từ thread nền)."""
+    publish_frame(sheet_name, pd.DataFrame(get_worksheet(sheet_name).get_all_records()))
+
+
+def snapshot_synced_at(sheet_name):
+    """Thời điểm (epoch) snapshot của tab được tải; None nếu tab không có snapshot nền."""
+    with _state_lock:
+        item = _snapshots.get(sheet_name)
+    return item[1] if item else None
+
+
+def append_snapshot_rows(sheet_name, rows):
+    """
+    Thêm lạc quan các dòng vừa append (dict theo tên cột) vào snapshot của tab,
+    để người vừa ghi thấy ngay trước lần làm mới nền kế tiếp. Tab không có snapshot -> False.
+    """
+    if not rows:
+        return False
+    with _state_lock:
+        item = _snapshots.get(sheet_name)
+        if item is None:
+            return False
+        df, synced_at = item
+        columns = list(df.columns) or list(rows[0].keys())
+        added = pd.DataFrame([{col: row.get(col, "") for col in columns} for row in rows], columns=columns)
+        _snapshots[sheet_name] = (pd.concat([df, added], ignore_index=True), synced_at)
+    return True
+
+
+def _run_refresh_callbacks(sheet_name):
+    for callback in _refresh_callbacks.get(sheet_name, []):
+        try:
+            callback()
+        except Exception:
+            pass
+
+
+def _background_refresh(sheet_name):
+    try:
+        _fetch_frame(sheet_name)
+        _run_refresh_callbacks(sheet_name)
+    except Exception as e:
+        print(f"Local mirror refresh error ({sheet_name}): {e}")
+    finally:
+        with _state_lock:
+            _refreshing.discard(sheet_name)
+
+
+def start_background(target, name=None):
+    """Chạy target trên daemon thread (làm mới nền, không chặn request của user)."""
+    def run():
+        # Làm mới nền nhường quota cho thao tác của user
+        with quota_priority(PRIORITY_BACKGROUND):
+            target()
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def read_sheet_frame(sheet_name, on_refresh=None):
+    """
+    Đọc một tab dạng DataFrame (như get_all_records) có mirror cục bộ:
+    - Tab có snapshot của BackgroundRefresher -> trả snapshot trong bộ nhớ (không gọi Sheets).
+    - Cold start (lần đọc đầu của process) + mirror có sẵn -> trả mirror ngay, làm mới nền.
+    - Các lần sau -> đọc Sheets và ghi đè mirror.
+    - Sheets lỗi -> fallback mirror (đọc offline); không có mirror thì raise lỗi gốc.
+
+    on_refresh: callback gọi sau khi làm mới nền xong (thường là hàm_cached.clear)
+    để cache_data không giữ dữ liệu mirror cũ hết TTL.
+    """
+    with _state_lock:
+        if on_refresh is not None:
+            callbacks = _refresh_callbacks.setdefault(sheet_name, [])
+            if on_refresh not in callbacks:
+                callbacks.append(on_refresh)
+        cold = sheet_name not in _warm_sheets
+        _warm_sheets.add(sheet_name)
+
+    # Giá trị vừa ghi qua write queue (chưa flush) được áp lên kết quả đọc
+    from core.write_queue import get_write_queue
+    queue = get_write_queue()
+
+    prefetched = _take_prefetched(sheet_name)
+    if prefetched is not None:
+        return queue.overlay_frame(sheet_name, prefetched)
+
+    with _state_lock:
+        snapshot = _snapshots.get(sheet_name)
+    if snapshot is not None:
+        # Refresher nền giữ bản mới -> không chặn request; bản sao để loader sửa thoải mái
+        return queue.overlay_frame(sheet_name, snapshot[0].copy())
+
+    if cold:
+        df_local = load_frame(sheet_name)
+        if not df_local.empty:
+            with _state_lock:
+                should_refresh = sheet_name not in _refreshing
+                _refreshing.add(sheet_name)
+            if should_refresh:
+                start_background(lambda: _background_refresh(sheet_name), name=f"mirror-{sheet_name}")
+            return queue.overlay_frame(sheet_name, df_local)
+
+    try:
+        return queue.overlay_frame(sheet_name, _fetch_frame(sheet_name))
+    except Exception:
+        df_local = load_frame(sheet_name)
+        if not df_local.empty:
+            return queue.overlay_frame(sheet_name, df_local)
+        raise
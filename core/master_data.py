@@ -1,23 +1,17 @@
 import streamlit as st
 import pandas as pd
-from core.gsheets import get_client
+from core.local_mirror import read_sheet_frame
+from core.cache_tags import tagged_cache, CONFIG
 
-@st.cache_data(ttl=300)
+@tagged_cache(CONFIG, ttl=300)
 def load_config_sheet():
     """
     Load Master Data from CONFIG sheet (Cached 5 mins).
     Returns: list_noi_may, list_loi, list_vi_tri, dict_muc_do
     """
     try:
-        gc = get_client()
-        if not gc: return [], [], [], {}
-        
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.worksheet("CONFIG")
-        
-        data = worksheet.get_all_records()
-        df_config = pd.DataFrame(data)
+        # Cold start đọc từ mirror cục bộ, làm mới nền rồi xóa cache của hàm này
+        df_config = read_sheet_frame("CONFIG", on_refresh=load_config_sheet.clear)
         
         # --- NORMALIZE DATA ---
         list_noi_may = df_config['noi_may'].dropna().unique().tolist() if 'noi_may' in df_config.columns else []
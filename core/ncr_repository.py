@@ -0,0 +1,599 @@
+import re
+import threading
+import time
+from datetime import timedelta
+
+import gspread
+import pandas as pd
+import streamlit as st
+
+from core import local_mirror
+from core.gsheets import get_worksheet
+from utils.ncr_helpers import (
+    get_now_vn,
+    calculate_stuck_hours,
+    parse_sheet_datetime,
+    COLUMN_MAPPING,
+    extract_dept_columns,
+)
+
+# Thời gian sống của snapshot (giây) - khớp với TTL cũ của các loader
+REFRESH_TTL = 300
+NCR_SHEET = "NCR_DATA"
+# attrs ghi version lên chính frame snapshot (giữ qua copy/lọc) -> biết bản sao thuộc version nào
+SNAPSHOT_VERSION = "snapshot_version"
+# Delta sync: tải lại toàn bộ sau N lần delta, hoặc khi số dòng thay đổi vượt ngưỡng
+FULL_RESYNC_EVERY = 6
+MAX_DELTA_ROWS = 500
+
+# Schema của snapshot: cột phân loại -> category (so sánh/lọc rẻ, ít bộ nhớ), số lượng -> kiểu số
+CATEGORY_COLS = [
+    'trang_thai', 'bo_phan', 'bo_phan_full', 'ten_loi', 'md_loi',
+    'don_vi_tinh', 'hop_dong', 'nguoi_lap_phieu_key',
+]
+NUMERIC_COLS = ['sl_loi', 'sl_kiem', 'sl_lo_hang']
+# Cột category được lưu dạng lowercase (so sánh với mã trạng thái)
+LOWERCASE_COLS = ['trang_thai']
+
+
+@st.cache_data(ttl=REFRESH_TTL, show_spinner=False)
+def _refresh_epoch():
+    """
+    Mốc làm mới dùng chung cho snapshot NCR_DATA.
+    Hết TTL (hoặc st.cache_data.clear()) -> sinh mốc mới -> repository tải lại.
+    Làm mới có chủ đích: cache_tags.invalidate(NCR_DATA).
+    """
+    return time.time()
+
+
+def apply_ncr_schema(df):
+    """
+    Ép kiểu snapshot theo CATEGORY_COLS / NUMERIC_COLS (idempotent, sửa tại chỗ).
+    Category luôn có '' để fillna('') / so sánh chuỗi rỗng không lỗi.
+    """
+    for col in NUMERIC_COLS:
+        if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+            values = pd.to_numeric(df[col], errors='coerce').fillna(0)
+            df[col] = values.astype('int64') if (values % 1 == 0).all() else values
+    for col in CATEGORY_COLS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = df[col].fillna('').astype(str).str.strip()
+            if col in LOWERCASE_COLS:
+                values = values.str.lower()
+            df[col] = pd.Categorical(values, categories=sorted(set(values) | {''}))
+    return df
+
+
+def normalize_ncr_frame(df):
+    """
+    Chuẩn hóa DataFrame NCR_DATA thô:
+    - Tên cột lowercase + map ngược COLUMN_MAPPING (so_phieu_ncr -> so_phieu, ...)
+    - date_obj / year / month / week từ ngay_lap, deadline_obj từ kp_deadline
+    - bo_phan / bo_phan_full từ prefix số phiếu
+    - cap_nhat_obj + hours_stuck từ thoi_gian_cap_nhat (cùng một mốc now)
+    - nguoi_lap_phieu_key (lowercase) + ép kiểu theo apply_ncr_schema
+    """
+    if df.empty:
+        return pd.DataFrame()
+
+    df = df.copy()
+    df.columns = df.columns.str.strip().str.lower()
+    inv_map = {v.lower(): k for k, v in COLUMN_MAPPING.items()}
+    df.rename(columns=inv_map, inplace=True)
+
+    # Parse ngày giờ một lần (định dạng tường minh), mọi trang dùng lại cột đã parse
+    if 'ngay_lap' in df.columns:
+        df['date_obj'] = parse_sheet_datetime(df['ngay_lap'])
+        df['year'] = df['date_obj'].dt.year
+        df['month'] = df['date_obj'].dt.month
+        df['week'] = df['date_obj'].dt.isocalendar().week
+
+    if 'hop_dong' not in df.columns and 'so_hop_dong' in df.columns:
+        df['hop_dong'] = df['so_hop_dong']
+
+    if 'so_phieu' in df.columns:
+        df[['bo_phan', 'bo_phan_full']] = extract_dept_columns(df['so_phieu'])
+
+    if 'kp_deadline' in df.columns:
+        df['deadline_obj'] = parse_sheet_datetime(df['kp_deadline'])
+
+    if 'thoi_gian_cap_nhat' in df.columns:
+        df['cap_nhat_obj'] = parse_sheet_datetime(df['thoi_gian_cap_nhat'])
+        df['hours_stuck'] = calculate_stuck_hours(df['cap_nhat_obj'], now=get_now_vn())
+    else:
+        df['hours_stuck'] = 0
+
+    if 'nguoi_lap_phieu' in df.columns:
+        df['nguoi_lap_phieu_key'] = df['nguoi_lap_phieu'].fillna('').astype(str).str.strip().str.lower()
+
+    return apply_ncr_schema(df)
+
+
+def build_ticket_frame(df):
+    """
+    Gom snapshot (một dòng / lỗi) thành bảng phiếu (một dòng / so_phieu):
+    - sl_loi: tổng số lượng lỗi
+    - ten_loi: tên lỗi duy nhất, sắp xếp, nối bằng ', '
+    - so_dong_loi: số dòng lỗi của phiếu
+    - các cột còn lại: giá trị đầu tiên (trạng thái, người duyệt, thời gian...)
+    """
+    if df.empty or 'so_phieu' not in df.columns:
+        return pd.DataFrame()
+
+    keys = df['so_phieu']
+    tickets = df.groupby(keys, sort=True).first()
+    tickets['so_dong_loi'] = keys.groupby(keys, sort=True).size()
+
+    if 'sl_loi' in df.columns:
+        sums = pd.to_numeric(df['sl_loi'], errors='coerce').fillna(0).groupby(keys, sort=True).sum()
+        tickets['sl_loi'] = sums.astype('int64') if (sums % 1 == 0).all() else sums
+
+    if 'ten_loi' in df.columns:
+        names = pd.DataFrame({'so_phieu': keys, 'ten_loi': df['ten_loi'].astype(str)})
+        names = names.drop_duplicates().sort_values(['so_phieu', 'ten_loi'])
+        tickets['ten_loi'] = names.groupby('so_phieu', sort=True)['ten_loi'].agg(', '.join)
+
+    tickets.index.name = 'so_phieu'
+    return apply_ncr_schema(tickets.reset_index())
+
+
+def _col_letter(col):
+    """Số thứ tự cột (1-based) -> ký tự cột A1 (1 -> A, 27 -> AA)."""
+    return re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, col))
+
+
+def _records_from_rows(header, rows):
+    """Giống get_all_records(): pad dòng theo header + numericise giá trị."""
+    width = len(header)
+    records = []
+    for row in rows:
+        row = list(row)[:width] + [""] * (width - len(row))
+        records.append(dict(zip(header, gspread.utils.numericise_all(row))))
+    return records
+
+
+class NcrRepository:
+    """
+    Kho dữ liệu NCR_DATA dùng chung cho toàn process.
+    Mỗi cửa sổ làm mới chỉ đọc sheet MỘT lần; các trang/service nhận bản sao
+    (read-only view) của snapshot đã chuẩn hóa thay vì tự gọi get_all_records().
+
+    Đồng bộ delta: sau lần tải đầu, mỗi lần làm mới chỉ đọc header + 2 cột
+    (so_phieu_ncr, thoi_gian_cap_nhat), rồi tải riêng các dòng mới append và
+    các dòng có mốc cập nhật thay đổi. Định kỳ (FULL_RESYNC_EVERY) tải lại toàn bộ
+    để bắt các chỉnh sửa không đụng tới thoi_gian_cap_nhat.
+
+    Cold start: nếu có mirror cục bộ (core.local_mirror) thì phục vụ ngay từ đĩa
+    và đồng bộ với Sheet trên thread nền.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._derived_lock = threading.Lock()
+        self._epoch = None
+        self._force_full = True
+        self._syncs_since_full = 0
+        self._header = []
+        self._keys = []
+        self._stamps = []
+        self._row_index = None
+        self._raw = pd.DataFrame()
+        self._snapshot = pd.DataFrame()
+        self._tickets = pd.DataFrame()
+        self._derived = {}  # name -> (version, kết quả dựng từ snapshot)
+        self.version = 0    # Tăng mỗi khi snapshot thay đổi
+        self.high_water = ""
+        self.last_synced = None
+        # True khi BackgroundRefresher giữ snapshot mới: hết TTL không đồng bộ trên request của user
+        self.background = False
+        self._dirty = False  # invalidate() -> request kế tiếp delta sync (thấy ngay dữ liệu vừa ghi)
+
+    # --- Sheet access ---
+    def _open_ws(self):
+        return get_worksheet(NCR_SHEET)
+
+    def _tracking_cols(self, header):
+        """Vị trí (0-based) cột so_phieu_ncr và thoi_gian_cap_nhat trong header."""
+        norm = [str(h).strip().lower() for h in header]
+        key_col = COLUMN_MAPPING['so_phieu']
+        ts_col = COLUMN_MAPPING['thoi_gian_cap_nhat']
+        if key_col not in norm or ts_col not in norm:
+            return None, None
+        return norm.index(key_col), norm.index(ts_col)
+
+    def _remember_watermark(self, keys, stamps):
+        self._keys = keys
+        self._stamps = stamps
+        self._row_index = None
+        valid = [s for s in stamps if s]
+        self.high_water = max(valid) if valid else ""
+
+    # --- Sync modes ---
+    def _apply_frame(self, header, raw):
+        """Thay snapshot bằng frame thô mới + tính lại watermark từ 2 cột theo dõi."""
+        key_idx, ts_idx = self._tracking_cols(header)
+        self._header = header
+        self._raw = raw
+        self._snapshot = normalize_ncr_frame(raw)
+        self._tickets = build_ticket_frame(self._snapshot)
+        self.version += 1
+        self._snapshot.attrs[SNAPSHOT_VERSION] = self.version
+        if key_idx is None or raw.empty:
+            self._remember_watermark([], [])
+        else:
+            self._remember_watermark(
+                raw.iloc[:, key_idx].astype(str).tolist(),
+                raw.iloc[:, ts_idx].astype(str).tolist(),
+            )
+
+    def _full_sync(self, ws):
+        self._apply_values(ws.get_all_values())
+
+    def _apply_values(self, values):
+        """Snapshot từ toàn bộ giá trị sheet (dòng đầu là header), như get_all_values()."""
+        if not values:
+            self._apply_frame([], pd.DataFrame())
+            return
+        header, rows = values[0], values[1:]
+        self._apply_frame(header, pd.DataFrame(_records_from_rows(header, rows), columns=header))
+
+    def _save_mirror(self):
+        local_mirror.save_sheet(NCR_SHEET, self._header, self._raw.values.tolist())
+
+    def _load_mirror(self):
+        """Cold start: nạp snapshot từ mirror cục bộ (nếu có)."""
+        cached = local_mirror.load_sheet(NCR_SHEET)
+        if not cached or not cached[0]:
+            return False
+        header, rows, synced_at = cached
+        self._apply_frame(header, pd.DataFrame(rows, columns=header))
+        self.last_synced = get_now_vn() - timedelta(seconds=max(0, time.time() - synced_at))
+        return True
+
+    def _delta_sync(self, ws):
+        """
+        Đồng bộ phần thay đổi. Trả về False nếu cần tải lại toàn bộ
+        (header đổi, số dòng giảm, quá nhiều dòng thay đổi...).
+        """
+        key_idx, ts_idx = self._tracking_cols(self._header)
+        if key_idx is None or self._raw.empty:
+            return False
+
+        key_l = _col_letter(key_idx + 1)
+        ts_l = _col_letter(ts_idx + 1)
+        header_vr, key_vr, ts_vr = ws.batch_get(["1:1", f"{key_l}2:{key_l}", f"{ts_l}2:{ts_l}"])
+
+        # "1:1" bỏ các ô trống cuối dòng -> so sánh sau khi cắt đuôi rỗng
+        header = list(header_vr[0]) if header_vr else []
+        known = list(self._header)
+        while known and known[-1] == "":
+            known.pop()
+        if header != known:
+            return False
+
+        keys = [str(r[0]) if r else "" for r in key_vr]
+        stamps = [str(r[0]) if r else "" for r in ts_vr]
+        n_new = max(len(keys), len(stamps))
+        keys += [""] * (n_new - len(keys))
+        stamps += [""] * (n_new - len(stamps))
+
+        n_old = len(self._keys)
+        if n_new < n_old:
+            return False
+
+        changed = [
+            i for i in range(n_old)
+            if keys[i] != self._keys[i] or stamps[i] != self._stamps[i]
+        ]
+        if len(changed) > MAX_DELTA_ROWS:
+            return False
+
+        if not changed and n_new == n_old:
+            return True
+
+        # Một request duy nhất cho các dòng thay đổi + khối dòng mới append
+        last_l = _col_letter(len(self._header))
+        ranges = [f"A{i + 2}:{last_l}{i + 2}" for i in changed]
+        if n_new > n_old:
+            ranges.append(f"A{n_old + 2}:{last_l}{n_new + 1}")
+        fetched = ws.batch_get(ranges)
+
+        rows, positions = [], []
+        for i, vr in zip(changed, fetched):
+            rows.append(vr[0] if vr else [])
+            positions.append(i)
+        if n_new > n_old:
+            appended = list(fetched[-1])
+            appended += [[]] * (n_new - n_old - len(appended))
+            rows.extend(appended)
+            positions.extend(range(n_old, n_new))
+
+        delta = pd.DataFrame(_records_from_rows(self._header, rows), columns=self._header, index=positions)
+        self._merge_rows(delta)
+        self._remember_watermark(keys, stamps)
+        return True
+
+    def _merge_rows(self, delta):
+        """Thay/chèn các dòng (index = vị trí dòng) vào frame thô, snapshot chuẩn hóa và bảng phiếu."""
+        delta_norm = normalize_ncr_frame(delta)
+        affected = set()
+        if 'so_phieu' in self._snapshot.columns:
+            affected.update(self._snapshot['so_phieu'].reindex(delta.index).dropna())
+        if 'so_phieu' in delta_norm.columns:
+            affected.update(delta_norm['so_phieu'].dropna())
+
+        self._raw = pd.concat([self._raw.drop(index=delta.index, errors='ignore'), delta]).sort_index()
+        # concat hai category khác tập giá trị -> object, ép kiểu lại
+        self._snapshot = apply_ncr_schema(pd.concat(
+            [self._snapshot.drop(index=delta.index, errors='ignore'), delta_norm]
+        ).sort_index())
+        self._update_tickets(affected)
+        self.version += 1
+        self._snapshot.attrs[SNAPSHOT_VERSION] = self.version
+
+    def _update_tickets(self, keys):
+        """Tính lại bảng phiếu chỉ cho các so_phieu bị ảnh hưởng (append / đổi trạng thái)."""
+        if self._tickets.empty or 'so_phieu' not in self._snapshot.columns:
+            self._tickets = build_ticket_frame(self._snapshot)
+            return
+        if not keys:
+            return
+        rebuilt = build_ticket_frame(self._snapshot[self._snapshot['so_phieu'].isin(keys)])
+        kept = self._tickets[~self._tickets['so_phieu'].isin(keys)]
+        self._tickets = apply_ncr_schema(
+            pd.concat([kept, rebuilt]).sort_values('so_phieu', kind='stable', ignore_index=True)
+        )
+
+    def _patch_cells(self, updates):
+        """
+        Vá trực tiếp các ô ('B5' -> giá trị) vào snapshot (đang giữ lock).
+        Dùng cho cập nhật lạc quan khi ghi qua write queue chưa flush.
+        """
+        if self._raw.empty or not updates:
+            return
+        key_idx, ts_idx = self._tracking_cols(self._header)
+        patched = {}
+        for upd in updates:
+            if ':' in upd['range']:
+                continue
+            row, col = gspread.utils.a1_to_rowcol(upd['range'])
+            pos, value = row - 2, upd['values'][0][0]
+            if pos < 0 or pos >= len(self._raw) or col > len(self._header):
+                continue
+            if pos not in patched:
+                patched[pos] = self._raw.loc[pos].astype(object).copy()
+            patched[pos].iloc[col - 1] = value
+            if col - 1 == ts_idx:
+                self._stamps[pos] = str(value)
+            if col - 1 == key_idx:
+                self._keys[pos] = str(value)
+                self._row_index = None
+        if patched:
+            self._merge_rows(pd.DataFrame(list(patched.values()), index=list(patched.keys())))
+
+    def _apply_pending_writes(self):
+        """Áp lại các cập nhật còn trong write queue (chưa flush) lên snapshot vừa đồng bộ."""
+        from core.write_queue import get_write_queue
+        self._patch_cells(get_write_queue().pending(NCR_SHEET))
+
+    def _sync(self, allow_full=True):
+        """
+        Đồng bộ với Sheet (delta hoặc toàn bộ) rồi ghi mirror cục bộ. Gọi khi đang giữ lock.
+        allow_full=False: chỉ delta; cần tải toàn bộ -> trả False (để thread nền làm).
+        """
+        ws = self._open_ws()
+        before = self._raw
+        need_full = self._force_full or self._syncs_since_full >= FULL_RESYNC_EVERY
+        if not need_full and self._delta_sync(ws):
+            self._syncs_since_full += 1
+        elif allow_full:
+            self._full_sync(ws)
+            self._syncs_since_full = 0
+            self._force_full = False
+        else:
+            return False
+        self._dirty = False
+        self.last_synced = get_now_vn()
+        if self._raw is not before:
+            self._save_mirror()
+        self._apply_pending_writes()
+        return True
+
+    def _background_sync(self):
+        with self._lock:
+            try:
+                self._sync()
+            except Exception as e:
+                print(f"NcrRepository background sync error: {e}")
+
+    def _ensure_fresh(self):
+        epoch = _refresh_epoch()
+        if epoch == self._epoch:
+            return
+        if self.background and not self._dirty and not self._raw.empty:
+            # Refresher nền giữ snapshot mới -> hết TTL phục vụ bản hiện có, không chờ lock / không tải
+            self._epoch = epoch
+            return
+        with self._lock:
+            # Double-check: request khác có thể vừa tải xong trong lúc chờ lock
+            if epoch == self._epoch:
+                return
+            self._epoch = epoch
+            if self._raw.empty and self._force_full and self._load_mirror():
+                # Cold start: phục vụ ngay từ mirror, delta sync chạy nền
+                self._force_full = False
+                local_mirror.start_background(self._background_sync, name="ncr-repository-sync")
+                return
+            if self.background and not self._raw.empty:
+                # Sau invalidate chỉ delta sync; cần tải toàn bộ thì để thread nền làm
+                try:
+                    if self._dirty and not self._sync(allow_full=False):
+                        local_mirror.start_background(self._background_sync, name="ncr-repository-sync")
+                except Exception as e:
+                    print(f"NcrRepository refresh error: {e}")
+                return
+            try:
+                self._sync()
+            except Exception as e:
+                # Giữ snapshot cũ, thử lại ở cửa sổ làm mới kế tiếp
+                print(f"NcrRepository refresh error: {e}")
+
+    def refresh(self):
+        """Đồng bộ ngay (BackgroundRefresher gọi trên thread nền); frame mới thay nguyên khối khi xong."""
+        with self._lock:
+            self._sync()
+
+    # --- Bootstrap (core.local_mirror.bootstrap_sheets) ---
+    def needs_full_values(self):
+        """Lần đọc kế tiếp sẽ tải toàn bộ sheet -> bootstrap gộp NCR_DATA vào request chung."""
+        if _refresh_epoch() == self._epoch:
+            return False
+        if self._raw.empty and self._force_full:
+            # Cold start có mirror -> đọc từ đĩa, không cần tải
+            return local_mirror.mirror_synced_at(NCR_SHEET) is None
+        return self._force_full or self._syncs_since_full >= FULL_RESYNC_EVERY
+
+    def apply_values(self, values):
+        """Nạp toàn bộ sheet vừa tải (values_batch_get) thay cho full sync của cửa sổ làm mới hiện tại."""
+        epoch = _refresh_epoch()
+        with self._lock:
+            if epoch == self._epoch:
+                return
+            self._epoch = epoch
+            self._apply_values(values)
+            self._force_full = False
+            self._syncs_since_full = 0
+            self.last_synced = get_now_vn()
+            self._save_mirror()
+            self._apply_pending_writes()
+
+    # --- Public API ---
+    def raw(self):
+        """Bản sao dữ liệu thô (tên cột như trên Sheet, vd: so_phieu_ncr)."""
+        self._ensure_fresh()
+        return self._raw.copy()
+
+    def snapshot(self):
+        """Bản sao snapshot đã chuẩn hóa (so_phieu, sl_loi, date_obj, bo_phan, hours_stuck...)."""
+        self._ensure_fresh()
+        return self._snapshot.copy()
+
+    def tickets(self):
+        """Bản sao bảng phiếu (một dòng / so_phieu, xem build_ticket_frame)."""
+        self._ensure_fresh()
+        return self._tickets.copy()
+
+    def derived(self, name, build):
+        """
+        Kết quả build(snapshot, tickets) dùng chung, giữ đến khi snapshot đổi version.
+        build không được sửa frame truyền vào (không copy để tránh tốn bộ nhớ).
+        """
+        self._ensure_fresh()
+        # Lock riêng: không chờ đồng bộ nền (đang giữ _lock khi gọi Sheets).
+        # Đọc version trước frame -> kết quả không bao giờ cũ hơn version ghi kèm.
+        with self._derived_lock:
+            version = self.version
+            cached = self._derived.get(name)
+            if cached is None or cached[0] != version:
+                cached = (version, build(self._snapshot, self._tickets))
+                self._derived[name] = cached
+            return cached[1]
+
+    def _ticket_index(self):
+        """Index so_phieu_ncr -> [số dòng trên sheet], dựng lười từ watermark (đang giữ lock)."""
+        if self._row_index is None:
+            index = {}
+            for pos, key in enumerate(self._keys):
+                index.setdefault(key.strip(), []).append(pos + 2)
+            self._row_index = index
+        return self._row_index
+
+    def _read_indexed_rows(self, ws, key):
+        """
+        Đọc trực tiếp (1 batch_get) header + các dòng của phiếu theo index.
+        Trả về None nếu index không khớp với sheet (phiếu mới, dòng bị chèn/xóa, header đổi).
+        """
+        with self._lock:
+            header = list(self._header)
+            rows = list(self._ticket_index().get(key, []))
+        headers = [str(h).strip().lower() for h in header]
+        key_col = COLUMN_MAPPING['so_phieu']
+        if not rows or key_col not in headers:
+            return None
+
+        key_idx = headers.index(key_col)
+        last_l = _col_letter(len(header))
+        fetched = ws.batch_get(["1:1"] + [f"A{r}:{last_l}{r}" for r in rows])
+
+        live_header = list(fetched[0][0]) if fetched and fetched[0] else []
+        known = list(header)
+        while known and known[-1] == "":
+            known.pop()
+        if live_header != known:
+            return None
+
+        result = []
+        for r, vr in zip(rows, fetched[1:]):
+            values = list(vr[0]) if vr else []
+            values += [""] * (len(header) - len(values))
+            if str(values[key_idx]).strip() != key:
+                return None
+            result.append((r, values))
+        return headers, result
+
+    def fetch_ticket_rows(self, ws, so_phieu):
+        """
+        Lấy các dòng HIỆN TẠI của một phiếu để ghi có mục tiêu (thay cho get_all_values + quét).
+        Returns: (headers_lowercase, [(sheet_row, row_values), ...])
+
+        Dùng index so_phieu -> dòng và xác minh bằng 1 lần đọc nhỏ; nếu phiếu chưa có trong
+        index thì delta sync rồi thử lại; cuối cùng mới quét toàn sheet.
+        """
+        self._ensure_fresh()
+        key = str(so_phieu).strip()
+
+        found = self._read_indexed_rows(ws, key)
+        if found is None:
+            # Phiếu vừa append / index lệch -> delta sync để cập nhật index rồi thử lại
+            self.invalidate()
+            self._ensure_fresh()
+            found = self._read_indexed_rows(ws, key)
+        if found is not None:
+            from core.write_queue import get_write_queue
+            headers, rows = found
+            return headers, get_write_queue().overlay_rows(NCR_SHEET, rows)
+
+        # Fallback: quét toàn bộ (hành vi cũ), lần đọc sau tải lại toàn bộ snapshot
+        self.invalidate(full=True)
+        data = ws.get_all_values()
+        if not data:
+            return [], []
+        headers = [str(h).strip().lower() for h in data[0]]
+        idx_so_phieu = headers.index(COLUMN_MAPPING['so_phieu'])
+        rows = [
+            (i, row) for i, row in enumerate(data[1:], start=2)
+            if str(row[idx_so_phieu]).strip() == key
+        ]
+        return headers, rows
+
+    def apply_cell_updates(self, updates):
+        """Cập nhật lạc quan snapshot theo các ô vừa đưa vào write queue."""
+        with self._lock:
+            self._patch_cells(updates)
+
+    def invalidate(self, full=False):
+        """
+        Buộc lần đọc kế tiếp đồng bộ lại từ Sheet.
+        full=True: tải lại toàn bộ (dùng khi sửa dòng mà không cập nhật thoi_gian_cap_nhat).
+        """
+        with self._lock:
+            self._epoch = None
+            self._dirty = True
+            if full:
+                self._force_full = True
+
+
+@st.cache_resource
+def get_ncr_repository():
+    """Repository NCR_DATA duy nhất cho toàn process (Cached resource)."""
+    return NcrRepository()
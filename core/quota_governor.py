@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import streamlit as st
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+# Quota mặc định của Sheets API cho một service account: 60 read + 60 write / phút
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+# Số request được phép bắn liền (phần còn lại rải đều trong phút -> không bao giờ vượt quota)
+BURST = 15
+# Số token luôn giữ lại cho request ưu tiên cao (background không được dùng)
+BACKGROUND_RESERVE = 5
+# Số lần thử lại khi vẫn dính 429 (quota bị process khác dùng chung)
+MAX_RETRIES_429 = 3
+
+READ = "read"
+WRITE = "write"
+
+# Độ ưu tiên: số nhỏ được phục vụ trước
+PRIORITY_INTERACTIVE = 0   # Lưu phiếu NCR, thao tác user đang chờ
+PRIORITY_NORMAL = 1        # Đọc dữ liệu trang
+PRIORITY_BACKGROUND = 2    # Làm mới nền, badge sidebar
+
+_local = threading.local()
+
+
+def current_priority():
+    return getattr(_local, "priority", PRIORITY_NORMAL)
+
+
+@contextmanager
+def quota_priority(priority):
+    """Gán độ ưu tiên cho mọi request Sheets trong khối with (theo thread)."""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def classify_request(method, endpoint):
+    """GET (và batchGet) -> read, còn lại -> write."""
+    if method.upper() == "GET" or ":batchGet" in endpoint:
+        return READ
+    return WRITE
+
+
+class _Bucket:
+    def __init__(self, per_minute, burst):
+        self.capacity = float(burst)
+        self.rate = max(per_minute - burst, 1) / 60.0  # token / giây
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class QuotaGovernor:
+    """
+    Token bucket dùng chung toàn process cho Google Sheets API.
+    - Mỗi loại (read/write) một bucket; request chờ theo thứ tự ưu tiên rồi FIFO.
+    - Request background không được dùng BACKGROUND_RESERVE token cuối.
+    - usage(): số request trong 60s gần nhất, token còn lại, thời gian chờ.
+    """
+
+    def __init__(self, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE,
+                 burst=BURST, background_reserve=BACKGROUND_RESERVE):
+        self.limits = {READ: reads_per_minute, WRITE: writes_per_minute}
+        self.background_reserve = background_reserve
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._buckets = {kind: _Bucket(limit, min(burst, limit)) for kind, limit in self.limits.items()}
+        self._waiters = {READ: [], WRITE: []}
+        self._history = {READ: deque(), WRITE: deque()}
+        self._waited = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._throttled = 0
+
+    def acquire(self, kind, priority=None):
+        """Chờ đến khi có token cho một request. Trả về số giây đã chờ."""
+        priority = current_priority() if priority is None else priority
+        bucket = self._buckets[kind]
+        waiters = self._waiters[kind]
+        entry = (priority, next(self._seq))
+        floor = self.background_reserve if priority >= PRIORITY_BACKGROUND else 0
+        start = time.monotonic()
+
+        with self._cond:
+            heapq.heappush(waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    if waiters[0] == entry:
+                        if bucket.tokens >= 1 + floor:
+                            bucket.tokens -= 1
+                            break
+                        timeout = (1 + floor - bucket.tokens) / bucket.rate
+                    else:
+                        timeout = None  # Chờ request đứng trước lấy xong token
+                    self._cond.wait(timeout)
+            finally:
+                waiters.remove(entry)
+                heapq.heapify(waiters)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - start
+            self._history[kind].append(time.time())
+            if waited > 0.01:
+                self._waited += 1
+                self._wait_seconds += waited
+                self._max_wait = max(self._max_wait, waited)
+        return waited
+
+    def penalize(self, kind, attempt):
+        """Bị 429 dù đã điều tiết: rút cạn bucket, lần thử sau chờ lâu dần."""
+        with self._cond:
+            bucket = self._buckets[kind]
+            bucket.refill(time.monotonic())
+            bucket.tokens = min(bucket.tokens, 0.0) - (2 ** attempt - 1)
+            self._throttled += 1
+
+    def usage(self):
+        """Tình trạng quota hiện tại (hiển thị giám sát)."""
+        now = time.time()
+        with self._cond:
+            result = {}
+            for kind, history in self._history.items():
+                while history and now - history[0] > 60:
+                    history.popleft()
+                bucket = self._buckets[kind]
+                bucket.refill(time.monotonic())
+                result[kind] = {
+                    "last_minute": len(history),
+                    "limit": self.limits[kind],
+                    "tokens": max(bucket.tokens, 0.0),
+                    "waiting": len(self._waiters[kind]),
+                }
+            result["waits"] = self._waited
+            result["avg_wait"] = self._wait_seconds / self._waited if self._waited else 0.0
+            result["max_wait"] = self._max_wait
+            result["throttled_429"] = self._throttled
+        return result
+
+
+class GovernedHTTPClient(HTTPClient):
+    """HTTP client của gspread đi qua QuotaGovernor (truyền vào service_account_from_dict)."""
+
+    def request(self, method, endpoint, *args, **kwargs):
+        governor = get_quota_governor()
+        kind = classify_request(method, endpoint)
+        attempt = 0
+        while True:
+            governor.acquire(kind)
+            try:
+                return super().request(method, endpoint, *args, **kwargs)
+            except APIError as e:
+                if e.code != 429 or attempt >= MAX_RETRIES_429:
+                    raise
+                attempt += 1
+                governor.penalize(kind, attempt)
+
+
+@st.cache_resource
+def get_quota_governor():
+    """Governor duy nhất cho toàn process. Cấu hình tùy chọn: secrets [quota]."""
+    try:
+        cfg = dict(st.secrets.get("quota", {}))
+    except Exception:
+        cfg = {}
+    return QuotaGovernor(
+        reads_per_minute=int(cfg.get("reads_per_minute", READS_PER_MINUTE)),
+        writes_per_minute=int(cfg.get("writes_per_minute", WRITES_PER_MINUTE)),
+        burst=int(cfg.get("burst", BURST)),
+        background_reserve=int(cfg.get("background_reserve", BACKGROUND_RESERVE)),
+    )
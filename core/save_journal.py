@@ -0,0 +1,307 @@
+import io
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+import streamlit as st
+
+from core.local_mirror import get_data_dir
+from core.quota_governor import quota_priority, PRIORITY_INTERACTIVE
+
+# Nhật ký lưu phiếu (offline-first): phiếu được ghi xuống đĩa trước, thread nền đẩy lên Cloudinary + Sheet
+DB_FILENAME = "save_journal.sqlite3"
+IMAGE_DIRNAME = "save_journal_images"
+# Retry khi đẩy lỗi (mất Wi-Fi, 429...): 5s, 10s, 20s... tối đa 5 phút; quá số lần -> 'failed' (thử lại thủ công)
+RETRY_BASE = 5
+RETRY_MAX = 300
+MAX_ATTEMPTS = 30
+# Phiếu đã đồng bộ vẫn hiển thị trong khoảng này (trang NCR của tôi)
+DONE_VISIBLE_SECONDS = 24 * 3600
+
+STATUS_PENDING = 'pending'
+STATUS_DRAINING = 'draining'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Bước đã qua của một entry (để retry không làm lại / không ghi trùng)
+STAGE_IMAGES = 'images'   # Chưa upload xong ảnh
+STAGE_APPEND = 'append'   # Ảnh xong, đã (có thể đã) gửi lệnh append lên Sheet
+
+
+class SaveJournal:
+    """
+    Hàng đợi lưu phiếu bền vững (SQLite cục bộ), dùng chung cho toàn process.
+    - submit(): ghi phiếu + ảnh (đã thu nhỏ) xuống đĩa, trả về idempotency key ngay (độ trễ cố định).
+    - Thread nền drain: upload ảnh (public_id cố định theo key -> upload lại không tạo ảnh trùng),
+      rồi append các dòng lỗi vào Sheet; retry + backoff khi lỗi.
+    - Retry sau khi đã gửi append: kiểm tra số phiếu đã có trên Sheet chưa trước khi append lại.
+    """
+
+    def __init__(self, data_dir):
+        self.db_path = os.path.join(data_dir, DB_FILENAME)
+        self.image_dir = os.path.join(data_dir, IMAGE_DIRNAME)
+        os.makedirs(self.image_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, owner TEXT, session TEXT, ncr_id TEXT,"
+                " spreadsheet_id TEXT, worksheet TEXT, rows TEXT, images TEXT, image_urls TEXT,"
+                " status TEXT, stage TEXT, attempts INTEGER DEFAULT 0, last_error TEXT,"
+                " created_at REAL, updated_at REAL, next_attempt REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_status ON entries (status, next_attempt)")
+            # Process trước dừng giữa chừng -> trả entry đang drain về hàng đợi
+            conn.execute("UPDATE entries SET status = ? WHERE status = ?", (STATUS_PENDING, STATUS_DRAINING))
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- Producer API ---
+    def submit(self, owner, session, ncr_id, spreadsheet_id, worksheet, rows, image_files=None):
+        """
+        Ghi phiếu vào nhật ký (commit xuống đĩa) rồi đánh thức thread drain.
+        image_files: file upload của Streamlit (được thu nhỏ trước khi lưu).
+        Returns: idempotency key của lần lưu.
+        """
+        from core.services.image_upload_service import prepare_image
+
+        key = uuid.uuid4().hex
+        images = []
+        if image_files:
+            folder = os.path.join(self.image_dir, key)
+            os.makedirs(folder, exist_ok=True)
+            for idx, f in enumerate(image_files):
+                path = os.path.join(folder, f"{idx}.jpg")
+                with open(path, 'wb') as out:
+                    out.write(prepare_image(f))
+                images.append({'path': path, 'name': getattr(f, 'name', f"{idx}.jpg")})
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO entries (key, owner, session, ncr_id, spreadsheet_id, worksheet, rows, images,"
+                    " status, stage, attempts, created_at, updated_at, next_attempt)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                    (key, owner, session, ncr_id, spreadsheet_id, worksheet,
+                     json.dumps(rows, default=str, ensure_ascii=False), json.dumps(images),
+                     STATUS_PENDING, STAGE_IMAGES if images else STAGE_APPEND, now, now, now),
+                )
+        finally:
+            conn.close()
+        self._ensure_worker()
+        self._wake.set()
+        return key
+
+    def retry(self, key):
+        """Đưa entry lỗi về hàng đợi (nút 'Thử lại')."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE entries SET status = ?, attempts = 0, next_attempt = ? WHERE key = ? AND status = ?",
+                    (STATUS_PENDING, time.time(), key, STATUS_FAILED),
+                )
+        finally:
+            conn.close()
+        self._ensure_worker()
+        self._wake.set()
+
+    def entries(self, owner=None):
+        """Các lần lưu chưa đồng bộ xong (+ vừa xong trong 24h) của owner (None = tất cả)."""
+        conn = self._connect()
+        try:
+            query = (
+                "SELECT key, owner, ncr_id, status, attempts, last_error, created_at, updated_at"
+                " FROM entries WHERE (status != ? OR updated_at > ?)"
+            )
+            params = [STATUS_DONE, time.time() - DONE_VISIBLE_SECONDS]
+            if owner is not None:
+                query += " AND owner = ?"
+                params.append(owner)
+            rows = conn.execute(query + " ORDER BY created_at DESC", params).fetchall()
+        finally:
+            conn.close()
+        return pd.DataFrame([dict(r) for r in rows])
+
+    def stats(self):
+        """Số entry theo trạng thái (hiển thị giám sát)."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) FROM entries GROUP BY status").fetchall()
+        finally:
+            conn.close()
+        return {status: count for status, count in rows}
+
+    # --- Drain ---
+    def _claim_due(self):
+        """Lấy (và đánh dấu draining) entry đến hạn sớm nhất; None nếu không có."""
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT * FROM entries WHERE status = ? AND next_attempt <= ? ORDER BY created_at LIMIT 1",
+                    (STATUS_PENDING, time.time()),
+                ).fetchone()
+                if row is None:
+                    return None
+                claimed = conn.execute(
+                    "UPDATE entries SET status = ? WHERE key = ? AND status = ?",
+                    (STATUS_DRAINING, row['key'], STATUS_PENDING),
+                ).rowcount
+            return dict(row) if claimed else None
+        finally:
+            conn.close()
+
+    def _next_due_in(self):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT MIN(next_attempt) FROM entries WHERE status = ?", (STATUS_PENDING,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row or row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def _update(self, key, **fields):
+        fields['updated_at'] = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    f"UPDATE entries SET {', '.join(f'{k} = ?' for k in fields)} WHERE key = ?",
+                    list(fields.values()) + [key],
+                )
+        finally:
+            conn.close()
+
+    def _upload_images(self, entry):
+        from core.services.image_upload_service import upload_images
+        images = json.loads(entry['images'] or '[]')
+        files = []
+        for img in images:
+            with open(img['path'], 'rb') as f:
+                buf = io.BytesIO(f.read())
+            buf.name = img['name']
+            files.append(buf)
+        # Ảnh trong nhật ký đã thu nhỏ/nén lúc submit -> upload nguyên bytes
+        urls, errors = upload_images(
+            files, entry['ncr_id'], public_id_base=f"{entry['ncr_id']}_{entry['key'][:8]}", prepared=True
+        )
+        if errors:
+            raise RuntimeError(f"Upload ảnh lỗi: {', '.join(f'{name}: {e}' for name, e in errors)}")
+        return urls
+
+    def _already_appended(self, entry, ws):
+        """
+        Lần trước đã gửi append (có thể đã thành công) -> số phiếu đã có trên Sheet chưa?
+        Đọc thẳng cột so_phieu_ncr trên Sheet (không dựa vào snapshot - đồng bộ lỗi sẽ cho kết quả cũ);
+        lỗi đọc -> raise, entry được thử lại sau thay vì append trùng.
+        """
+        from utils.ncr_helpers import COLUMN_MAPPING
+        ncr_id = str(entry['ncr_id']).strip()
+        header = [str(h).strip().lower() for h in ws.row_values(1)]
+        key_col = COLUMN_MAPPING['so_phieu']
+        if key_col in header:
+            values = ws.col_values(header.index(key_col) + 1)[1:]
+            return ncr_id in {str(v).strip() for v in values}
+        return ws.find(ncr_id) is not None
+
+    def _drain_entry(self, entry):
+        from core.gsheets import get_worksheet, align_rows
+        from core.cache_tags import invalidate, NCR_DATA
+
+        key = entry['key']
+        if entry['stage'] == STAGE_IMAGES:
+            urls = self._upload_images(entry)
+            entry['image_urls'] = "\n".join(url for url in urls if url)
+            entry['stage'] = STAGE_APPEND
+            # Lưu URL trước khi append: retry sau đó không upload lại
+            self._update(key, image_urls=entry['image_urls'], stage=STAGE_APPEND)
+
+        ws = get_worksheet(entry['worksheet'], entry['spreadsheet_id'])
+        if entry['attempts'] > 0 and self._already_appended(entry, ws):
+            self._finish(entry)
+            return
+
+        rows = json.loads(entry['rows'])
+        for row in rows:
+            row['hinh_anh'] = entry['image_urls'] or row.get('hinh_anh', "")
+        # Đánh dấu đã thử (trước khi gửi) để lần retry kiểm tra trùng trước khi append lại
+        self._update(key, attempts=entry['attempts'] + 1)
+        header_row = ws.row_values(1)
+        if not header_row:
+            raise RuntimeError("Sheet chưa có Header!")
+        ws.append_rows(align_rows(header_row, rows), value_input_option="USER_ENTERED")
+        self._finish(entry)
+        invalidate(NCR_DATA)
+
+    def _finish(self, entry):
+        self._update(entry['key'], status=STATUS_DONE, last_error=None)
+        shutil.rmtree(os.path.join(self.image_dir, entry['key']), ignore_errors=True)
+
+    def drain(self):
+        """Đẩy mọi entry đến hạn (đồng bộ). Trả về số entry đã đồng bộ xong."""
+        done = 0
+        while True:
+            entry = self._claim_due()
+            if entry is None:
+                return done
+            try:
+                # Phiếu của user -> ưu tiên quota như thao tác lưu trực tiếp
+                with quota_priority(PRIORITY_INTERACTIVE):
+                    self._drain_entry(entry)
+                done += 1
+            except Exception as e:
+                attempts = entry['attempts'] + 1
+                self._update(
+                    entry['key'],
+                    status=STATUS_FAILED if attempts >= MAX_ATTEMPTS else STATUS_PENDING,
+                    attempts=attempts,
+                    last_error=str(e)[:500],
+                    next_attempt=time.time() + min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX),
+                )
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="save-journal", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+                wait = self._next_due_in()
+            except Exception as e:
+                print(f"Save journal drain error: {e}")
+                wait = RETRY_BASE
+            self._wake.wait(timeout=wait)
+            self._wake.clear()
+
+
+@st.cache_resource
+def get_save_journal():
+    """Nhật ký lưu phiếu duy nhất cho toàn process; còn entry chờ từ lần chạy trước -> drain ngay."""
+    data_dir = get_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    journal = SaveJournal(data_dir)
+    journal._ensure_worker()
+    return journal
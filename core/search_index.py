@@ -0,0 +1,131 @@
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Các cột tìm kiếm tự do (hợp đồng, lỗi, sản phẩm, vật tư, nguồn gốc)
+SEARCH_COLUMNS = ['hop_dong', 'ten_loi', 'ten_sp', 'ma_vat_tu', 'nguon_goc']
+# Độ dài n-gram của index (từ khóa ngắn hơn -> dò trên giá trị duy nhất)
+NGRAM = 3
+# Khớp nhiều giá trị hơn ngưỡng này -> lấy dòng bằng mask trên mã giá trị thay vì nối từng lát
+SLICE_LIMIT = 256
+
+
+@lru_cache(maxsize=65536)
+def _fold(text):
+    text = unicodedata.normalize('NFD', text.lower())
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    return ' '.join(text.replace('đ', 'd').split())
+
+
+def fold_text(value):
+    """Chuẩn hóa để so khớp: lowercase, bỏ dấu tiếng Việt, gộp khoảng trắng ('Bông  keo' -> 'bong keo')."""
+    return _fold(str(value))
+
+
+def match_values(values, term):
+    """Các giá trị (trong danh sách nhỏ, vd giá trị duy nhất) chứa từ khóa."""
+    needle = fold_text(term)
+    return [v for v in values if needle in fold_text(v)]
+
+
+def _ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class _ColumnIndex:
+    """Index một cột: giá trị duy nhất (đã bỏ dấu) + n-gram -> giá trị + giá trị -> vị trí dòng."""
+
+    def __init__(self, values):
+        codes, uniques = pd.factorize(values.astype(object), use_na_sentinel=True)
+        self.folded = [fold_text(v) for v in uniques]
+        self.grams = {}
+        for value_id, text in enumerate(self.folded):
+            for gram in _ngrams(text):
+                self.grams.setdefault(gram, set()).add(value_id)
+        self.codes = codes
+        # Dòng sắp theo mã giá trị -> mỗi giá trị là một lát liên tục
+        valid = codes >= 0
+        self.order = np.flatnonzero(valid)[np.argsort(codes[valid], kind='stable')]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(codes[valid], minlength=len(uniques)))])
+
+    def value_ids(self, needle):
+        candidates = None
+        for gram in _ngrams(needle):
+            ids = self.grams.get(gram, set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        if candidates is None:
+            candidates = range(len(self.folded))  # Từ khóa ngắn: dò toàn bộ giá trị duy nhất
+        return [v for v in candidates if needle in self.folded[v]]
+
+    def positions(self, needle):
+        ids = self.value_ids(needle)
+        if not ids:
+            return np.empty(0, dtype=np.int64)
+        if len(ids) > SLICE_LIMIT:
+            selected = np.zeros(len(self.folded) + 1, dtype=bool)  # slot cuối cho NaN (mã -1)
+            selected[ids] = True
+            return np.flatnonzero(selected[self.codes])
+        return np.concatenate([self.order[self.starts[v]:self.starts[v + 1]] for v in ids])
+
+
+class TextIndex:
+    """
+    Index tìm kiếm (n-gram trên giá trị duy nhất) cho các cột text của một frame.
+    search() trả về nhãn dòng (index hoặc cột key) khớp từ khóa - không quét lại toàn cột,
+    thời gian tìm phụ thuộc số giá trị khác nhau chứ không phải số dòng.
+    """
+
+    def __init__(self, frame, columns=SEARCH_COLUMNS, key=None, version=None):
+        self.labels = frame[key].to_numpy() if key else frame.index.to_numpy()
+        self.version = version  # version snapshot mà nhãn dòng thuộc về (None: không gắn snapshot)
+        self.columns = {col: _ColumnIndex(frame[col]) for col in columns if col in frame.columns}
+
+    def search(self, term, columns=None):
+        """Nhãn các dòng có ít nhất một cột (trong columns) chứa term (đã bỏ dấu)."""
+        needle = fold_text(term)
+        if not needle:
+            return pd.Index(self.labels)
+        found = [
+            self.columns[col].positions(needle)
+            for col in (columns or self.columns) if col in self.columns
+        ]
+        rows = np.zeros(len(self.labels), dtype=bool)
+        for positions in found:
+            rows[positions] = True
+        return pd.Index(self.labels[rows])
+
+
+def get_row_search_index():
+    """Index theo dòng lỗi của snapshot NCR (nhãn = index của snapshot, gắn version của snapshot)."""
+    from core.ncr_repository import get_ncr_repository, SNAPSHOT_VERSION
+    return get_ncr_repository().derived(
+        'search_rows',
+        lambda snapshot, tickets: TextIndex(snapshot, version=snapshot.attrs.get(SNAPSHOT_VERSION)),
+    )
+
+
+def search_rows(frame, term, columns=None):
+    """
+    Lọc frame (bản sao / lát cắt của snapshot NCR, vd get_report_data) theo từ khóa.
+    Nhãn dòng chỉ có nghĩa trong cùng một version snapshot: dùng index chung khi frame
+    cùng version, ngược lại (snapshot vừa đổi) dựng index tạm ngay trên frame.
+    """
+    from core.ncr_repository import SNAPSHOT_VERSION
+    index = get_row_search_index()
+    version = frame.attrs.get(SNAPSHOT_VERSION)
+    if version is None or version != index.version:
+        index = TextIndex(frame, columns=columns or SEARCH_COLUMNS)
+    return frame[frame.index.isin(index.search(term, columns))]
+
+
+def get_ticket_search_index():
+    """Index theo phiếu (nhãn = so_phieu, ten_loi = danh sách lỗi của phiếu)."""
+    from core.ncr_repository import get_ncr_repository
+    return get_ncr_repository().derived(
+        'search_tickets',
+        lambda snapshot, tickets: TextIndex(tickets, key='so_phieu') if not tickets.empty else TextIndex(tickets),
+    )
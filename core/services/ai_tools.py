@@ -1,9 +1,20 @@
 import pandas as pd
 import streamlit as st
 from datetime import datetime
-from core.services.report_service import get_report_data
+from core.services.report_service import get_report_data, get_report_tickets
+from core.services.report_cube import (
+    CUBE_DIMS, build_report_cube, get_report_cube, slice_cube, cube_totals, contains_mask,
+)
+from core.search_index import SEARCH_COLUMNS, search_rows
 import json
 
+# Tên chiều bộ phận trong cube (các tool lọc / xếp hạng theo tên đầy đủ)
+DEPT_DIM = 'bo_phan_full'
+
+def _int_dict(series):
+    """Series tổng hợp -> dict {tên: int} để trả JSON."""
+    return {str(k): int(v) for k, v in series.items()}
+
 def filter_data(contract=None, department=None, year=None, month=None, defect_name=None):
     """
     Filters NCR data and returns a summary.
@@ -18,38 +29,19 @@ def filter_data(contract=None, department=None, year=None, month=None, defect_na
     Returns:
         str: JSON string summary of filtered data (Total count, filtered criteria).
     """
-    df = get_report_data()
+    cube = get_report_cube()
     
-    # 1. Apply Filters
-    if contract:
-        df = df[df['hop_dong'].astype(str).str.contains(contract, case=False, na=False)]
-    
-    if department:
-        # Check bo_phan_full if exists, else bo_phan
-        col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        df = df[df[col].astype(str).str.contains(department, case=False, na=False)]
-        
-    if year:
-        df = df[df['year'] == int(year)]
-        
-    if month:
-        df = df[df['month'] == int(month)]
-        
-    if defect_name:
-        df = df[df['ten_loi'].astype(str).str.contains(defect_name, case=False, na=False)]
+    # 1. Apply Filters (cắt cube thay vì quét toàn bộ dữ liệu)
+    filters = {'hop_dong': contract, DEPT_DIM: department, 'ten_loi': defect_name}
+    defects = slice_cube(cube.defects, filters, year, month)
+    tickets = slice_cube(cube.tickets, filters, year, month)
         
     # 2. Aggregations for Insight
-    total_count = len(df)
-    unique_tickets = df['so_phieu'].nunique() if not df.empty else 0
+    total_count = int(defects['so_dong_loi'].sum()) if not defects.empty else 0
+    unique_tickets = int(tickets['so_phieu'].sum()) if not tickets.empty else 0
     
-    top_defects = {}
-    if not df.empty and 'ten_loi' in df.columns:
-        top_defects = df['ten_loi'].value_counts().head(3).to_dict()
-        
-    top_depts = {}
-    if not df.empty:
-         col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-         top_depts = df[col].value_counts().head(3).to_dict()
+    top_defects = _int_dict(cube_totals(defects, 'ten_loi', 'so_dong_loi', 3))
+    top_depts = _int_dict(cube_totals(defects, DEPT_DIM, 'so_dong_loi', 3))
 
     return json.dumps({
         "status": "success",
@@ -73,33 +65,15 @@ def get_top_defects(top_n=5, contract=None, department=None, year=None, month=No
         year (int): Filter by year.
         month (int): Filter by month.
     """
-    df = get_report_data()
-    if df.empty: return "No data."
+    cube = get_report_cube()
+    if cube.defects.empty: return "No data."
     
     # Apply Filters
-    if contract:
-        df = df[df['hop_dong'].astype(str).str.contains(contract, case=False, na=False)]
-    
-    if department:
-        col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        df = df[df[col].astype(str).str.contains(department, case=False, na=False)]
-        
-    if year:
-        df = df[df['year'] == int(year)]
-        
-    if month:
-        df = df[df['month'] == int(month)]
-        
-    if df.empty: return "No data matching filters."
+    defects = slice_cube(cube.defects, {'hop_dong': contract, DEPT_DIM: department}, year, month)
+    if defects.empty: return "No data matching filters."
     
     # Sum quantities by defect type instead of counting rows
-    if 'sl_loi' in df.columns:
-        df['sl_loi_val'] = pd.to_numeric(df['sl_loi'], errors='coerce').fillna(0)
-        counts = df.groupby('ten_loi')['sl_loi_val'].sum().sort_values(ascending=False).head(int(top_n)).astype(int).to_dict()
-    else:
-        # Fallback to count if sl_loi not available
-        counts = df['ten_loi'].value_counts().head(int(top_n)).to_dict()
-    
+    counts = _int_dict(cube_totals(defects, 'ten_loi', 'sl_loi', top_n))
     return json.dumps(counts, ensure_ascii=False)
 
 def compare_periods(period1, period2):
@@ -110,13 +84,13 @@ def compare_periods(period1, period2):
         period1 (str): "YYYY-MM"
         period2 (str): "YYYY-MM"
     """
-    df = get_report_data()
-    if df.empty: return "No data."
+    defects = get_report_cube().defects
+    if defects.empty: return "No data."
     
     def get_count(p_str):
         try:
             y, m = map(int, p_str.split('-'))
-            return len(df[(df['year'] == y) & (df['month'] == m)])
+            return int(slice_cube(defects, year=y, month=m)['so_dong_loi'].sum())
         except:
             return 0
             
@@ -135,11 +109,10 @@ def compare_periods(period1, period2):
 
 def get_department_ranking():
     """Returns departments ranked by total errors."""
-    df = get_report_data()
-    if df.empty: return "No data."
+    defects = get_report_cube().defects
+    if defects.empty: return "No data."
     
-    col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-    ranking = df[col].value_counts().to_dict()
+    ranking = _int_dict(cube_totals(defects, DEPT_DIM, 'so_dong_loi'))
     return json.dumps(ranking, ensure_ascii=False)
 
 def get_ncr_details(ncr_id):
@@ -181,18 +154,14 @@ def get_contract_ranking(top_n=5, department=None, year=None, month=None):
     Xếp hạng các Hợp đồng (cụ thể) có nhiều lỗi nhất.
     Có thể lọc theo bộ phận hoặc thời gian.
     """
-    df = get_report_data()
-    if df.empty: return "No data."
+    tickets = get_report_cube().tickets
+    if tickets.empty: return "No data."
     
-    # Apply Filters
-    if department:
-        col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        df = df[df[col].astype(str).str.contains(department, case=False, na=False)]
-    if year: df = df[df['year'] == int(year)]
-    if month: df = df[df['month'] == int(month)]
+    # Apply Filters (cube theo phiếu: đếm mỗi phiếu một lần)
+    tickets = slice_cube(tickets, {DEPT_DIM: department}, year, month)
     
-    # Count unique tickets per contract
-    ranking = df.groupby('hop_dong')['so_phieu'].nunique().sort_values(ascending=False).head(int(top_n)).to_dict()
+    # Count tickets per contract
+    ranking = _int_dict(cube_totals(tickets, 'hop_dong', 'so_phieu', top_n))
     return json.dumps(ranking, ensure_ascii=False)
 
 def get_contract_group_ranking(top_n=5, department=None, year=None, month=None):
@@ -201,21 +170,14 @@ def get_contract_group_ranking(top_n=5, department=None, year=None, month=None):
     Có thể lọc theo bộ phận hoặc thời gian.
     Dùng cho: "Nhóm hợp đồng nào nhiều lỗi nhất?" hoặc "Nhóm hợp đồng nào lỗi nhiều nhất ở khâu FI?"
     """
-    df = get_report_data()
-    if df.empty: return "No data."
+    tickets = get_report_cube().tickets
+    if tickets.empty: return "No data."
     
-    # Apply Filters
-    if department:
-        col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        df = df[df[col].astype(str).str.contains(department, case=False, na=False)]
-    if year: df = df[df['year'] == int(year)]
-    if month: df = df[df['month'] == int(month)]
+    # Apply Filters (cube theo phiếu: đếm mỗi phiếu một lần)
+    tickets = slice_cube(tickets, {DEPT_DIM: department}, year, month)
     
-    # Group Logic (Suffix)
-    # Group Logic (Suffix)
-    df['group'] = df['hop_dong'].apply(lambda x: str(x).strip()[-3:] if len(str(x).strip()) >= 3 else "Khác")
-    # Count unique tickets per group
-    ranking = df.groupby('group')['so_phieu'].nunique().sort_values(ascending=False).head(int(top_n)).to_dict()
+    # Count tickets per group (nhom_hd = 3 ký tự cuối của hợp đồng)
+    ranking = _int_dict(cube_totals(tickets, 'nhom_hd', 'so_phieu', top_n))
     return json.dumps(ranking, ensure_ascii=False)
 
 def general_data_query(filter_conditions: dict) -> str:
@@ -238,36 +200,41 @@ def general_data_query(filter_conditions: dict) -> str:
         }
     """
     with st.spinner("Đang truy vấn dữ liệu theo yêu cầu..."):
-        df = get_report_data()
-        if df.empty:
+        cube = get_report_cube()
+        if cube.defects.empty:
             return json.dumps({"status": "error", "message": "No data available"})
     
-        applied_filters = {}
-        
-        # Make a copy to avoid SettingWithCopyWarning if any
-        df = df.copy()
-        
+        conditions = {}
         for col, val in filter_conditions.items():
             # Validate input
             if not val: continue
             val_str = str(val).strip()
             if not val_str: continue
+            conditions[col] = val_str
 
-            if col in df.columns:
-                # Dynamic Filter: Case-insensitive contains
-                try:
-                    df = df[df[col].astype(str).str.contains(val_str, case=False, na=False)]
+        if all(col in CUBE_DIMS for col in conditions):
+            # Mọi điều kiện đều là chiều của cube -> chỉ cần cắt cube
+            applied_filters = conditions
+            defects = slice_cube(cube.defects, conditions)
+            tickets = slice_cube(cube.tickets, conditions)
+        else:
+            # Có cột ngoài cube (ma_vat_tu, vi_tri_loi...): lọc dữ liệu chi tiết (case-insensitive contains)
+            # rồi dựng cube cho phần đã lọc (sl_kiem lấy từ bảng phiếu của các phiếu khớp)
+            df = get_report_data()
+            applied_filters = {}
+            for col, val_str in conditions.items():
+                if col in SEARCH_COLUMNS and col in df.columns:
+                    df = search_rows(df, val_str, [col])
                     applied_filters[col] = val_str
-                except Exception as e:
-                    # Fallback if regex fails (e.g. invalid regex chars)
-                    # Try literal string match if contains fails, or ignore
-                    try:
-                        df = df[df[col].astype(str).str.lower() == val_str.lower()]
-                        applied_filters[col] = val_str
-                    except:
-                        pass
+                elif col in df.columns:
+                    df = df[contains_mask(df[col], val_str)]
+                    applied_filters[col] = val_str
+            df_tickets = get_report_tickets()
+            if not df_tickets.empty:
+                df_tickets = df_tickets[df_tickets['so_phieu'].isin(df['so_phieu'].unique())]
+            defects, tickets = build_report_cube(df, df_tickets, rollup=False)
         
-        if df.empty:
+        if defects.empty:
             return json.dumps({
                 "status": "success",
                 "filters_applied": applied_filters,
@@ -276,23 +243,14 @@ def general_data_query(filter_conditions: dict) -> str:
             }, ensure_ascii=False)
         
         # Aggregate insights
-        total_count = len(df)
-        unique_tickets = df['so_phieu'].nunique() if 'so_phieu' in df.columns else 0
+        total_count = int(defects['so_dong_loi'].sum())
+        unique_tickets = int(tickets['so_phieu'].sum()) if not tickets.empty else 0
         
         # Calculate Defect Quantities and Error Rate
-        total_defect_qty = 0
-        total_inspected_qty = 0
+        # NOTE: sl_kiem lấy từ cube theo phiếu -> mỗi phiếu chỉ tính một lần (không nhân theo số dòng lỗi)
+        total_defect_qty = defects['sl_loi'].sum()
+        total_inspected_qty = tickets['sl_kiem'].sum() if not tickets.empty else 0
         error_rate = 0.0
-        
-        # NOTE: Column names after mapping: sl_loi (so_luong_loi), sl_kiem (so_luong_kiem)
-        if 'sl_loi' in df.columns:
-            total_defect_qty = pd.to_numeric(df['sl_loi'], errors='coerce').fillna(0).sum()
-            
-        if 'sl_kiem' in df.columns:
-            # FIX: Only sum sl_kiem for unique tickets, avoiding duplicates from multiple defect rows
-            # Assuming same sl_kiem for all rows in same ticket
-            df_unique_tickets = df.drop_duplicates('so_phieu')
-            total_inspected_qty = pd.to_numeric(df_unique_tickets['sl_kiem'], errors='coerce').fillna(0).sum()
             
         if total_inspected_qty > 0:
             error_rate = (total_defect_qty / total_inspected_qty) * 100
@@ -303,27 +261,13 @@ def general_data_query(filter_conditions: dict) -> str:
         if total_inspected_qty > 0 and total_defect_qty > total_inspected_qty:
              data_warnings.append(f"CẢNH BÁO: Tổng số lỗi ({total_defect_qty}) lớn hơn tổng kiểm ({total_inspected_qty}). Tỷ lệ lỗi > 100%. Vui lòng kiểm tra lại dữ liệu nguồn.")
 
-        def get_group_stats(dataframe, group_col):
-             if group_col not in dataframe.columns: return {}
+        def get_group_stats(group_col):
+             qty_by_group = cube_totals(defects, group_col, 'sl_loi')
+             insp_by_group = cube_totals(tickets, group_col, 'sl_kiem')
              
              stats = {}
-             # Group by unique values
-             groups = dataframe[group_col].dropna().unique()
-             
-             for g in groups:
-                 sub_df = dataframe[dataframe[group_col] == g]
-                 
-                 # Qty
-                 qty = 0
-                 if 'sl_loi' in sub_df.columns:
-                     qty = pd.to_numeric(sub_df['sl_loi'], errors='coerce').fillna(0).sum()
-                 
-                 # Insp (dedup so_phieu)
-                 insp = 0
-                 if 'so_phieu' in sub_df.columns and 'sl_kiem' in sub_df.columns:
-                     sub_df_unique = sub_df.drop_duplicates('so_phieu')
-                     insp = pd.to_numeric(sub_df_unique['sl_kiem'], errors='coerce').fillna(0).sum()
-                 
+             for g, qty in qty_by_group.items():
+                 insp = insp_by_group.get(g, 0)
                  rate = (qty / insp * 100) if insp > 0 else 0.0
                  
                  # Check anomaly
@@ -336,50 +280,27 @@ def general_data_query(filter_conditions: dict) -> str:
                      "rate_pct": round(rate, 2)
                  }
             
-             # Sort by qty desc and take top 5
-             sorted_stats = dict(sorted(stats.items(), key=lambda item: item[1]['qty'], reverse=True)[:5])
-             return sorted_stats
+             # qty_by_group đã sắp giảm dần -> lấy top 5
+             return dict(list(stats.items())[:5])
 
-        # Top Defects (Keep simple for now or update? User asked for formulas)
-        # For Defects, Rate is usually vs Global Inspected, not "Inspected of Ticket containing defect"
-        # Let's keep Top Defects simple (Qty) but add Rate vs Global
+        # Top Defects: Rate so với tổng kiểm toàn bộ (không phải số kiểm của phiếu chứa lỗi)
         top_defects = {}
-        if 'ten_loi' in df.columns and 'sl_loi' in df.columns:
-            # Ensure numeric val
-            df_temp = df.copy()
-            df_temp['sl_loi_val'] = pd.to_numeric(df_temp['sl_loi'], errors='coerce').fillna(0)
-            
-            # Group sum
-            defect_sums = df_temp.groupby('ten_loi')['sl_loi_val'].sum().sort_values(ascending=False).head(5)
-            
-            for name, val in defect_sums.items():
-                rate = (val / total_inspected_qty * 100) if total_inspected_qty > 0 else 0.0
-                top_defects[name] = {
-                    "qty": int(val),
-                    "rate_global_pct": round(rate, 2)
-                }
+        for name, val in cube_totals(defects, 'ten_loi', 'sl_loi', 5).items():
+            rate = (val / total_inspected_qty * 100) if total_inspected_qty > 0 else 0.0
+            top_defects[str(name)] = {
+                "qty": int(val),
+                "rate_global_pct": round(rate, 2)
+            }
 
         # Top Sources (Detailed Rate)
-        top_sources = get_group_stats(df, 'nguon_goc')
+        top_sources = get_group_stats('nguon_goc')
 
         # Top Departments
-        target_col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        top_depts = get_group_stats(df, target_col)
+        top_depts = get_group_stats(DEPT_DIM)
         
-        # Top Contracts (Keep ticket count)
-        top_contracts = {}
-        top_contract_groups = {}
-        if 'hop_dong' in df.columns and 'so_phieu' in df.columns:
-            # Count unique tickets
-            unique_counts = df.groupby('hop_dong')['so_phieu'].nunique().sort_values(ascending=False).head(10)
-            top_contracts = unique_counts.to_dict()
-            
-            # Calculate groups (Suffix last 3 chars)
-            groups = df['hop_dong'].apply(lambda x: str(x).strip()[-3:] if len(str(x).strip()) >= 3 else "Khác")
-            # Create temp df for grouping
-            df_temp = df.copy()
-            df_temp['group'] = groups
-            top_contract_groups = df_temp.groupby('group')['so_phieu'].nunique().sort_values(ascending=False).head(5).to_dict()
+        # Top Contracts (số phiếu) + nhóm hợp đồng (3 ký tự cuối)
+        top_contracts = _int_dict(cube_totals(tickets, 'hop_dong', 'so_phieu', 10))
+        top_contract_groups = _int_dict(cube_totals(tickets, 'nhom_hd', 'so_phieu', 5))
 
         return json.dumps({
             "status": "success",
@@ -402,22 +323,19 @@ def get_top_ticket_by_defects(top_n=5, department=None, year=None, month=None):
     Tìm các PHIẾU NCR có tổng số lượng lỗi cao nhất.
     Dùng cho câu hỏi: "Phiếu nào nhiều lỗi nhất?", "Top phiếu lỗi cao nhất"
     """
-    df = get_report_data()
+    df = get_report_tickets()
     if df.empty: return "No data."
     
-    # Filter logic
+    # Filter logic (bảng phiếu: sl_loi đã là tổng theo phiếu)
     if department:
-        col = 'bo_phan_full' if 'bo_phan_full' in df.columns else 'bo_phan'
-        df = df[df[col].astype(str).str.contains(department, case=False, na=False)]
+        df = df[contains_mask(df[DEPT_DIM], department)]
     if year: df = df[df['year'] == int(year)]
     if month: df = df[df['month'] == int(month)]
     
     if df.empty: return "No data matching filters."
     
-    # Group by Ticket (so_phieu) and Sum defect quantity (sl_loi)
     if 'so_phieu' in df.columns and 'sl_loi' in df.columns:
-         df['sl_loi_val'] = pd.to_numeric(df['sl_loi'], errors='coerce').fillna(0)
-         ranking = df.groupby('so_phieu')['sl_loi_val'].sum().sort_values(ascending=False).head(int(top_n)).to_dict()
+         ranking = df.set_index('so_phieu')['sl_loi'].sort_values(ascending=False).head(int(top_n)).to_dict()
          return json.dumps(ranking, ensure_ascii=False)
          
     return json.dumps({"error": "Missing columns"}, ensure_ascii=False)
@@ -10,7 +10,9 @@ from utils.ncr_helpers import (
     load_ncr_data_with_grouping,
     update_ncr_status
 )
-from utils.sheets_error_handler import handle_sheets_errors
+from core.gsheets import get_worksheet
+from core.ncr_repository import get_ncr_repository
+from core.cache_tags import tagged_cache, invalidate, NCR_DATA
 
 # --- CONFIGURATION ---
 DRAFT_STATUS = 'draft'
@@ -28,26 +30,17 @@ def _get_current_status_from_sheet(so_phieu):
     Đọc trực tiếp trạng thái hiện tại từ Google Sheet để đảm bảo tính nhất quán (Idempotency).
     """
     try:
-        gc = init_gspread()
-        if not gc: return None
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        if len(data) < 2: return None
+        ws = get_worksheet("NCR_DATA")
+        # Đọc trực tiếp các dòng của phiếu qua index (không tải toàn sheet)
+        headers, ticket_rows = get_ncr_repository().fetch_ticket_rows(ws, so_phieu)
+        if not ticket_rows: return None
         
-        headers = [str(h).strip().lower() for h in data[0]]
-        idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
-        
-        for row in data[1:]:
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                return str(row[idx_status]).strip()
-        return None
+        return str(ticket_rows[0][1][idx_status]).strip()
     except Exception:
         return None
 
-@st.cache_data(ttl=300, show_spinner=False)
-@handle_sheets_errors
+@tagged_cache(NCR_DATA, ttl=300, show_spinner=False)
 def get_pending_approvals(user_role, user_dept, admin_selected_role=None):
     """
     Tải danh sách các phiếu NCR đang chờ phê duyệt dựa trên role và bộ phận.
@@ -112,7 +105,8 @@ def approve_ncr(so_phieu, role, user_name, next_status, solutions=None, assignee
         assignee=assignee
     )
     if success:
-        st.cache_data.clear()  # Clear cache to refresh data after approval
+        # Snapshot đã được vá qua write queue -> chỉ xóa cache phụ thuộc NCR_DATA
+        invalidate(NCR_DATA, resync=False)
     return success, msg
 
 def reject_ncr(so_phieu, role, user_name, current_status_ui, reason):
@@ -148,5 +142,5 @@ def reject_ncr(so_phieu, role, user_name, current_status_ui, reason):
         reject_reason=reason
     )
     if success:
-        st.cache_data.clear()  # Clear cache to refresh data after rejection
+        invalidate(NCR_DATA, resync=False)
     return success, msg
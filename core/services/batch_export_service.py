@@ -0,0 +1,198 @@
+import io
+import os
+import re
+import json
+import hashlib
+import zipfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+# Số process render song song (docxtpl + docx2pdf nặng CPU/IO, không an toàn khi chạy đa luồng)
+BATCH_MAX_WORKERS = min(4, max(2, os.cpu_count() or 2))
+# Tổng dung lượng chứng từ đã render giữ trong bộ nhớ (LRU theo byte, mỗi process server)
+DOC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DOC_TYPES = ['BBK', 'NCR']
+
+_doc_lock = threading.Lock()
+_doc_cache = OrderedDict()  # fingerprint -> (file_name, bytes)
+_doc_cache_bytes = 0
+
+
+def _safe_name(text):
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(text)).strip('_') or 'phieu'
+
+
+def _records(df):
+    # Bỏ category / Timestamp -> kiểu thuần (pickle gọn, hash ổn định)
+    return json.loads(df.astype(object).to_json(orient='records', date_format='iso', force_ascii=False))
+
+
+def document_fingerprint(doc_type, template_path, ticket_info, error_records):
+    """Hash nội dung của một chứng từ (template + dữ liệu phiếu + các dòng lỗi)."""
+    try:
+        template_mtime = os.path.getmtime(template_path)
+    except OSError:
+        template_mtime = None
+    payload = [doc_type, template_mtime, ticket_info, error_records]
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_cached_document(fingerprint):
+    with _doc_lock:
+        if fingerprint not in _doc_cache:
+            return None
+        _doc_cache.move_to_end(fingerprint)
+        return _doc_cache[fingerprint]
+
+
+def _store_document(fingerprint, document):
+    """Giữ chứng từ trong LRU; vượt DOC_CACHE_MAX_BYTES -> bỏ bản ít dùng nhất (file quá lớn không giữ)."""
+    global _doc_cache_bytes
+    size = len(document[1])
+    if size > DOC_CACHE_MAX_BYTES:
+        return
+    with _doc_lock:
+        old = _doc_cache.pop(fingerprint, None)
+        if old is not None:
+            _doc_cache_bytes -= len(old[1])
+        _doc_cache[fingerprint] = document
+        _doc_cache_bytes += size
+        while _doc_cache_bytes > DOC_CACHE_MAX_BYTES:
+            _, evicted = _doc_cache.popitem(last=False)
+            _doc_cache_bytes -= len(evicted[1])
+
+
+def render_document(job):
+    """
+    Render một chứng từ (chạy trong process con). job = (so_phieu, doc_type, template_path, ticket_info, error_records).
+    Trả về (file_name, bytes) - PDF nếu convert được, ngược lại DOCX.
+    """
+    from utils.export_helper import generate_ncr_pdf, enrich_export_context
+    so_phieu, doc_type, template_path, ticket_info, error_records = job
+    ticket_info = enrich_export_context(dict(ticket_info))
+    pdf_path, docx_path = generate_ncr_pdf(
+        template_path, ticket_info, pd.DataFrame(error_records), f"{doc_type}_{_safe_name(so_phieu)}"
+    )
+    try:
+        path = pdf_path if pdf_path and os.path.exists(pdf_path) else docx_path
+        with open(path, 'rb') as f:
+            data = f.read()
+        return f"{doc_type}_{_safe_name(so_phieu)}{os.path.splitext(path)[1]}", data
+    finally:
+        # File tạm chỉ dùng để đọc bytes
+        for tmp in (pdf_path, docx_path):
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+
+def _run_sequential(jobs, on_done):
+    for fingerprint, job in jobs:
+        try:
+            on_done(fingerprint, job, render_document(job), None)
+        except Exception as e:
+            on_done(fingerprint, job, None, e)
+
+
+def _run_parallel(jobs, on_done, max_workers):
+    """
+    Render trong process pool. Pool hỏng giữa chừng (BrokenProcessPool: process con bị kill / crash)
+    -> job bị ảnh hưởng không tính là xong, để export_tickets_zip render lại tuần tự.
+    """
+    # spawn: process con sạch (không kế thừa thread của Streamlit / write queue), giống Windows
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+        futures = {pool.submit(render_document, job): (fingerprint, job) for fingerprint, job in jobs}
+        for future in as_completed(futures):
+            fingerprint, job = futures[future]
+            try:
+                document = future.result()
+            except BrokenProcessPool as e:
+                print(f"Batch export pool broken ({job[0]} {job[1]}): {e}")
+                continue
+            except Exception as e:
+                on_done(fingerprint, job, None, e)
+                continue
+            on_done(fingerprint, job, document, None)
+
+
+def export_tickets_zip(df_rows, doc_types=DOC_TYPES, progress=None, max_workers=BATCH_MAX_WORKERS):
+    """
+    Xuất hàng loạt BBK/NCR của các phiếu trong df_rows (các dòng lỗi, đã lọc) vào một file ZIP.
+    - Chứng từ đã render với cùng nội dung lấy từ cache -> xuất lại gần như tức thì.
+    - Phần còn lại render song song trong process pool, ghi vào ZIP ngay khi xong từng file.
+    progress(done, total, label): callback báo tiến độ (vd cập nhật st.progress).
+
+    Returns:
+        (bytes ZIP, [lỗi "so_phieu (loại): message"])
+    """
+    from utils.export_helper import get_template_path
+
+    if df_rows is None or df_rows.empty or 'so_phieu' not in df_rows.columns:
+        return None, ["Không có phiếu để xuất"]
+
+    jobs = []
+    for so_phieu, rows in df_rows.groupby('so_phieu', sort=False, observed=True):
+        records = _records(rows)
+        for doc_type in doc_types:
+            template_path = get_template_path(doc_type)
+            fingerprint = document_fingerprint(doc_type, template_path, records[0], records)
+            jobs.append((fingerprint, (str(so_phieu), doc_type, template_path, records[0], records)))
+
+    total = len(jobs)
+    finished = set()  # fingerprint đã xong (thành công hoặc lỗi render thật)
+    errors = {}       # fingerprint -> "so_phieu (loại): message"
+    buffer = io.BytesIO()
+    names = set()
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        def on_done(fingerprint, job, document, error):
+            so_phieu, doc_type = job[0], job[1]
+            if fingerprint in finished:
+                return
+            if error is not None:
+                errors[fingerprint] = f"{so_phieu} ({doc_type}): {error}"
+            else:
+                errors.pop(fingerprint, None)
+                _store_document(fingerprint, document)
+                file_name, data = document
+                if file_name in names:  # Trùng tên sau khi chuẩn hóa
+                    file_name = f"{len(names)}_{file_name}"
+                names.add(file_name)
+                zf.writestr(f"{doc_type}/{file_name}", data)
+            finished.add(fingerprint)
+            if progress:
+                progress(len(finished), total, f"{doc_type} {so_phieu}")
+
+        pending = []
+        for fingerprint, job in jobs:
+            cached = get_cached_document(fingerprint)
+            if cached is not None:
+                on_done(fingerprint, job, cached, None)
+            else:
+                pending.append((fingerprint, job))
+
+        if len(pending) > 1 and max_workers > 1:
+            try:
+                _run_parallel(pending, on_done, min(max_workers, len(pending)))
+            except Exception as e:
+                # Không tạo được / mất process pool (môi trường hạn chế) -> phần còn thiếu render tuần tự
+                print(f"Batch export pool error: {e}")
+
+        # Chỉ render lại job chưa xong (pool hỏng / không chạy được pool), bỏ lỗi cũ của chúng
+        remaining = [p for p in pending if p[0] not in finished]
+        for fingerprint, _ in remaining:
+            errors.pop(fingerprint, None)
+        _run_sequential(remaining, on_done)
+
+        if errors:
+            zf.writestr("_loi_xuat_file.txt", "\n".join(errors.values()))
+
+    return buffer.getvalue(), list(errors.values())
@@ -1,73 +1,169 @@
 
 
+import threading
+
 import streamlit as st
 import pandas as pd
 from datetime import datetime
 import uuid
 import gspread
-from core.gsheets import open_worksheet, smart_append_batch
-from utils.sheets_error_handler import handle_sheets_errors
+from core.gsheets import open_worksheet, smart_append_batch, align_rows
+from core.local_mirror import read_sheet_frame, append_snapshot_rows
+from core.write_queue import get_write_queue
+from core.cache_tags import tagged_resource, invalidate
 
 # Tên sheet trong Google Sheets
 SHEET_MASTER = "DNXL"
 SHEET_DETAIL = "DNXL_DETAILS"
 
-@st.cache_data(ttl=300, show_spinner=False)
-@handle_sheets_errors
+
+def _positions(series):
+    """Giá trị (chuỗi, đã strip) -> [vị trí dòng trong frame]."""
+    result = {}
+    for pos, value in enumerate(series.astype(str).str.strip()):
+        result.setdefault(value, []).append(pos)
+    return result
+
+
+class DnxlStore:
+    """
+    Bảng DNXL + DNXL_DETAILS có index, dựng từ MỘT lần đọc mỗi sheet (dùng chung toàn process).
+    - dnxl_id -> dòng trên sheet (i + 2), ncr_id -> [phiếu DNXL], dnxl_id -> [dòng chi tiết]
+    - Header lấy từ frame -> claim/update/duyệt chỉ còn một lần ghi đúng ô, không find/row_values/cell.
+    - Ghi qua write queue -> vá lạc quan tại chỗ (apply_cell_updates), không tải lại sheet.
+    """
+
+    def __init__(self, master, detail):
+        self._lock = threading.Lock()
+        self._frames = {SHEET_MASTER: master.reset_index(drop=True), SHEET_DETAIL: detail.reset_index(drop=True)}
+        self.master_header = list(master.columns)
+        self.detail_header = list(detail.columns)
+
+        self._master_pos = {}
+        self._ncr_pos = {}
+        if 'dnxl_id' in master.columns:
+            for value, positions in _positions(master['dnxl_id']).items():
+                self._master_pos[value] = positions[0]
+        if 'ncr_id' in master.columns:
+            self._ncr_pos = _positions(master['ncr_id'])
+        self._detail_pos = _positions(detail['dnxl_id']) if 'dnxl_id' in detail.columns else {}
+
+    # --- Tra cứu ---
+    def master_row(self, dnxl_id):
+        """Dòng trên sheet DNXL của phiếu (None nếu không có)."""
+        pos = self._master_pos.get(str(dnxl_id).strip())
+        return None if pos is None else pos + 2
+
+    def master_value(self, dnxl_id, col):
+        """Giá trị hiện tại một cột của phiếu (None nếu không có phiếu / cột)."""
+        pos = self._master_pos.get(str(dnxl_id).strip())
+        if pos is None or col not in self.master_header:
+            return None
+        with self._lock:
+            return self._frames[SHEET_MASTER].iat[pos, self.master_header.index(col)]
+
+    def masters(self):
+        with self._lock:
+            return self._frames[SHEET_MASTER].copy()
+
+    def masters_for_ncr(self, ncr_id):
+        positions = self._ncr_pos.get(str(ncr_id).strip(), [])
+        with self._lock:
+            return self._frames[SHEET_MASTER].iloc[positions].copy()
+
+    def details_for(self, dnxl_id):
+        positions = self._detail_pos.get(str(dnxl_id).strip(), [])
+        with self._lock:
+            return self._frames[SHEET_DETAIL].iloc[positions].copy()
+
+    def details_map(self):
+        """{dnxl_id: DataFrame chi tiết} (cột dnxl_id dạng chuỗi như groupby cũ)."""
+        with self._lock:
+            df = self._frames[SHEET_DETAIL]
+            if df.empty or 'dnxl_id' not in df.columns:
+                return {}
+            df = df.copy()
+        df['dnxl_id'] = df['dnxl_id'].astype(str)
+        return {d_id: group for d_id, group in df.groupby('dnxl_id')}
+
+    def detail_rows(self, dnxl_id):
+        """{detail_id: dòng trên sheet DNXL_DETAILS} của một phiếu."""
+        positions = self._detail_pos.get(str(dnxl_id).strip(), [])
+        with self._lock:
+            df = self._frames[SHEET_DETAIL]
+            if 'detail_id' not in df.columns:
+                return {}
+            return {str(df['detail_id'].iat[pos]): pos + 2 for pos in positions}
+
+    # --- Cập nhật lạc quan ---
+    def apply_cell_updates(self, sheet_name, updates):
+        """Vá các ô ('B5' -> giá trị) vừa đưa vào write queue vào frame tương ứng."""
+        with self._lock:
+            df = self._frames[sheet_name]
+            for upd in updates:
+                if ':' in upd['range']:
+                    continue
+                row, col = gspread.utils.a1_to_rowcol(upd['range'])
+                if not (0 <= row - 2 < len(df)) or col > len(df.columns):
+                    continue
+                name = df.columns[col - 1]
+                if df[name].dtype != object:
+                    df[name] = df[name].astype(object)
+                df.iat[row - 2, col - 1] = upd['values'][0][0]
+
+
+@tagged_resource(SHEET_MASTER, SHEET_DETAIL, ttl=300, show_spinner=False)
+def _load_dnxl_store():
+    """Store DNXL dùng chung (Cached resource); mirror làm mới nền xong -> dựng lại. Lỗi -> raise (không cache)."""
+    master = read_sheet_frame(SHEET_MASTER, on_refresh=_load_dnxl_store.clear)
+    detail = read_sheet_frame(SHEET_DETAIL, on_refresh=_load_dnxl_store.clear)
+    return DnxlStore(master, detail)
+
+
+def get_dnxl_store():
+    """
+    Store DNXL. 429 đã được GovernedHTTPClient thử lại (không ngủ thêm ở đây);
+    lỗi -> raise, không được giữ trong cache_resource -> lần gọi sau thử tải lại.
+    """
+    return _load_dnxl_store()
+
+
+def _locate(dnxl_id):
+    """(store, dòng trên sheet) của phiếu; không thấy -> dựng lại store một lần (phiếu vừa tạo ở process khác)."""
+    store = get_dnxl_store()
+    row = store.master_row(dnxl_id)
+    if row is None:
+        _load_dnxl_store.clear()
+        store = get_dnxl_store()
+        row = store.master_row(dnxl_id)
+    return store, row
+
+
+def _enqueue(store, sheet_name, updates):
+    """Ghi qua write queue + vá store (không cần tải lại sheet)."""
+    get_write_queue().enqueue(sheet_name, updates)
+    store.apply_cell_updates(sheet_name, updates)
+
+
 def get_dnxl_by_ncr(ncr_id):
     """
     Lấy danh sách DNXL Master thuộc về một NCR cụ thể.
     (Chưa lấy details để tối ưu hiệu năng hiển thị danh sách)
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        
-        if not ws: return pd.DataFrame()
-
-        data = ws.get_all_records()
-        if not data: return pd.DataFrame()
-            
-        df = pd.DataFrame(data)
-        
-        if 'ncr_id' in df.columns:
-            ncr_id_str = str(ncr_id).strip()
-            df['ncr_id_str'] = df['ncr_id'].astype(str).str.strip()
-            return df[df['ncr_id_str'] == ncr_id_str].drop(columns=['ncr_id_str'])
-            
-        return pd.DataFrame()
+        return get_dnxl_store().masters_for_ncr(ncr_id)
     except Exception as e:
         # Error already handled by decorator
         return pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner=False)
-@handle_sheets_errors
 def get_dnxl_details(dnxl_id):
     """Lấy chi tiết các lỗi của một phiếu DNXL"""
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_DETAIL)
-        
-        if not ws: return pd.DataFrame()
-
-        data = ws.get_all_records()
-        if not data: return pd.DataFrame()
-            
-        df = pd.DataFrame(data)
-        
-        if 'dnxl_id' in df.columns:
-            # Convert both to string to be safe
-            dnxl_id_str = str(dnxl_id).strip()
-            df['dnxl_id_str'] = df['dnxl_id'].astype(str).str.strip()
-            return df[df['dnxl_id_str'] == dnxl_id_str].drop(columns=['dnxl_id_str'])
-            
-        return pd.DataFrame()
+        return get_dnxl_store().details_for(dnxl_id)
     except Exception as e:
         # st.error(f"Lỗi tải chi tiết: {e}") # Silent error to avoid spam
         return pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner=False)
-@handle_sheets_errors
 def get_all_dnxl_details_map():
     """
     Lấy toàn bộ details và gom nhóm theo dnxl_id.
@@ -75,28 +171,23 @@ def get_all_dnxl_details_map():
     Giúp tối ưu hiển thị danh sách, tránh gọi API N lần.
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_DETAIL)
-        if not ws: return {}
-        
-        data = ws.get_all_records()
-        if not data: return {}
-        
-        df = pd.DataFrame(data)
-        if df.empty or 'dnxl_id' not in df.columns: return {}
-        
-        # Group by dnxl_id
-        result = {}
-        # Ensure dnxl_id is string
-        df['dnxl_id'] = df['dnxl_id'].astype(str)
-        
-        for d_id, group in df.groupby('dnxl_id'):
-            result[d_id] = group
-            
-        return result
+        return get_dnxl_store().details_map()
     except Exception:
         return {}
 
+def _append(ws, sheet_name, header, rows):
+    """
+    Append theo header đã biết của store (không gọi row_values(1)); store chưa có header -> smart_append_batch.
+    Snapshot nền (nếu có) được thêm dòng ngay -> store dựng lại sau invalidate thấy dòng mới.
+    """
+    if not rows:
+        return
+    if header:
+        ws.append_rows(align_rows(header, rows), value_input_option="USER_ENTERED")
+    else:
+        smart_append_batch(ws, rows)
+    append_snapshot_rows(sheet_name, rows)
+
 def create_dnxl(ncr_data, form_header, details_df, user_name):
     """
     Tạo phiếu DNXL mới (Master) và DNXL Details.
@@ -150,10 +241,11 @@ def create_dnxl(ncr_data, form_header, details_df, user_name):
             })
             
         # 3. Write to Sheets (Batch)
-        smart_append_batch(ws_master, [row_master])
-        smart_append_batch(ws_detail, rows_detail)
+        store = get_dnxl_store()
+        _append(ws_master, SHEET_MASTER, store.master_header, [row_master])
+        _append(ws_detail, SHEET_DETAIL, store.detail_header, rows_detail)
         
-        st.cache_data.clear() # Clear cache to refresh data immediately
+        invalidate(SHEET_MASTER, SHEET_DETAIL) # Chỉ xóa cache DNXL, giữ CONFIG/USERS/NCR
         return True, f"Đã tạo phiếu {dnxl_id} thành công!"
         
     except Exception as e:
@@ -170,14 +262,8 @@ def get_pending_dnxl(role, user_name):
         user_name: Tên user hiện tại
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        if not ws: return pd.DataFrame()
-
-        data = ws.get_all_records()
-        if not data: return pd.DataFrame()
-        
-        df = pd.DataFrame(data)
+        df = get_dnxl_store().masters()
+        if df.empty: return pd.DataFrame()
         
         # Ensure required columns exist
         for col in ['status', 'claimed_by', 'created_by']:
@@ -211,18 +297,13 @@ def claim_dnxl(dnxl_id, user_name):
     Status: moi_tao -> dang_xu_ly
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        
-        # Find row
-        cell = ws.find(dnxl_id)
-        if not cell:
+        # Find row (index của store, không ws.find)
+        store, row_idx = _locate(dnxl_id)
+        if row_idx is None:
             return False, "Không tìm thấy phiếu"
-            
-        row_idx = cell.row
         
         # Get Header mapping
-        headers = ws.row_values(1)
+        headers = store.master_header
         try:
             col_status = headers.index('status') + 1
             col_claimed_by = headers.index('claimed_by') + 1
@@ -230,8 +311,19 @@ def claim_dnxl(dnxl_id, user_name):
         except ValueError:
             return False, "Sheet thiếu cột metadata (status/claimed_by)"
             
-        # Check current status (Optional safety)
-        current_status = ws.cell(row_idx, col_status).value
+        # Check current status - giá trị đang chờ ghi trong write queue của process này,
+        # không có thì đọc ô status trên Sheet (store có thể cũ / process khác vừa nhận)
+        status_a1 = gspread.utils.rowcol_to_a1(row_idx, col_status)
+        queue = get_write_queue()
+        current_status = queue.pending_value(SHEET_MASTER, status_a1)
+        if current_status is None:
+            spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
+            ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
+            if not ws:
+                return False, "Không thể kết nối đến Google Sheets"
+            current_status = ws.acell(status_a1).value
+            if current_status != store.master_value(dnxl_id, 'status'):
+                store.apply_cell_updates(SHEET_MASTER, [{'range': status_a1, 'values': [[current_status]]}])
         if current_status != 'moi_tao':
             return False, f"Phiếu này không còn ở trạng thái Mới (Status: {current_status})"
             
@@ -241,8 +333,7 @@ def claim_dnxl(dnxl_id, user_name):
             {'range': gspread.utils.rowcol_to_a1(row_idx, col_claimed_by), 'values': [[user_name]]},
             {'range': gspread.utils.rowcol_to_a1(row_idx, col_claimed_at), 'values': [[datetime.now().strftime("%Y-%m-%d %H:%M:%S")]]}
         ]
-        ws.batch_update(updates)
-        st.cache_data.clear()
+        _enqueue(store, SHEET_MASTER, updates)
         return True, "Đã nhận việc thành công!"
         
     except Exception as e:
@@ -259,30 +350,24 @@ def update_dnxl_progress(dnxl_id, details_list, worker_response, worker_images):
         worker_images: Url string (newline separated)
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws_master = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        ws_detail = open_worksheet(spreadsheet_id, SHEET_DETAIL)
-        
         # --- 1. UPDATE MASTER ---
-        cell_m = ws_master.find(dnxl_id)
-        if not cell_m: return False, "Không tìm thấy Master DNXL"
+        store, row_m = _locate(dnxl_id)
+        if row_m is None: return False, "Không tìm thấy Master DNXL"
         
-        headers_m = ws_master.row_values(1)
+        headers_m = store.master_header
         col_status = headers_m.index('status') + 1
         col_response = headers_m.index('worker_response') + 1
         col_images = headers_m.index('worker_images') + 1
         
         updates_m = [
-            {'range': gspread.utils.rowcol_to_a1(cell_m.row, col_status), 'values': [['cho_duyet_ket_qua']]},
-            {'range': gspread.utils.rowcol_to_a1(cell_m.row, col_response), 'values': [[worker_response]]},
-            {'range': gspread.utils.rowcol_to_a1(cell_m.row, col_images), 'values': [[worker_images]]},
+            {'range': gspread.utils.rowcol_to_a1(row_m, col_status), 'values': [['cho_duyet_ket_qua']]},
+            {'range': gspread.utils.rowcol_to_a1(row_m, col_response), 'values': [[worker_response]]},
+            {'range': gspread.utils.rowcol_to_a1(row_m, col_images), 'values': [[worker_images]]},
         ]
-        ws_master.batch_update(updates_m)
+        _enqueue(store, SHEET_MASTER, updates_m)
         
         # --- 2. UPDATE DETAILS ---
-        # Get all details to find rows
-        all_details = ws_detail.get_all_records()
-        headers_d = ws_detail.row_values(1)
+        headers_d = store.detail_header
         
         col_qty_fixed = headers_d.index('qty_fixed') + 1
         col_worker_note = headers_d.index('worker_note') + 1
@@ -293,11 +378,7 @@ def update_dnxl_progress(dnxl_id, details_list, worker_response, worker_images):
         new_rows = []
         
         # Map existing rows for fast lookup: detail_id -> row_idx
-        detail_map = {}
-        for i, d in enumerate(all_details):
-             # Row in sheet = i + 2 (Header starts 1, data starts 2)
-             if str(d.get('dnxl_id')) == str(dnxl_id):
-                 detail_map[str(d.get('detail_id'))] = i + 2
+        detail_map = store.detail_rows(dnxl_id)
                  
         for item in details_list:
             d_id = str(item.get('detail_id', ''))
@@ -325,12 +406,14 @@ def update_dnxl_progress(dnxl_id, details_list, worker_response, worker_images):
                 new_rows.append(new_row)
 
         if updates_d:
-            ws_detail.batch_update(updates_d)
+            _enqueue(store, SHEET_DETAIL, updates_d)
             
         if new_rows:
-            smart_append_batch(ws_detail, new_rows)
+            spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
+            ws_detail = open_worksheet(spreadsheet_id, SHEET_DETAIL)
+            _append(ws_detail, SHEET_DETAIL, headers_d, new_rows)
+            invalidate(SHEET_DETAIL) # Có dòng mới -> dựng lại store
             
-        st.cache_data.clear()
         return True, "Đã gửi kết quả xử lý thành công"
         
     except Exception as e:
@@ -343,31 +426,28 @@ def qc_review_dnxl(dnxl_id, decision, note):
               'reject' -> tra_lai
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        cell = ws.find(dnxl_id)
-        if not cell: return False, "Phiếu không tồn tại"
+        store, row = _locate(dnxl_id)
+        if row is None: return False, "Phiếu không tồn tại"
         
-        headers = ws.row_values(1)
+        headers = store.master_header
         col_status = headers.index('status') + 1
         
         updates = []
         
         if decision == 'approve':
-            updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_status), 'values': [['hoan_thanh']]})
+            updates.append({'range': gspread.utils.rowcol_to_a1(row, col_status), 'values': [['hoan_thanh']]})
             # Ghi nhận kết quả vào result_summary
             col_res = headers.index('result_summary') + 1 if 'result_summary' in headers else -1
             if col_res != -1:
-                 updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_res), 'values': [[note]]})
+                 updates.append({'range': gspread.utils.rowcol_to_a1(row, col_res), 'values': [[note]]})
                  
         elif decision == 'reject':
-            updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_status), 'values': [['tra_lai']]})
+            updates.append({'range': gspread.utils.rowcol_to_a1(row, col_status), 'values': [['tra_lai']]})
             col_note = headers.index('qc_review_note') + 1 if 'qc_review_note' in headers else -1
             if col_note != -1:
-                 updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_note), 'values': [[note]]})
+                 updates.append({'range': gspread.utils.rowcol_to_a1(row, col_note), 'values': [[note]]})
                  
-        ws.batch_update(updates)
-        st.cache_data.clear()
+        _enqueue(store, SHEET_MASTER, updates)
         return True, f"Đã {decision} phiếu {dnxl_id}"
         
     except Exception as e:
@@ -379,23 +459,20 @@ def force_complete_dnxl(dnxl_id, user_name, note="Hoàn tất thủ công (Offli
     Status: * -> hoan_thanh
     """
     try:
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        ws = open_worksheet(spreadsheet_id, SHEET_MASTER)
-        cell = ws.find(dnxl_id)
-        if not cell: return False, "Phiếu không tồn tại"
+        store, row = _locate(dnxl_id)
+        if row is None: return False, "Phiếu không tồn tại"
         
-        headers = ws.row_values(1)
+        headers = store.master_header
         col_status = headers.index('status') + 1
         col_res = headers.index('result_summary') + 1 if 'result_summary' in headers else -1
         
         updates = []
-        updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_status), 'values': [['hoan_thanh']]})
+        updates.append({'range': gspread.utils.rowcol_to_a1(row, col_status), 'values': [['hoan_thanh']]})
         
         if col_res != -1:
-             updates.append({'range': gspread.utils.rowcol_to_a1(cell.row, col_res), 'values': [[note]]})
+             updates.append({'range': gspread.utils.rowcol_to_a1(row, col_res), 'values': [[note]]})
              
-        ws.batch_update(updates)
-        st.cache_data.clear()
+        _enqueue(store, SHEET_MASTER, updates)
         return True, f"Đã hoàn tất phiếu {dnxl_id}"
         
     except Exception as e:
@@ -1,10 +1,238 @@
 import io
+import re
+import json
+import hashlib
+import threading
+from copy import copy
+from collections import OrderedDict
 import pandas as pd
 import openpyxl
 from openpyxl.styles import Border, Side, Alignment
+from openpyxl.cell.cell import MergedCell
 import streamlit as st
 import os
 
+# Các trường NCR mà file DNXL sử dụng (fingerprint chỉ dựa trên các trường này)
+DNXL_NCR_FIELDS = ['hop_dong', 'ten_sp', 'ma_vat_tu', 'so_phieu_ncr', 'so_phieu', 'ngay_lap', 'nguon_goc', 'vi_tri_loi']
+# Số workbook DNXL giữ trong bộ nhớ (LRU, dùng chung toàn process)
+EXCEL_CACHE_SIZE = 64
+
+_excel_lock = threading.Lock()
+_excel_cache = OrderedDict()  # fingerprint -> bytes
+
+
+def dnxl_export_fingerprint(ncr_data, dnxl_data, details_df):
+    """
+    Hash nội dung dùng để dựng file DNXL (trường NCR liên quan + DNXL master + chi tiết).
+    DNXL hoặc chi tiết thay đổi -> fingerprint mới -> file được dựng lại.
+    """
+    payload = [
+        {k: ncr_data.get(k, '') for k in DNXL_NCR_FIELDS},
+        dict(dnxl_data),
+        details_df.to_dict('records') if details_df is not None and not details_df.empty else [],
+    ]
+    raw = json.dumps(payload, default=str, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def get_cached_dnxl_excel(fingerprint):
+    """Workbook đã dựng (bytes) theo fingerprint, None nếu chưa có."""
+    with _excel_lock:
+        data = _excel_cache.get(fingerprint)
+        if data is not None:
+            _excel_cache.move_to_end(fingerprint)
+        return data
+
+
+def get_dnxl_excel(ncr_data, dnxl_data, details_df):
+    """
+    Bytes file DNXL: lấy từ cache theo fingerprint, chưa có thì dựng (generate_dnxl_docx) rồi lưu.
+    Dùng khi người dùng bấm tải - trang không dựng sẵn file cho mọi DNXL.
+    """
+    fingerprint = dnxl_export_fingerprint(ncr_data, dnxl_data, details_df)
+    data = get_cached_dnxl_excel(fingerprint)
+    if data is not None:
+        return data
+
+    buffer = generate_dnxl_docx(ncr_data, dnxl_data, details_df)
+    if buffer is None:
+        return None
+    data = buffer.getvalue()
+    with _excel_lock:
+        _excel_cache[fingerprint] = data
+        while len(_excel_cache) > EXCEL_CACHE_SIZE:
+            _excel_cache.popitem(last=False)
+    return data
+
+# Placeholder {{ key }} được điền trong template DNXL
+DNXL_PLACEHOLDER_KEYS = [
+    'hop_dong', 'ten_sp', 'ma_vat_tu', 'ncr_id', 'ngay_ncr', 'nguoi_lap', 'noi_sx', 'noi_gay_loi',
+    'sl_yeu_cau', 'ngay_dua_huong_xl', 'thoi_gian_xl', 'tong_sl_dat', 'dnxl_id', 'target_scope',
+    'handling_instruction',
+]
+_PLACEHOLDER_RE = re.compile(r"(\{\{\s*(?:" + "|".join(map(re.escape, DNXL_PLACEHOLDER_KEYS)) + r")\s*\}\})")
+
+
+class DnxlTemplate:
+    """
+    Template DNXL đã biên dịch (dùng chung toàn process):
+    - workbook mẫu nạp 1 lần, thiết lập in áp dụng sẵn;
+    - danh sách ô chứa placeholder + bố cục token (literal / key);
+    - dòng bắt đầu bảng chi tiết và các ô cần dọn.
+    render(): ghi trực tiếp vào các ô, save ra bytes rồi khôi phục ô về trạng thái mẫu.
+    """
+
+    def __init__(self, template_path):
+        with open(template_path, 'rb') as f:
+            self.template_bytes = f.read()
+        self.wb = openpyxl.load_workbook(io.BytesIO(self.template_bytes))
+        self.ws = self.wb.active
+        self._lock = threading.Lock()
+        self._pin_images()
+        self._apply_page_setup()
+
+        # Ô placeholder: (row, col, [literal | ('key',)])
+        self.placeholders = []
+        for row in self.ws.iter_rows(min_row=1, max_row=50, min_col=1, max_col=20):
+            for cell in row:
+                if isinstance(cell, MergedCell) or not isinstance(cell.value, str):
+                    continue
+                parts = _PLACEHOLDER_RE.split(cell.value)
+                if len(parts) == 1:
+                    continue
+                layout = [
+                    (part.strip('{} \t\n'),) if i % 2 else part
+                    for i, part in enumerate(parts) if part or i % 2
+                ]
+                self.placeholders.append((cell.row, cell.column, layout))
+
+        self.start_row = self._find_start_row()
+        # Ô trong vùng bảng (12 dòng x 9 cột) có thể cần dọn (không phải ô merge)
+        merged = {
+            (r, c)
+            for rng in self.ws.merged_cells.ranges
+            for r in range(rng.min_row, rng.max_row + 1)
+            for c in range(rng.min_col, rng.max_col + 1)
+            if (r, c) != (rng.min_row, rng.min_col)
+        }
+        self.clear_cells = [
+            (r, c) for r in range(self.start_row, self.start_row + 12) for c in range(1, 10)
+            if (r, c) not in merged
+        ]
+
+    def _pin_images(self):
+        # openpyxl đọc ảnh từ stream rồi đóng -> giữ bytes để save được nhiều lần
+        for ws in self.wb.worksheets:
+            for img in ws._images:
+                data = img._data()
+                img._data = (lambda data=data: data)
+
+    def _apply_page_setup(self):
+        try:
+            # User request: Center on page, fix margins
+            self.ws.page_setup.horizontalCentered = True
+            self.ws.page_setup.verticalCentered = False # Top align is standard for forms
+            
+            # Margins (Inches) - Narrow margins to maximize space
+            if self.ws.page_margins:
+                self.ws.page_margins.left = 0.25
+                self.ws.page_margins.right = 0.25
+                self.ws.page_margins.top = 0.5
+                self.ws.page_margins.bottom = 0.5
+            
+            # Fit to 1 page wide
+            self.ws.page_setup.fitToPage = True
+            self.ws.page_setup.fitToWidth = 1
+            self.ws.page_setup.fitToHeight = False # Allow multiple pages if many defects
+        except Exception:
+            # Non-critical: If print setup fails, just ignore and save file
+            pass
+
+    def _find_start_row(self):
+        # Strategy: Find explicit template loop row {{ i.ten_loi }}
+        for row in self.ws.iter_rows(min_row=1, max_row=30):
+            for cell in row:
+                if isinstance(cell.value, str) and "ten_loi" in cell.value and "{{" in cell.value:
+                    return cell.row
+        # Fallback if tag not found: Find 'Stt' (header merged, data starts 2 rows below)
+        for row in self.ws.iter_rows(min_row=1, max_row=30):
+            for cell in row:
+                if isinstance(cell.value, str) and "STT" == cell.value.strip().upper():
+                    return cell.row + 2
+        return 15 # Fallback adjusted
+
+    def render(self, data_map, details_df):
+        """Bytes file XLSX đã điền dữ liệu (template giữ nguyên sau khi gọi)."""
+        ws = self.ws
+        with self._lock:
+            saved = {}  # (row, col) -> (value, style, ô có sẵn trong template)
+
+            def cell_at(r, c):
+                existed = (r, c) in ws._cells
+                cell = ws.cell(row=r, column=c)
+                if (r, c) not in saved:
+                    saved[(r, c)] = (cell.value, copy(cell._style), existed)
+                return cell
+
+            try:
+                # 1. Placeholder: ghi thẳng theo bố cục token đã biên dịch
+                for r, c, layout in self.placeholders:
+                    cell_at(r, c).value = "".join(
+                        str(data_map.get(part[0], '')) if isinstance(part, tuple) else part
+                        for part in layout
+                    )
+
+                # 2. Smart Clear: chỉ dọn ô còn tag "{{" hoặc rỗng (tránh xóa footer)
+                for r, c in self.clear_cells:
+                    cell = cell_at(r, c)
+                    val = str(cell.value) if cell.value else ""
+                    if "{{" in val or val.strip() == "":
+                        cell.value = None
+
+                # 3. Bảng chi tiết
+                if not details_df.empty:
+                    thin = Side(border_style="thin", color="000000")
+                    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+                    align_center = Alignment(horizontal='center', vertical='center')
+                    align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+
+                    def safe_set(r, c, val, align):
+                        cell = cell_at(r, c)
+                        if isinstance(cell, MergedCell): return # Skip if merged
+                        cell.value = val
+                        cell.border = border
+                        cell.alignment = align
+
+                    c_idx = self.start_row
+                    for idx_enum, (_, row) in enumerate(details_df.iterrows()):
+                        # 1. STT (Col 1)
+                        safe_set(c_idx, 1, idx_enum + 1, align_center)
+                        # 2. Ten Loi (Col 2)
+                        safe_set(c_idx, 2, row.get('defect_name', ''), align_left)
+                        # Cols 3-6 để trống (nhập tay); SL Hỏng (Col 7) để trống
+                        safe_set(c_idx, 7, "", align_center)
+                        c_idx += 1
+
+                output = io.BytesIO()
+                self.wb.save(output)
+                return output.getvalue()
+            finally:
+                # Khôi phục template cho lần render sau
+                for (r, c), (value, style, existed) in saved.items():
+                    if existed:
+                        cell = ws._cells[(r, c)]
+                        cell.value = value
+                        cell._style = style
+                    else:
+                        ws._cells.pop((r, c), None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_dnxl_template(template_path, mtime):
+    """Template DNXL đã biên dịch (cache theo đường dẫn + thời điểm sửa file)."""
+    return DnxlTemplate(template_path)
+
+
 def generate_dnxl_docx(ncr_data, dnxl_data, details_df):
     """
     Điền dữ liệu DNXL vào template Excel (XLSX) sử dụng openpyxl.
@@ -27,8 +255,8 @@ def generate_dnxl_docx(ncr_data, dnxl_data, details_df):
         return None
 
     try:
-        wb = openpyxl.load_workbook(template_path)
-        ws = wb.active # Assume first sheet
+        # Template đã biên dịch (nạp 1 lần / process, nạp lại khi file mẫu thay đổi)
+        template = get_dnxl_template(template_path, os.path.getmtime(template_path))
         
         # --- 1. PREPARE DATA ---
         total_assigned = 0
@@ -52,12 +280,8 @@ def generate_dnxl_docx(ncr_data, dnxl_data, details_df):
             except:
                 return str(d_str)
 
-        import re
-        from openpyxl.cell.cell import MergedCell
-
-        # --- 2. REPLACE PLACEHOLDERS (REGEX) ---
-        # Map keys without brackets for regex matching
-        # Data dictionary
+        # --- 2. PLACEHOLDER DATA ---
+        # Keys khớp DNXL_PLACEHOLDER_KEYS ({{ key }} trong template)
         data_map = {
             'hop_dong': ncr_data.get('hop_dong', ''),
             'ten_sp': ncr_data.get('ten_sp', ''),
@@ -77,127 +301,8 @@ def generate_dnxl_docx(ncr_data, dnxl_data, details_df):
             'handling_instruction': dnxl_data.get('handling_instruction', '')
         }
 
-        # Search first 50 rows, 20 cols
-        for row in ws.iter_rows(min_row=1, max_row=50, min_col=1, max_col=20):
-            for cell in row:
-                # Skip if cell is part of a merge (but not top-left)
-                if isinstance(cell, MergedCell):
-                    continue
-                    
-                if cell.value and isinstance(cell.value, str):
-                    val = str(cell.value)
-                    
-                    # Regex to find {{ key }} or {{key}} with any internal spacing
-                    # Pattern: {{ \s*KEY \s* }}
-                    for key, replace_val in data_map.items():
-                        # Escape key just in case, though these are simple strings
-                        pattern = r"\{\{\s*" + re.escape(key) + r"\s*\}\}"
-                        if re.search(pattern, val):
-                            val = re.sub(pattern, str(replace_val), val)
-                            
-                    cell.value = val
-
-        # --- 3. WRITE TABLE DETAILS ---
-        # Strategy: Find explicit template loop row {{ i.ten_loi }}
-        start_row = None
-        
-        # 1. Search for value containing 'ten_loi' (The template tag)
-        for row in ws.iter_rows(min_row=1, max_row=30):
-            for cell in row:
-                if cell.value and isinstance(cell.value, str):
-                    if "ten_loi" in cell.value and "{{" in cell.value:
-                        start_row = cell.row
-                        break
-            if start_row: break
-            
-        # 2. Fallback if tag not found: Find 'Stt' and add offset
-        if not start_row: 
-            for row in ws.iter_rows(min_row=1, max_row=30):
-                for cell in row:
-                    # We do NOT skip merged cells for searching content, as the header might be merged.
-                    if cell.value and isinstance(cell.value, str):
-                        if "STT" == cell.value.strip().upper():
-                            # User feedback: Header is merged, data starts 2 rows below STT
-                            start_row = cell.row + 2
-                            break
-                if start_row: break
-        
-        if not start_row: start_row = 15 # Fallback adjusted
-        
-        # CLEAR existing placeholders (Smart Clear)
-        # Only clear rows that might contain template tags or are empty within a reasonable range
-        # Avoid clearing footer (Signature, Total check)
-        # Checking file images, footer starts around row 23-26. 
-        # If start_row is ~10, clearing 20 rows hits row 30 -> Wipes footer.
-        
-        # Safe clear: Only clear provided the cell value contains "{{" or is None
-        # And limit to max 12 rows (typical page size for this form)
-        for r in range(start_row, start_row + 12):
-            for c in range(1, 10):
-                cell = ws.cell(row=r, column=c)
-                if not isinstance(cell, MergedCell):
-                    val = str(cell.value) if cell.value else ""
-                    if "{{" in val or val.strip() == "":
-                         cell.value = None
-
-        if not details_df.empty:
-            thin = Side(border_style="thin", color="000000")
-            border = Border(left=thin, right=thin, top=thin, bottom=thin)
-            align_center = Alignment(horizontal='center', vertical='center')
-            align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
-
-            c_idx = start_row
-            for idx_enum, (_, row) in enumerate(details_df.iterrows()):
-                # Helper to safely set value
-                def safe_set(r, c, val, align):
-                    cell = ws.cell(row=r, column=c)
-                    if isinstance(cell, MergedCell): return # Skip if merged
-                    cell.value = val
-                    cell.border = border
-                    cell.alignment = align
-
-                # 1. STT (Col 1)
-                safe_set(c_idx, 1, idx_enum + 1, align_center)
-                
-                # 2. Ten Loi (Col 2)
-                safe_set(c_idx, 2, row.get('defect_name', ''), align_left)
-                
-                # Cols 3, 4, 5, 6 (Forms of processing/Place) -> Leave empty for manual check/input
-                # Do NOT fill with 0
-                
-                # 5. SL Hong (Col 7) -> Should be empty per request (was Qty Assigned)
-                safe_set(c_idx, 7, "", align_center)
-                
-                # Other columns left empty per instruction to fix positions
-                
-                c_idx += 1
-
-
-
-        # --- 4. PAGE SETUP & PRINT OPTIONS ---
-        try:
-            # User request: Center on page, fix margins
-            ws.page_setup.horizontalCentered = True
-            ws.page_setup.verticalCentered = False # Top align is standard for forms
-            
-            # Margins (Inches) - Narrow margins to maximize space
-            if ws.page_margins:
-                ws.page_margins.left = 0.25
-                ws.page_margins.right = 0.25
-                ws.page_margins.top = 0.5
-                ws.page_margins.bottom = 0.5
-            
-            # Fit to 1 page wide
-            ws.page_setup.fitToPage = True
-            ws.page_setup.fitToWidth = 1
-            ws.page_setup.fitToHeight = False # Allow multiple pages if many defects
-        except Exception:
-            # Non-critical: If print setup fails, just ignore and save file
-            pass
-        
-        # --- 5. SAVE ---
-        output_buffer = io.BytesIO()
-        wb.save(output_buffer)
+        # --- 3. RENDER (ghi trực tiếp vào các ô đã biết + bảng chi tiết) & SAVE ---
+        output_buffer = io.BytesIO(template.render(data_map, details_df))
         output_buffer.seek(0)
         return output_buffer
         
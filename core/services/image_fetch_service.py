@@ -0,0 +1,181 @@
+import io
+import os
+import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Tải song song tối đa N ảnh / phiếu
+FETCH_WORKERS = 6
+# (connect, read) timeout cho mỗi ảnh
+FETCH_TIMEOUT = (5, 30)
+# Dung lượng tối đa của cache ảnh trên đĩa (LRU theo thời điểm dùng gần nhất)
+IMAGE_CACHE_MAX_BYTES = 300 * 1024 * 1024
+IMAGE_CACHE_DIRNAME = "image_cache"
+
+_URL_RE = re.compile(r'(https?://[^\s,;]+)')
+
+
+def parse_image_urls(value):
+    """Danh sách URL ảnh (không trùng, giữ thứ tự) từ giá trị cột hinh_anh."""
+    if value is None:
+        return []
+    urls = _URL_RE.findall(str(value))
+    return list(dict.fromkeys(urls))
+
+
+@st.cache_resource
+def get_http_session():
+    """HTTP session dùng chung (keep-alive, retry 429/5xx) cho tải ảnh."""
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_WORKERS * 2, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ImageDiskCache:
+    """
+    Cache ảnh trên đĩa theo URL (sha1), giới hạn dung lượng.
+    - Ảnh gốc: <key>.img; bản thu nhỏ theo chiều rộng: <key>_w<px>.jpg
+    - Hit -> cập nhật mtime; vượt giới hạn -> xóa file dùng lâu nhất.
+    """
+
+    def __init__(self, cache_dir, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}  # key -> [Lock, số thread đang dùng]
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    @contextmanager
+    def _key_lock(self, key):
+        """Lock theo URL; bỏ khỏi map khi không còn ai giữ (map không lớn dần theo số URL)."""
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def _hit(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def _store(self, path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            replaced = os.path.getsize(path)  # Ghi đè file cũ (vd bản thu nhỏ dựng lại) -> trừ dung lượng cũ
+        except OSError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += len(data) - replaced
+            over = self._size > self.max_bytes
+        if over:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(
+                (e for e in os.scandir(self.cache_dir) if e.is_file() and not e.name.endswith('.tmp')),
+                key=lambda e: e.stat().st_mtime,
+            )
+            # Giữ lại ~90% giới hạn để không phải dọn liên tục
+            target = int(self.max_bytes * 0.9)
+            for entry in entries:
+                if self._size <= target:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self._size -= size
+                except OSError:
+                    pass
+
+    def get(self, url, width_px=None):
+        """Đường dẫn file ảnh của URL (tải nếu chưa có); width_px -> bản thu nhỏ JPEG. Lỗi -> None."""
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        original = os.path.join(self.cache_dir, f"{key}.img")
+        with self._key_lock(key):
+            if width_px:
+                resized = os.path.join(self.cache_dir, f"{key}_w{int(width_px)}.jpg")
+                if self._hit(resized):
+                    return resized
+            if not self._hit(original):
+                res = get_http_session().get(url, timeout=FETCH_TIMEOUT)
+                if res.status_code != 200 or not res.content:
+                    return None
+                self._store(original, res.content)
+            if not width_px:
+                return original
+            data = _downscale(original, width_px)
+            if data is None:
+                return original
+            self._store(resized, data)
+            return resized
+
+
+def _downscale(path, width_px):
+    """Thu nhỏ ảnh về chiều rộng width_px (giữ tỉ lệ) -> bytes JPEG; không đọc được ảnh -> None."""
+    try:
+        from PIL import Image, ImageOps
+        with Image.open(path) as img:
+            # JPEG: giải mã thẳng ở tỉ lệ nhỏ (nhanh hơn nhiều so với giải mã full 12MP rồi thu nhỏ)
+            img.draft('RGB', (int(width_px), int(width_px)))
+            img = ImageOps.exif_transpose(img)
+            if img.width > width_px:
+                img.thumbnail((int(width_px), int(width_px * img.height / img.width) + 1))
+            out = io.BytesIO()
+            img.convert('RGB').save(out, format='JPEG', quality=85, optimize=True)
+            return out.getvalue()
+    except Exception as e:
+        print(f"Lỗi thu nhỏ ảnh: {e}")
+        return None
+
+
+@st.cache_resource
+def get_image_cache():
+    """Cache ảnh trên đĩa dùng chung toàn process (thư mục dữ liệu cục bộ / image_cache)."""
+    from core.local_mirror import get_data_dir
+    return ImageDiskCache(os.path.join(get_data_dir(), IMAGE_CACHE_DIRNAME))
+
+
+def fetch_image(url, width_px=None):
+    """Tải một ảnh qua cache. Trả về đường dẫn file hoặc None nếu lỗi."""
+    if not url:
+        return None
+    try:
+        return get_image_cache().get(url, width_px)
+    except Exception as e:
+        print(f"Lỗi tải ảnh: {e}")
+        return None
+
+
+def fetch_images(urls, width_px=None, max_workers=FETCH_WORKERS):
+    """Tải song song nhiều ảnh (giữ thứ tự urls). Ảnh lỗi -> None tại vị trí tương ứng."""
+    urls = list(urls)
+    if len(urls) <= 1:
+        return [fetch_image(url, width_px) for url in urls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as pool:
+        return list(pool.map(lambda url: fetch_image(url, width_px), urls))
@@ -0,0 +1,113 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cloudinary
+import cloudinary.uploader
+import streamlit as st
+
+# Ảnh được thu nhỏ tại máy chủ app trước khi upload (khớp transform width 1200 / crop limit của Cloudinary)
+UPLOAD_MAX_WIDTH = 1200
+UPLOAD_JPEG_QUALITY = 85
+# Số ảnh upload song song
+UPLOAD_WORKERS = 4
+# Retry khi upload lỗi (mạng chập chờn, 5xx): 1s, 2s, 4s...
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_BASE = 1
+
+
+def configure_cloudinary():
+    """Cấu hình Cloudinary từ secrets [cloudinary] (cloud_name, api_key, api_secret)."""
+    cld = st.secrets["cloudinary"]
+    cloudinary.config(
+        cloud_name=cld["cloud_name"],
+        api_key=cld["api_key"],
+        api_secret=cld["api_secret"],
+        secure=True
+    )
+
+
+def prepare_image(uploaded_file, max_width=UPLOAD_MAX_WIDTH):
+    """
+    Thu nhỏ + nén lại ảnh (JPEG, xoay theo EXIF) trước khi upload.
+    Ảnh 12MP từ điện thoại (~4-6MB) còn vài trăm KB. Không đọc được ảnh -> gửi nguyên bản.
+    """
+    raw = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+    try:
+        from PIL import Image, ImageOps
+        with Image.open(io.BytesIO(raw)) as img:
+            # JPEG: giải mã thẳng ở tỉ lệ nhỏ thay vì full độ phân giải
+            img.draft('RGB', (max_width, max_width))
+            img = ImageOps.exif_transpose(img)
+            if img.width > max_width:
+                img.thumbnail((max_width, int(max_width * img.height / img.width) + 1))
+            out = io.BytesIO()
+            img.convert('RGB').save(out, format='JPEG', quality=UPLOAD_JPEG_QUALITY, optimize=True)
+        data = out.getvalue()
+        return data if len(data) < len(raw) else raw
+    except Exception as e:
+        print(f"Không thu nhỏ được ảnh {getattr(uploaded_file, 'name', '')}: {e}")
+        return raw
+
+
+def _upload_one(data, public_id):
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            res = cloudinary.uploader.upload(
+                io.BytesIO(data),
+                folder="ncr_images",
+                public_id=public_id,
+                resource_type="image",
+                transformation={
+                    "quality": "auto",
+                    "fetch_format": "auto",
+                    "width": UPLOAD_MAX_WIDTH,
+                    "crop": "limit"
+                }
+            )
+            return res.get("secure_url")
+        except Exception:
+            if attempt == UPLOAD_RETRIES:
+                raise
+            time.sleep(UPLOAD_RETRY_BASE * 2 ** attempt)
+
+
+def upload_images(file_list, filename_prefix, progress=None, max_workers=UPLOAD_WORKERS, public_id_base=None,
+                  prepared=False):
+    """
+    Thu nhỏ + upload song song các ảnh lên Cloudinary (thread pool, retry từng ảnh).
+    progress(done, total, file_name): gọi trên thread của trang (an toàn để cập nhật st.progress).
+    public_id_base: public_id cố định "<base>_<idx>" -> upload lại ghi đè thay vì tạo ảnh trùng (idempotent).
+    prepared=True: file đã qua prepare_image (vd ảnh trong nhật ký lưu) -> gửi nguyên bytes, không nén lại lần 2.
+
+    Returns:
+        (urls theo thứ tự file_list - None nếu ảnh lỗi, [(file_name, lỗi)])
+    """
+    files = list(file_list or [])
+    if not files:
+        return [], []
+
+    configure_cloudinary()
+    base = public_id_base or f"{filename_prefix}_{int(time.time())}"
+
+    def job(idx, uploaded_file):
+        if prepared:
+            data = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+        else:
+            data = prepare_image(uploaded_file)
+        return _upload_one(data, f"{base}_{idx}")
+
+    urls = [None] * len(files)
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as pool:
+        futures = {pool.submit(job, idx, f): idx for idx, f in enumerate(files)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            name = getattr(files[idx], 'name', f"image_{idx}")
+            try:
+                urls[idx] = future.result()
+            except Exception as e:
+                errors.append((name, e))
+            if progress:
+                progress(done, len(files), name)
+    return urls, errors
@@ -6,10 +6,10 @@ from utils.ncr_helpers import (
     restart_ncr
 )
 
-@st.cache_data(ttl=300)
 def get_monitor_data():
     """
     Tải tất cả dữ liệu NCR và trả về dưới dạng grouped dataframe.
+    Dữ liệu lấy từ snapshot NcrRepository dùng chung (không cache riêng).
     """
     # Load all data (no filters at load time)
     df_all, df_grouped = load_ncr_data_with_grouping(filter_status=None, filter_department=None)
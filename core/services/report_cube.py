@@ -0,0 +1,125 @@
+from collections import namedtuple
+
+import pandas as pd
+
+from core.search_index import match_values
+
+# Chiều của cube: thời gian x bộ phận x nguồn gốc x hợp đồng (+ nhóm hợp đồng) x tên lỗi
+TIME_DIMS = ['year', 'month', 'week']
+TEXT_DIMS = ['bo_phan', 'bo_phan_full', 'nguon_goc', 'hop_dong', 'nhom_hd', 'ten_loi']
+CUBE_DIMS = TIME_DIMS + TEXT_DIMS
+
+# defects: một ô / tổ hợp chiều, số dòng lỗi + tổng sl_loi (từ snapshot từng lỗi)
+# tickets: một ô / tổ hợp chiều theo phiếu (ten_loi = danh sách lỗi của phiếu),
+#          số phiếu + sl_kiem tính một lần / phiếu (từ bảng phiếu)
+ReportCube = namedtuple('ReportCube', ['defects', 'tickets'])
+
+
+def contract_group(hop_dong):
+    """Nhóm hợp đồng = 3 ký tự cuối (ngắn hơn -> 'Khác'), tính trên giá trị duy nhất."""
+    uniques = hop_dong.unique()
+    codes = pd.Series([str(v).strip() for v in uniques], dtype=object)
+    groups = codes.str[-3:].where(codes.str.len() >= 3, 'Khác')
+    return hop_dong.map(dict(zip(uniques, groups))).astype('category')
+
+
+def _numeric(df, col):
+    if col not in df.columns:
+        return pd.Series(0, index=df.index)
+    return pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+
+def _dimension_frame(df):
+    """Khung chiều của cube từ snapshot / bảng phiếu (cột text -> category)."""
+    dims = pd.DataFrame(index=df.index)
+    for col in TIME_DIMS:
+        dims[col] = df[col] if col in df.columns else pd.NA
+    for col in TEXT_DIMS:
+        if col == 'nhom_hd':
+            continue
+        values = df[col] if col in df.columns else pd.Series('', index=df.index)
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.fillna('').astype(str).str.strip().astype('category')
+        dims[col] = values
+    dims['nhom_hd'] = contract_group(dims['hop_dong'])
+    return dims[CUBE_DIMS]
+
+
+def _rollup(frame, rollup=True, **aggs):
+    if not rollup:
+        return frame.rename(columns={spec[0]: name for name, spec in aggs.items()})
+    return frame.groupby(CUBE_DIMS, observed=True, dropna=False, sort=False).agg(**aggs).reset_index()
+
+
+def build_report_cube(snapshot, tickets, rollup=True):
+    """
+    Dựng cube tổng hợp cho báo cáo / công cụ AI (bỏ phiếu đã hủy như get_report_data).
+    Mỗi câu hỏi chỉ cần lọc + cộng trên cube (vài nghìn ô) thay vì quét toàn bộ dữ liệu.
+    rollup=False: giữ nguyên một ô / dòng (cho tập nhỏ vừa lọc, tránh chi phí groupby nhiều chiều).
+    """
+    empty = pd.DataFrame(columns=CUBE_DIMS)
+    if snapshot.empty or 'so_phieu' not in snapshot.columns:
+        return ReportCube(empty, empty)
+
+    rows = snapshot[snapshot['trang_thai'] != 'da_huy'] if 'trang_thai' in snapshot.columns else snapshot
+    defects = _rollup(
+        _dimension_frame(rows).assign(so_dong_loi=1, sl_loi=_numeric(rows, 'sl_loi')),
+        rollup,
+        so_dong_loi=('so_dong_loi', 'sum'),
+        sl_loi=('sl_loi', 'sum'),
+    )
+
+    if tickets.empty:
+        return ReportCube(defects, empty)
+    ticket_rows = tickets[tickets['trang_thai'] != 'da_huy'] if 'trang_thai' in tickets.columns else tickets
+    ticket_cube = _rollup(
+        _dimension_frame(ticket_rows).assign(
+            so_phieu=1,
+            sl_kiem=_numeric(ticket_rows, 'sl_kiem'),
+            sl_loi=_numeric(ticket_rows, 'sl_loi'),
+        ),
+        rollup,
+        so_phieu=('so_phieu', 'sum'),
+        sl_kiem=('sl_kiem', 'sum'),
+        sl_loi=('sl_loi', 'sum'),
+    )
+    return ReportCube(defects, ticket_cube)
+
+
+def get_report_cube():
+    """Cube của snapshot hiện tại (dựng lại khi snapshot NCR đổi version)."""
+    from core.ncr_repository import get_ncr_repository
+    return get_ncr_repository().derived('report_cube', build_report_cube)
+
+
+def contains_mask(series, text):
+    """Lọc chứa từ khóa (không phân biệt hoa thường / dấu), tính trên giá trị duy nhất của cột."""
+    return series.isin(match_values(series.dropna().unique(), text))
+
+
+def slice_cube(cube, filters=None, year=None, month=None):
+    """
+    Lọc một bảng của cube.
+    filters: {chiều: chuỗi cần chứa} (vd: {'hop_dong': '725', 'ten_loi': 'bẩn'}).
+    year / month: so khớp chính xác.
+    """
+    if cube.empty:
+        return cube
+    mask = pd.Series(True, index=cube.index)
+    for col, text in (filters or {}).items():
+        if text is None or not str(text).strip():
+            continue
+        mask &= contains_mask(cube[col], text)
+    if year:
+        mask &= cube['year'] == int(year)
+    if month:
+        mask &= cube['month'] == int(month)
+    return cube[mask]
+
+
+def cube_totals(cube, by, measure, top_n=None):
+    """Tổng measure theo một chiều, sắp giảm dần."""
+    if cube.empty:
+        return pd.Series(dtype='int64')
+    totals = cube.groupby(by, observed=True)[measure].sum().sort_values(ascending=False, kind='stable')
+    return totals.head(int(top_n)) if top_n else totals
@@ -1,14 +1,12 @@
 import pandas as pd
 import streamlit as st
-from utils.ncr_helpers import load_ncr_dataframe_v2
+from utils.ncr_helpers import load_ncr_dataframe_v2, load_ncr_tickets
 import streamlit as st
 
-# FORCE CACHE UPDATE 2026-01-29
-# FORCE CACHE UPDATE 2026-01-29
-@st.cache_data(ttl=300)
 def get_report_data():
     """
     Tải dữ liệu NCR và lọc bỏ các phiếu đã hủy.
+    Dữ liệu lấy từ snapshot NcrRepository dùng chung (không cache riêng).
     """
     df_raw = load_ncr_dataframe_v2()
     if not df_raw.empty and 'trang_thai' in df_raw.columns:
@@ -16,6 +14,16 @@ def get_report_data():
         df_raw = df_raw[df_raw['trang_thai'] != 'da_huy'].copy()
     return df_raw
 
+def get_report_tickets():
+    """
+    Bảng phiếu (một dòng / so_phieu) đã lọc bỏ phiếu hủy.
+    Dùng cho các thống kê theo phiếu thay vì groupby dữ liệu từng lỗi.
+    """
+    df_tickets = load_ncr_tickets()
+    if not df_tickets.empty and 'trang_thai' in df_tickets.columns:
+        df_tickets = df_tickets[df_tickets['trang_thai'] != 'da_huy'].copy()
+    return df_tickets
+
 def prepare_trend_data(df):
     """
     Chuẩn bị dữ liệu xu hướng lỗi theo thời gian (ngày).
@@ -33,7 +41,8 @@ def prepare_pareto_data(df, top_n=10):
     if df.empty or 'ten_loi' not in df.columns:
         return pd.DataFrame(columns=['ten_loi', 'count', 'cumulative_percent'])
         
-    count_by_error = df['ten_loi'].value_counts().reset_index()
+    count_by_error = df['ten_loi'].value_counts()
+    count_by_error = count_by_error[count_by_error > 0].reset_index()  # category: bỏ giá trị không xuất hiện
     count_by_error.columns = ['ten_loi', 'count']
     
     # Tính % tích lũy
@@ -68,7 +77,8 @@ def prepare_severity_breakdown(df):
     if df.empty or 'muc_do' not in df.columns:
         return pd.DataFrame(columns=['muc_do', 'count'])
         
-    count_by_sev = df['muc_do'].value_counts().reset_index()
+    count_by_sev = df['muc_do'].value_counts()
+    count_by_sev = count_by_sev[count_by_sev > 0].reset_index()
     count_by_sev.columns = ['muc_do', 'count']
     
     return count_by_sev
@@ -5,8 +5,9 @@ from utils.ncr_helpers import (
     update_user_status, 
     update_user_info
 )
+from core.cache_tags import tagged_cache, USERS
 
-@st.cache_data(ttl=300)
+@tagged_cache(USERS, ttl=300)
 def load_users():
     """
     Tải danh sách toàn bộ người dùng.
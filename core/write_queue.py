@@ -0,0 +1,357 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import gspread
+import streamlit as st
+from gspread.exceptions import APIError
+
+from core.gsheets import get_spreadsheet
+from utils.ncr_helpers import get_now_vn
+
+# Gom các lần ghi trong khoảng này thành một request values_batch_update
+FLUSH_DELAY = 1.0
+# Backoff khi flush lỗi (429, mất mạng...): 2s, 4s, 8s... tối đa 60s
+RETRY_BASE = 2
+RETRY_MAX = 60
+# Hàng đợi lưu xuống đĩa (SQLite cục bộ) -> còn nguyên sau khi process bị kill / redeploy
+DB_FILENAME = "write_queue.sqlite3"
+# 4xx vẫn retry được (timeout, quota); 4xx khác (sai range, tab đã xóa, range bị khóa) -> dead-letter
+RETRYABLE_4XX = {408, 429}
+
+
+def is_permanent_error(error):
+    """Lỗi API 4xx không tự hết khi thử lại."""
+    if not isinstance(error, APIError):
+        return False
+    code = getattr(error.response, 'status_code', None)
+    return code is not None and 400 <= code < 500 and code not in RETRYABLE_4XX
+
+
+class SheetWriteQueue:
+    """
+    Hàng đợi ghi (write-behind) dùng chung cho toàn process.
+    - enqueue(): nhận cập nhật dạng batch_update ({'range': 'B5', 'values': [[v]]}),
+      gộp các lần ghi vào CÙNG một ô (giữ giá trị mới nhất).
+    - Thread nền flush tất cả sheet trong MỘT spreadsheet.values_batch_update, retry + backoff.
+    - pending_*/overlay_*: cho phép đọc lại ngay giá trị vừa ghi khi chưa flush xong.
+    - db_path: ô chờ ghi được lưu trong SQLite (như save_journal), nạp lại khi khởi động.
+    - Lỗi 4xx vĩnh viễn: tách batch theo sheet rồi theo range, range lỗi chuyển sang dead-letter,
+      phần còn lại vẫn được ghi (một range hỏng không chặn mọi lần ghi sau).
+    """
+
+    def __init__(self, flush_delay=FLUSH_DELAY, db_path=None):
+        self.flush_delay = flush_delay
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # sheet_name -> {a1_range: values}
+        self._wake = threading.Event()
+        self._thread = None
+        self.last_error = None
+        self.last_flush = None
+        if db_path:
+            self._init_db()
+
+    # --- Persistence ---
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pending ("
+                    " sheet TEXT, a1 TEXT, vals TEXT, enqueued_at REAL, PRIMARY KEY (sheet, a1))"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS dead_letters ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT, a1 TEXT, vals TEXT,"
+                    " error TEXT, failed_at REAL)"
+                )
+            rows = conn.execute("SELECT sheet, a1, vals FROM pending ORDER BY enqueued_at").fetchall()
+        finally:
+            conn.close()
+        # Ô chưa flush của lần chạy trước
+        for sheet, a1, vals in rows:
+            self._pending.setdefault(sheet, {})[a1] = json.loads(vals)
+
+    def _persist(self, sheet_name, updates):
+        if not self.db_path:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO pending (sheet, a1, vals, enqueued_at) VALUES (?, ?, ?, ?)",
+                    [(sheet_name, upd['range'], json.dumps(upd['values'], default=str), now) for upd in updates],
+                )
+        finally:
+            conn.close()
+
+    def _forget(self, cells):
+        if not self.db_path or not cells:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM pending WHERE sheet = ? AND a1 = ?", cells)
+        finally:
+            conn.close()
+
+    # --- Producer API ---
+    def enqueue(self, sheet_name, updates):
+        """Đưa cập nhật vào hàng đợi; ghi sau vào cùng ô sẽ thay thế ghi trước."""
+        if not updates:
+            return
+        with self._lock:
+            # Ghi đĩa trong lock: thứ tự trên đĩa khớp thứ tự trong bộ nhớ khi cùng ô
+            self._persist(sheet_name, updates)
+            cells = self._pending.setdefault(sheet_name, {})
+            for upd in updates:
+                rng = upd['range']
+                cells.pop(rng, None)  # Giữ thứ tự ghi mới nhất
+                cells[rng] = upd['values']
+        self._ensure_worker()
+        self._wake.set()
+
+    def pending_count(self):
+        with self._lock:
+            return sum(len(cells) for cells in self._pending.values())
+
+    def pending(self, sheet_name):
+        """Danh sách cập nhật chưa flush của một sheet: [{'range', 'values'}]."""
+        with self._lock:
+            cells = dict(self._pending.get(sheet_name, {}))
+        return [{'range': rng, 'values': values} for rng, values in cells.items()]
+
+    def pending_value(self, sheet_name, a1):
+        """Giá trị đang chờ ghi của một ô (None nếu không có)."""
+        with self._lock:
+            values = self._pending.get(sheet_name, {}).get(a1)
+        return values[0][0] if values else None
+
+    def overlay_rows(self, sheet_name, rows):
+        """Áp giá trị chờ ghi lên các dòng đọc từ sheet: rows = [(sheet_row, values)]."""
+        pending = self._single_cells(sheet_name)
+        if not pending:
+            return rows
+        for sheet_row, values in rows:
+            for (r, c), v in pending.items():
+                if r == sheet_row and c <= len(values):
+                    values[c - 1] = v
+        return rows
+
+    def overlay_frame(self, sheet_name, df):
+        """Áp giá trị chờ ghi lên DataFrame dạng records (dòng i <-> sheet row i + 2)."""
+        pending = self._single_cells(sheet_name)
+        if not pending or df.empty:
+            return df
+        df = df.copy()
+        for (r, c), v in pending.items():
+            if 0 <= r - 2 < len(df) and c <= len(df.columns):
+                col = df.columns[c - 1]
+                if df[col].dtype != object:
+                    df[col] = df[col].astype(object)
+                df.iat[r - 2, c - 1] = v
+        return df
+
+    def stats(self):
+        """Tình trạng hàng đợi (hiển thị giám sát)."""
+        with self._lock:
+            count = sum(len(cells) for cells in self._pending.values())
+        return {
+            "pending": count,
+            "dead_letters": len(self.dead_letters()),
+            "last_flush": self.last_flush,
+            "last_error": self.last_error,
+        }
+
+    # --- Dead-letter ---
+    def dead_letters(self):
+        """Các ô bị Sheets từ chối vĩnh viễn: [{id, sheet, range, values, error, failed_at}]."""
+        if not self.db_path:
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, sheet, a1, vals, error, failed_at FROM dead_letters ORDER BY id"
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {'id': r[0], 'sheet': r[1], 'range': r[2], 'values': json.loads(r[3]), 'error': r[4], 'failed_at': r[5]}
+            for r in rows
+        ]
+
+    def requeue_dead_letters(self, ids):
+        """Đưa lại các ô dead-letter vào hàng đợi (sau khi đã sửa sheet / quyền)."""
+        for item in self.dead_letters():
+            if item['id'] in ids:
+                self.enqueue(item['sheet'], [{'range': item['range'], 'values': item['values']}])
+        self.discard_dead_letters(ids)
+
+    def discard_dead_letters(self, ids):
+        if not self.db_path or not ids:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM dead_letters WHERE id = ?", [(i,) for i in ids])
+        finally:
+            conn.close()
+
+    def _dead_letter(self, sheet, rng, values, error):
+        print(f"Write queue dead-letter {sheet}!{rng}: {error}")
+        if not self.db_path:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO dead_letters (sheet, a1, vals, error, failed_at) VALUES (?, ?, ?, ?, ?)",
+                    (sheet, rng, json.dumps(values, default=str), str(error)[:500], time.time()),
+                )
+        finally:
+            conn.close()
+
+    def _single_cells(self, sheet_name):
+        result = {}
+        for upd in self.pending(sheet_name):
+            if ':' in upd['range']:
+                continue
+            result[gspread.utils.a1_to_rowcol(upd['range'])] = upd['values'][0][0]
+        return result
+
+    # --- Flush ---
+    def _send(self, items):
+        """Một values_batch_update cho các ô [(sheet, range, values)]."""
+        data = [
+            {'range': gspread.utils.absolute_range_name(sheet, rng), 'values': values}
+            for sheet, rng, values in items
+        ]
+        get_spreadsheet().values_batch_update({'valueInputOption': 'RAW', 'data': data})
+
+    def _send_split(self, batch, done, dead):
+        """
+        Batch bị từ chối (4xx vĩnh viễn): ghi từng sheet, sheet lỗi thì ghi từng range.
+        Range vẫn lỗi -> dead. Lỗi tạm thời (429, mạng) -> raise để retry + backoff.
+        """
+        for sheet, cells in batch.items():
+            items = [(sheet, rng, values) for rng, values in cells.items()]
+            try:
+                self._send(items)
+                done.extend(items)
+                continue
+            except Exception as e:
+                if not is_permanent_error(e):
+                    raise
+            for item in items:
+                try:
+                    self._send([item])
+                except Exception as e:
+                    if not is_permanent_error(e):
+                        raise
+                    self._dead_letter(*item, e)
+                    dead.append(item)
+                done.append(item)
+
+    def _clear(self, done):
+        """Bỏ khỏi hàng đợi các ô đã xử lý (chỉ ô chưa bị ghi đè trong lúc flush). Trả về số ô còn chờ."""
+        with self._lock:
+            forgotten = []
+            for sheet, rng, values in done:
+                current = self._pending.get(sheet, {})
+                if current.get(rng) is values:
+                    del current[rng]
+                    forgotten.append((sheet, rng))
+            self._forget(forgotten)
+            return sum(len(cells) for cells in self._pending.values())
+
+    def flush(self):
+        """Ghi toàn bộ hàng đợi ngay (đồng bộ). Trả về True nếu không còn gì chờ ghi."""
+        with self._flush_lock:
+            with self._lock:
+                batch = {sheet: dict(cells) for sheet, cells in self._pending.items() if cells}
+            if not batch:
+                return True
+
+            items = [(sheet, rng, values) for sheet, cells in batch.items() for rng, values in cells.items()]
+            done, dead = [], []
+            try:
+                try:
+                    self._send(items)
+                    done = items
+                except Exception as e:
+                    if not is_permanent_error(e):
+                        raise
+                    self._send_split(batch, done, dead)
+            finally:
+                # Kể cả khi lỗi giữa chừng: phần đã ghi không gửi lại
+                remaining = self._clear(done)
+
+            if dead:
+                self.last_error = f"{len(dead)} ô bị Sheets từ chối (xem dead-letter)"
+                # Snapshot đã vá lạc quan các ô này -> tải lại để hiển thị đúng giá trị trên Sheet
+                # (NCR_DATA tải toàn bộ: delta sync không thấy ô bị vá vì thoi_gian_cap_nhat không đổi)
+                from core.cache_tags import invalidate, NCR_DATA
+                from core.ncr_repository import get_ncr_repository
+                sheets = {sheet for sheet, _, _ in dead}
+                if NCR_DATA in sheets:
+                    get_ncr_repository().invalidate(full=True)
+                invalidate(*(sheets - {NCR_DATA}))
+            else:
+                self.last_error = None
+            self.last_flush = get_now_vn()
+            return remaining == 0
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="sheet-write-queue", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        attempt = 0
+        while True:
+            self._wake.wait()
+            time.sleep(self.flush_delay)  # Chờ gom thêm các lần ghi liền nhau
+            self._wake.clear()
+            try:
+                if not self.flush():
+                    self._wake.set()
+                attempt = 0
+            except Exception as e:
+                self.last_error = str(e)
+                attempt += 1
+                time.sleep(min(RETRY_BASE ** attempt, RETRY_MAX))
+                self._wake.set()
+
+
+def _flush_on_exit(queue):
+    try:
+        queue.flush()
+    except Exception as e:
+        print(f"Write queue flush on exit failed: {e}")
+
+
+@st.cache_resource
+def get_write_queue():
+    """Hàng đợi ghi duy nhất cho toàn process (Cached resource); còn ô chờ từ lần chạy trước -> flush ngay."""
+    from core.local_mirror import get_data_dir
+    data_dir = get_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    queue = SheetWriteQueue(db_path=os.path.join(data_dir, DB_FILENAME))
+    atexit.register(_flush_on_exit, queue)
+    if queue.pending_count():
+        queue._ensure_worker()
+        queue._wake.set()
+    return queue
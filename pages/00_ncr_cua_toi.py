@@ -13,9 +13,14 @@ from utils.ncr_helpers import (
     get_status_display_name,
     get_status_color,
     init_gspread,
+    get_now_vn_str,
+    _queue_ncr_updates,
     cancel_ncr
 )
 from core.services import dnxl_service # Import DNXL Service
+from core.gsheets import get_worksheet
+from core.ncr_repository import get_ncr_repository
+from core.cache_tags import invalidate, NCR_DATA, DNXL, DNXL_DETAILS
 from utils.ui_nav import render_sidebar, hide_default_sidebar_nav
 
 # --- PAGE SETUP ---
@@ -61,33 +66,55 @@ st.caption(f"Xin chào **{user_name}** - Quản lý các phiếu NCR bạn đã
 col1, col2 = st.columns([6, 1])
 with col2:
     if st.button("🔄 Làm mới", help="Clear cache và tải lại dữ liệu mới nhất"):
-        st.cache_data.clear()
+        invalidate(NCR_DATA, DNXL, DNXL_DETAILS)
         st.rerun()
 
 st.divider()
 
+# --- SAVE JOURNAL STATUS (phiếu đã lưu trên máy chủ, đang đồng bộ lên Sheet) ---
+from core.save_journal import get_save_journal, STATUS_PENDING, STATUS_DRAINING, STATUS_DONE, STATUS_FAILED
+df_journal = get_save_journal().entries(owner=None if user_role == 'admin' else user_name)
+if not df_journal.empty:
+    n_waiting = df_journal['status'].isin([STATUS_PENDING, STATUS_DRAINING]).sum()
+    n_failed = (df_journal['status'] == STATUS_FAILED).sum()
+    journal_label = f"📤 Đồng bộ phiếu: {n_waiting} đang chờ" + (f", {n_failed} lỗi" if n_failed else "")
+    with st.expander(journal_label, expanded=bool(n_failed)):
+        status_names = {
+            STATUS_PENDING: "⏳ Chờ đồng bộ",
+            STATUS_DRAINING: "🔄 Đang đồng bộ",
+            STATUS_DONE: "✅ Đã lên hệ thống",
+            STATUS_FAILED: "❌ Lỗi",
+        }
+        for _, entry in df_journal.iterrows():
+            jc1, jc2 = st.columns([3, 1])
+            with jc1:
+                saved_at = datetime.fromtimestamp(entry['created_at']).strftime("%d/%m %H:%M")
+                st.write(f"**{entry['ncr_id']}** · {status_names.get(entry['status'], entry['status'])} · lưu lúc {saved_at}")
+                if entry['status'] != STATUS_DONE and entry['last_error']:
+                    st.caption(f"Lần thử {int(entry['attempts'])}: {entry['last_error']}")
+            with jc2:
+                if entry['status'] == STATUS_FAILED:
+                    if st.button("🔁 Thử lại", key=f"journal_retry_{entry['key']}"):
+                        get_save_journal().retry(entry['key'])
+                        st.rerun()
+
 # --- HELPER: IMAGE POPUP ---
 # --- HELPER: RESUBMIT FUNCTION ---
 def resubmit_ncr(so_phieu):
     """Gửi lại phiếu NCR (reset status về cho_truong_ca)"""
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
+        ws = get_worksheet("NCR_DATA")
         
-        all_data = ws.get_all_values()
-        headers = all_data[0]
+        # Các dòng của phiếu qua index của NcrRepository (không tải toàn sheet)
+        headers, ticket_rows = get_ncr_repository().fetch_ticket_rows(ws, so_phieu)
         
         # Map column names
         from utils.ncr_helpers import COLUMN_MAPPING
-        col_so_phieu = headers.index(COLUMN_MAPPING.get('so_phieu', 'so_phieu_ncr'))
         col_trang_thai = headers.index(COLUMN_MAPPING.get('trang_thai', 'trang_thai'))
         col_thoi_gian = headers.index(COLUMN_MAPPING.get('thoi_gian_cap_nhat', 'thoi_gian_cap_nhat'))
         
         # Find rows to update
-        rows_to_update = []
-        for idx, row in enumerate(all_data[1:], start=2):
-            if row[col_so_phieu] == so_phieu:
-                rows_to_update.append(idx)
+        rows_to_update = [idx for idx, _ in ticket_rows]
         
         if not rows_to_update:
             return False, "Không tìm thấy phiếu"
@@ -98,15 +125,15 @@ def resubmit_ncr(so_phieu):
         
         for row_idx in rows_to_update:
             updates.append({
-                'range': f'{chr(65 + col_trang_thai)}{row_idx}',
+                'range': gspread.utils.rowcol_to_a1(row_idx, col_trang_thai + 1),
                 'values': [['cho_truong_ca']]
             })
             updates.append({
-                'range': f'{chr(65 + col_thoi_gian)}{row_idx}',
+                'range': gspread.utils.rowcol_to_a1(row_idx, col_thoi_gian + 1),
                 'values': [[current_time]]
             })
         
-        ws.batch_update(updates)
+        _queue_ncr_updates(updates)
         return True, f"Đã gửi lại phiếu {so_phieu} ({len(rows_to_update)} dòng)"
         
     except Exception as e:
@@ -134,7 +161,7 @@ def render_export_buttons(so_phieu, ticket_rows, df_raw=None, context="default")
             if st.button(f"🔄 Tạo BBK (PDF)", key=f"gen_bbk_{so_phieu}_{context}"):
                 with st.spinner("Đang tạo file BBK..."):
                     try:
-                        from utils.export_helper import generate_ncr_pdf
+                        from utils.export_helper import generate_ncr_pdf, get_template_path, enrich_export_context
                         ticket_info = ticket_rows.iloc[0].to_dict()
                         
                         # Use Raw Data if available, else fallback to ticket_rows (Grouped)
@@ -142,58 +169,11 @@ def render_export_buttons(so_phieu, ticket_rows, df_raw=None, context="default")
                         # To list errors, we need RAW data.
                         df_errs = df_raw if df_raw is not None else ticket_rows
                         
-                        # Fix Path: Use clean generated template Text Mode
-                        # Template path fix
-                        template_path = os.path.join(os.getcwd(), "templates", "Template BBK FI.docx")
-                        
+                        template_path = get_template_path("BBK")
+
                         # --- ENRICH CONTEXT ---
-                        # Map code keys back to sheet keys for template compatibility
-                        # e.g. 'sl_lo_hang' (in logic) -> 'so_luong_lo_hang' (in template)
-                        from utils.ncr_helpers import COLUMN_MAPPING
-                        from utils.aql_manager import get_aql_standard
-                        
-                        # 1. Map Keys
-                        for code_key, sheet_key in COLUMN_MAPPING.items():
-                            if code_key in ticket_info:
-                                ticket_info[sheet_key] = ticket_info[code_key]
-                        
-                        # 2. Inject AQL Variables
-                        try:
-                            # 'sl_lo_hang' is the internal key
-                            sl_lo = int(float(str(ticket_info.get('sl_lo_hang', 0) or 0)))
-                            aql_info = get_aql_standard(sl_lo)
-                            
-                            if aql_info:
-                                ticket_info['ac_major'] = aql_info['ac_major']
-                                ticket_info['ac_minor'] = aql_info['ac_minor']
-                                ticket_info['sample_size'] = aql_info['sample_size']
-                                ticket_info['aql_code'] = aql_info['code']
-                            else:
-                                ticket_info['ac_major'] = ""
-                                ticket_info['ac_minor'] = ""
-                        except:
-                            ticket_info['ac_major'] = ""
-                            ticket_info['ac_minor'] = ""
-                            
-                        # 3. Ensure New Fields Exist (Empty if missing) & Fallback Logic
-                        # Khach Hang: Derive from Hop Dong if missing (Old tickets support)
-                        if not ticket_info.get('khach_hang') and ticket_info.get('hop_dong'):
-                            hd = str(ticket_info.get('hop_dong', '')).strip()
-                            if hd and len(hd) >= 3:
-                                parts = hd.split('-')
-                                potential_cust = parts[-1] if not parts[-1].isdigit() else (parts[-2] if len(parts) > 1 else "")
-                                derived_kh = ''.join(filter(str.isalpha, potential_cust))
-                                if not derived_kh and len(parts) >= 2:
-                                     derived_kh = ''.join(filter(str.isalpha, parts[-2]))
-                                if not derived_kh: derived_kh = hd[-3:]
-                                ticket_info['khach_hang'] = derived_kh
-                        
-                        # Defauts for others
-                        for f in ['so_po', 'khach_hang', 'don_vi_kiem']:
-                            if f not in ticket_info or not ticket_info[f]:
-                                ticket_info[f] = ""
-                        # Fallback don_vi_kiem? user request said 'user input', so blank is safer if old.
-                        
+                        enrich_export_context(ticket_info)
+
                         pdf_path, docx_path = generate_ncr_pdf(template_path, ticket_info, df_errs, f"BBK_{so_phieu}")
                         
                         # Store in session state
@@ -243,59 +223,15 @@ def render_export_buttons(so_phieu, ticket_rows, df_raw=None, context="default")
             if st.button(f"🔄 Tạo NCR (PDF)", key=f"gen_ncr_{so_phieu}_{context}"):
                 with st.spinner("Đang tạo file NCR..."):
                     try:
-                        from utils.export_helper import generate_ncr_pdf
+                        from utils.export_helper import generate_ncr_pdf, get_template_path, enrich_export_context
                         ticket_info = ticket_rows.iloc[0].to_dict()
                         df_errs = df_raw if df_raw is not None else ticket_rows
                         
-                        # Fix Path: Use relative path
+                        template_path = get_template_path("NCR")
 
-                        # Template path fix
-                        template_path = os.path.join(os.getcwd(), "templates", "Template NCR FI.docx")
-                        
                         # --- ENRICH CONTEXT ---
-                        from utils.ncr_helpers import COLUMN_MAPPING
-                        from utils.aql_manager import get_aql_standard
-                        
-                        # 1. Map Keys
-                        for code_key, sheet_key in COLUMN_MAPPING.items():
-                            if code_key in ticket_info:
-                                ticket_info[sheet_key] = ticket_info[code_key]
-                        
-                        # 2. Inject AQL Variables
-                        try:
-                            sl_lo = int(float(str(ticket_info.get('sl_lo_hang', 0) or 0)))
-                            aql_info = get_aql_standard(sl_lo)
-                            
-                            if aql_info:
-                                ticket_info['ac_major'] = aql_info['ac_major']
-                                ticket_info['ac_minor'] = aql_info['ac_minor']
-                                ticket_info['sample_size'] = aql_info['sample_size']
-                                ticket_info['aql_code'] = aql_info['code']
-                            else:
-                                ticket_info['ac_major'] = ""
-                                ticket_info['ac_minor'] = ""
-                        except:
-                            ticket_info['ac_major'] = ""
-                            ticket_info['ac_minor'] = ""
+                        enrich_export_context(ticket_info)
 
-                        # 3. Ensure New Fields Exist (Empty if missing) & Fallback Logic
-                        # Khach Hang: Derive from Hop Dong if missing (Old tickets support)
-                        if not ticket_info.get('khach_hang') and ticket_info.get('hop_dong'):
-                            hd = str(ticket_info.get('hop_dong', '')).strip()
-                            if hd and len(hd) >= 3:
-                                parts = hd.split('-')
-                                potential_cust = parts[-1] if not parts[-1].isdigit() else (parts[-2] if len(parts) > 1 else "")
-                                derived_kh = ''.join(filter(str.isalpha, potential_cust))
-                                if not derived_kh and len(parts) >= 2:
-                                     derived_kh = ''.join(filter(str.isalpha, parts[-2]))
-                                if not derived_kh: derived_kh = hd[-3:]
-                                ticket_info['khach_hang'] = derived_kh
-
-                        # Defaults
-                        for f in ['so_po', 'khach_hang', 'don_vi_kiem']:
-                            if f not in ticket_info or not ticket_info[f]:
-                                ticket_info[f] = ""
-                        
                         pdf_path, docx_path = generate_ncr_pdf(template_path, ticket_info, df_errs, f"NCR_{so_phieu}")
                         
                         # Store in session state
@@ -444,6 +380,57 @@ else:
         st.info(f"ℹ️ User **{current_view_user}** chưa có phiếu NCR nào.")
     st.stop()
 
+# --- BATCH EXPORT (ZIP) ---
+with st.expander("📦 Xuất hàng loạt BBK/NCR (ZIP)"):
+    df_batch = df_my_ncrs[df_my_ncrs['trang_thai'] != 'da_huy']
+
+    bc1, bc2 = st.columns(2)
+    with bc1:
+        batch_contract = st.text_input("Hợp đồng chứa:", key="batch_export_contract")
+    with bc2:
+        months = []
+        if {'year', 'month'}.issubset(df_batch.columns):
+            months = sorted(
+                {(int(y), int(m)) for y, m in df_batch[['year', 'month']].dropna().itertuples(index=False)},
+                reverse=True
+            )
+        batch_month = st.selectbox(
+            "Tháng:", ["Tất cả"] + [f"{m:02d}/{y}" for y, m in months], key="batch_export_month"
+        )
+    batch_types = st.multiselect("Loại chứng từ:", ["BBK", "NCR"], default=["BBK", "NCR"], key="batch_export_types")
+
+    if batch_contract.strip() and 'hop_dong' in df_batch.columns:
+        from core.services.report_cube import contains_mask
+        df_batch = df_batch[contains_mask(df_batch['hop_dong'], batch_contract)]
+    if batch_month != "Tất cả":
+        m, y = (int(x) for x in batch_month.split('/'))
+        df_batch = df_batch[(df_batch['year'] == y) & (df_batch['month'] == m)]
+
+    batch_count = df_batch['so_phieu'].nunique()
+    st.caption(f"📋 {batch_count} phiếu x {len(batch_types)} loại chứng từ")
+
+    if st.button("📦 Tạo file ZIP", key="batch_export_run", disabled=(batch_count == 0 or not batch_types)):
+        from core.services.batch_export_service import export_tickets_zip
+        progress_bar = st.progress(0.0, text="Đang tạo chứng từ...")
+        zip_bytes, batch_errors = export_tickets_zip(
+            df_batch,
+            doc_types=batch_types,
+            progress=lambda done, total, label: progress_bar.progress(done / total, text=f"{done}/{total} - {label}")
+        )
+        st.session_state['batch_export_zip'] = zip_bytes
+        st.session_state['batch_export_errors'] = batch_errors
+
+    if st.session_state.get('batch_export_zip'):
+        if st.session_state.get('batch_export_errors'):
+            st.warning(f"⚠️ {len(st.session_state['batch_export_errors'])} chứng từ lỗi (xem _loi_xuat_file.txt trong ZIP)")
+        st.download_button(
+            label="⬇️ Tải file ZIP",
+            data=st.session_state['batch_export_zip'],
+            file_name=f"NCR_export_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+            mime="application/zip",
+            key="batch_export_download"
+        )
+
 st.divider()
 
 # --- TABS ---
@@ -574,7 +561,7 @@ with tab1:
                             else:
                                 if cancel_ncr(gc, so_phieu, cancel_reason):
                                     st.success("Đã hủy phiếu thành công!")
-                                    st.cache_data.clear()
+                                    invalidate(NCR_DATA, resync=False)
                                     st.rerun()
                                 else:
                                     st.error("Lỗi khi hủy phiếu.")
@@ -592,10 +579,8 @@ with tab1:
                     
                     # Calculate row indices in sheet
                     try:
-                        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-                        ws = sh.worksheet("NCR_DATA")
-                        all_data = ws.get_all_values()
-                        headers = all_data[0]
+                        ws = get_worksheet("NCR_DATA")
+                        headers, ticket_sheet_rows = get_ncr_repository().fetch_ticket_rows(ws, so_phieu)
                         
                         from utils.ncr_helpers import COLUMN_MAPPING, upload_images_to_cloud
                         col_so_phieu_idx = headers.index(COLUMN_MAPPING.get('so_phieu', 'so_phieu_ncr'))
@@ -607,16 +592,15 @@ with tab1:
                         error_rows = []
                         current_images_str = ""
                         
-                        for idx, row in enumerate(all_data[1:], start=2):
-                            if row[col_so_phieu_idx] == so_phieu:
-                                error_rows.append({
-                                    'sheet_row': idx,
-                                    'ten_loi': row[col_ten_loi_idx],
-                                    'sl_loi': row[col_sl_loi_idx]
-                                })
-                                # Get images from the first row found (assuming all rows of a ticket share same images)
-                                if not current_images_str:
-                                    current_images_str = row[col_hinh_anh_idx]
+                        for idx, row in ticket_sheet_rows:
+                            error_rows.append({
+                                'sheet_row': idx,
+                                'ten_loi': row[col_ten_loi_idx],
+                                'sl_loi': row[col_sl_loi_idx]
+                            })
+                            # Get images from the first row found (assuming all rows of a ticket share same images)
+                            if not current_images_str:
+                                current_images_str = row[col_hinh_anh_idx]
                         
                         # --- 1. EDIT ERRORS ---
                         st.markdown("**1. Sửa lỗi hiện có:**")
@@ -739,6 +723,8 @@ with tab1:
                                     
                                     if updates:
                                         ws.batch_update(updates)
+                                        # Sửa SL/ảnh không đổi thoi_gian_cap_nhat -> delta sync không thấy, buộc tải lại toàn bộ
+                                        get_ncr_repository().invalidate(full=True)
                                         st.success("✅ Đã lưu thay đổi!")
                                         st.session_state[edit_key] = False
                                         st.rerun()
@@ -764,7 +750,7 @@ with tab2:
         st.info("ℹ️ Không có phiếu nào đang chờ duyệt")
     else:
         # Group by ticket
-        tickets_pending = df_pending.groupby(['so_phieu', 'trang_thai']).agg({
+        tickets_pending = df_pending.groupby(['so_phieu', 'trang_thai'], observed=True).agg({
             'ngay_lap': 'first',
             'sl_loi': 'sum',
             'ten_loi': lambda x: ', '.join(x.unique()),
@@ -853,8 +839,7 @@ with tab2:
                             st.markdown("### ✏️ Chỉnh sửa phiếu (Đang chờ duyệt)")
                             
                             try:
-                                sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-                                ws = sh.worksheet("NCR_DATA")
+                                ws = get_worksheet("NCR_DATA")
                                 all_data = ws.get_all_values()
                                 headers = all_data[0]
                                 
@@ -927,6 +912,8 @@ with tab2:
                                     
                                     if updates:
                                         ws.batch_update(updates)
+                                        # Sửa SL/ảnh không đổi thoi_gian_cap_nhat -> delta sync không thấy, buộc tải lại toàn bộ
+                                        get_ncr_repository().invalidate(full=True)
                                         st.success("✅ Đã lưu thay đổi!")
                                         st.session_state[edit_key] = False
                                         st.rerun()
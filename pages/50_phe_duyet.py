@@ -5,6 +5,7 @@ import json
 import sys
 import os
 import re
+import math
 from datetime import datetime
 
 # Add utils to path
@@ -26,6 +27,9 @@ from core.services.approval_service import (
     reject_ncr
 )
 
+# Số phiếu hiển thị mỗi trang (mỗi lần rerun chỉ dựng các phiếu của trang hiện tại)
+TICKETS_PER_PAGE = 10
+
 # --- PAGE SETUP ---
 st.set_page_config(page_title="Phê Duyệt NCR", page_icon="✍️", layout="centered", initial_sidebar_state="auto")
 
@@ -37,6 +41,8 @@ pass
 
 # --- AUTHENTICATION CHECK ---
 from core.auth import require_roles
+from core.cache_tags import invalidate, NCR_DATA, USERS, DNXL, DNXL_DETAILS
+from core.local_mirror import bootstrap_sheets
 user_info = require_roles(['truong_ca', 'truong_bp', 'qc_manager', 'director', 'bgd_tan_phu'])
 user_role = user_info.get("role")
 user_name = user_info.get("name")
@@ -45,6 +51,9 @@ user_dept = user_info.get("department")
 # --- GOOGLE SHEETS CONNECTION ---
 gc = init_gspread()
 
+# Các tab trang cần: tải (khi hết hạn) trong một request values_batch_get thay vì mỗi loader một lần
+bootstrap_sheets(NCR_DATA, USERS, DNXL, DNXL_DETAILS)
+
 # --- FLASH MESSAGE CHECK (Must be early) ---
 if 'flash_msg' in st.session_state and st.session_state.flash_msg:
     msg_type = st.session_state.flash_msg.get('type', 'success')
@@ -67,7 +76,7 @@ st.caption(f"Xin chào **{user_name}** - Role: **{user_role.upper()}**")
 col1, col2 = st.columns([6, 1])
 with col2:
     if st.button("🔄 Làm mới", help="Clear cache và tải lại dữ liệu mới nhất", key="btn_refresh_cache"):
-        st.cache_data.clear()
+        invalidate(NCR_DATA, DNXL, DNXL_DETAILS)
         st.rerun()
 
 st.divider()
@@ -340,16 +349,36 @@ else:
                 else:
                     st.error(f"Lỗi tạo DNXL: {res_dnxl}")
 
+    # --- PAGINATION: chỉ dựng các phiếu của trang hiện tại ---
+    total_pages = max(1, math.ceil(count / TICKETS_PER_PAGE))
+    page_key = f"approval_page_{selected_role}"
+    if st.session_state.get(page_key, 1) > total_pages:
+        st.session_state[page_key] = 1  # Bộ lọc thay đổi -> số trang giảm
+    if total_pages > 1:
+        page = st.selectbox(
+            f"📄 Trang ({TICKETS_PER_PAGE} phiếu/trang):",
+            options=list(range(1, total_pages + 1)),
+            format_func=lambda p: f"Trang {p}/{total_pages}",
+            key=page_key
+        )
+    else:
+        page = 1
+    df_page = df_grouped.iloc[(page - 1) * TICKETS_PER_PAGE: page * TICKETS_PER_PAGE]
+
     # --- OPTIMIZATION: PRE-GROUP DETAILS ---
-    # Group df_original by so_phieu once to avoid filtering in loop
+    # Group df_original by so_phieu once (chỉ các phiếu trong trang) to avoid filtering in loop
     details_map = {}
     if not df_original.empty and 'so_phieu' in df_original.columns:
         # Create a dictionary of DataFrames for O(1) access
         # Note: groupby is faster than filtering N times
-        details_map = {k: v for k, v in df_original.groupby('so_phieu')}
+        df_page_rows = df_original[df_original['so_phieu'].isin(df_page['so_phieu'])]
+        details_map = {k: v for k, v in df_page_rows.groupby('so_phieu')}
 
-    # --- RENDER TICKETS ---
-    for _, row in df_grouped.iterrows():
+    # --- RENDER TICKET (FRAGMENT) ---
+    # Mỗi phiếu là một fragment: thao tác trong phiếu chỉ rerun phiếu đó.
+    # Phê duyệt / từ chối gọi st.rerun() -> rerun toàn trang để cập nhật danh sách.
+    @fragment_decorator
+    def render_ticket(row):
         # EXTRACT DATA SAFELY
         so_phieu = row.get('so_phieu', 'Unknown')
         trang_thai = row.get('trang_thai', 'Unknown')
@@ -361,7 +390,11 @@ else:
         status_name = get_status_display_name(trang_thai)
         expander_label = f"📋 {so_phieu} | {status_name} | 👤 {nguoi_lap} | ⚠️ {tong_loi} lỗi"
         
-        with st.expander(expander_label, expanded=False):
+        with st.container(border=True):
+            # Nội dung (ảnh, DNXL, danh sách người nhận...) chỉ dựng khi mở phiếu
+            if not st.toggle(expander_label, key=f"open_ticket_{so_phieu}"):
+                return
+
             # Info grid
             col1, col2 = st.columns(2)
             with col1:
@@ -644,7 +677,7 @@ else:
                             )
                             if success:
                                 st.session_state.flash_msg = {'type': 'success', 'content': f"Đã phê duyệt phiếu {so_phieu} thành công!"}
-                                st.cache_data.clear()
+                                invalidate(NCR_DATA, resync=False)
                                 st.rerun()
                             else:
                                 st.error(f"Lỗi: {msg}")
@@ -681,7 +714,7 @@ else:
                                 )
                                 if success:
                                     st.session_state.flash_msg = {'type': 'warning', 'content': f"Đã trả phiếu {so_phieu} về."}
-                                    st.cache_data.clear()
+                                    invalidate(NCR_DATA, resync=False)
                                     st.rerun()
                                 else:
                                     st.error(msg)
@@ -723,10 +756,14 @@ else:
                         # Get Details from MAP (Fast)
                         details_val = all_details_map.get(str(d_row['dnxl_id']), pd.DataFrame())
                         
-                        # Generate EXCEL (Updated)
-                        # Optimization Note: Generating Excel bytes for ALL buttons is still heavy if list is long.
-                        # But with details cached, it's just local processing.
-                        excel_file = export_service.generate_dnxl_docx(row, dnxl_val, details_val)
+                        # Generate EXCEL on click: chỉ dựng file khi người dùng bấm,
+                        # file đã dựng được cache theo nội dung (DNXL / chi tiết đổi -> dựng lại)
+                        fingerprint = export_service.dnxl_export_fingerprint(row, dnxl_val, details_val)
+                        excel_file = export_service.get_cached_dnxl_excel(fingerprint)
+                        if excel_file is None:
+                            if st.button(f"📊 Tạo Excel {d_row['dnxl_id']}", key=f"prep_xlsx_{d_row['dnxl_id']}"):
+                                with st.spinner("Đang tạo file Excel..."):
+                                    excel_file = export_service.get_dnxl_excel(row, dnxl_val, details_val)
                         
                         if excel_file:
                             st.download_button(
@@ -972,12 +1009,11 @@ else:
                                                     'type': 'success', 
                                                     'content': f"✅ {msg}"
                                                 }
-                                                st.cache_data.clear()
+                                                invalidate(NCR_DATA, resync=False)
                                                 st.rerun()
                                             else:
                                                 st.error(f"❌ {msg}")
 
-
-
-
-
+    # --- RENDER TICKETS ---
+    for _, row in df_page.iterrows():
+        render_ticket(row)
@@ -19,6 +19,7 @@ from core.services.monitor_service import (
     perform_restart_ncr
 )
 from core.auth import require_roles, get_user_info
+from core.cache_tags import invalidate, NCR_DATA
 
 # --- PAGE SETUP ---
 st.set_page_config(page_title="QC Giám Sát", page_icon="🔧", layout="centered", initial_sidebar_state="auto")
@@ -40,7 +41,7 @@ st.caption(f"**{user_name}** ({user_role}) - Quản lý phiếu bị từ chối
 col1, col2 = st.columns([6, 1])
 with col2:
     if st.button("🔄 Làm mới", help="Clear cache và tải lại dữ liệu mới nhất"):
-        st.cache_data.clear()
+        invalidate(NCR_DATA)
         st.rerun()
 
 st.divider()
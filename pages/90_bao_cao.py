@@ -25,6 +25,7 @@ from core.services.report_service import (
     prepare_severity_breakdown
 )
 from core.services.ai_service import get_agent_response
+from core.search_index import search_rows
 import re # For parsing chart tags
 
 # --- PAGE SETUP ---
@@ -131,6 +132,12 @@ selected_contracts = st.sidebar.multiselect("Hợp đồng (Cụ thể)", unique
 if selected_contracts:
     df_final = df_final[df_final['hop_dong'].isin(selected_contracts)]
 
+# 6. Tìm kiếm tự do (hợp đồng, lỗi, sản phẩm, mã vật tư, nguồn gốc) - tra index, không dấu
+search_term = st.sidebar.text_input("Tìm kiếm", placeholder="vd: bong keo, VT001...",
+                                    help="Tìm theo hợp đồng, tên lỗi, sản phẩm, mã vật tư, nguồn gốc (không phân biệt dấu)")
+if search_term.strip():
+    df_final = search_rows(df_final, search_term)
+
 if df_final.empty:
     st.warning("Không có dữ liệu phù hợp với bộ lọc.")
     st.stop()
@@ -4,6 +4,7 @@ import sys
 import os
 import random
 import string
+from datetime import datetime
 
 # Add utils to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -15,6 +16,9 @@ from core.services.user_service import (
     reset_user_password_service
 )
 from core.auth import require_admin
+from core.cache_tags import invalidate, USERS
+from core.quota_governor import get_quota_governor
+from core.write_queue import get_write_queue
 
 st.set_page_config(page_title="Quản lý User", page_icon="⚙️", layout="wide")
 
@@ -58,6 +62,54 @@ DEPT_OPTIONS = {
 st.title("⚙️ Quản Lý Người Dùng Hệ Thống")
 st.markdown(f"Xin chào Admin **{user_info.get('name')}**")
 
+# --- GOOGLE SHEETS QUOTA ---
+with st.expander("📶 Quota Google Sheets API"):
+    usage = get_quota_governor().usage()
+    q1, q2, q3, q4 = st.columns(4)
+    q1.metric("Read / phút", f"{usage['read']['last_minute']}/{usage['read']['limit']}")
+    q2.metric("Write / phút", f"{usage['write']['last_minute']}/{usage['write']['limit']}")
+    q3.metric("Chờ TB", f"{usage['avg_wait']:.1f}s", help=f"Lâu nhất: {usage['max_wait']:.1f}s")
+    q4.metric("Lỗi 429", usage['throttled_429'])
+
+# --- HÀNG ĐỢI GHI (write-behind) ---
+queue = get_write_queue()
+queue_stats = queue.stats()
+dead_letters = queue.dead_letters()
+with st.expander(
+    f"📝 Hàng đợi ghi Sheets{' - ⚠️ ' + str(len(dead_letters)) + ' ô lỗi' if dead_letters else ''}",
+    expanded=bool(dead_letters),
+):
+    w1, w2, w3 = st.columns(3)
+    w1.metric("Đang chờ ghi", queue_stats['pending'])
+    w2.metric("Dead-letter", queue_stats['dead_letters'])
+    w3.metric("Flush gần nhất", queue_stats['last_flush'].strftime('%H:%M:%S') if queue_stats['last_flush'] else "-")
+    if queue_stats['last_error']:
+        st.warning(f"Lỗi gần nhất: {queue_stats['last_error']}")
+    if dead_letters:
+        st.caption("Các ô bị Google Sheets từ chối (sai range, tab đã xóa, range bị khóa...). Sửa sheet rồi ghi lại, hoặc bỏ qua.")
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "Sheet": d['sheet'],
+                    "Ô": d['range'],
+                    "Giá trị": str(d['values'][0][0]) if d['values'] and d['values'][0] else "",
+                    "Lỗi": d['error'],
+                    "Thời điểm": datetime.fromtimestamp(d['failed_at']).strftime('%d/%m %H:%M'),
+                }
+                for d in dead_letters
+            ]),
+            use_container_width=True,
+            hide_index=True,
+        )
+        ids = [d['id'] for d in dead_letters]
+        d1, d2 = st.columns(2)
+        if d1.button("🔁 Ghi lại tất cả", key="dead_letter_requeue"):
+            queue.requeue_dead_letters(ids)
+            st.rerun()
+        if d2.button("🗑️ Bỏ qua tất cả", key="dead_letter_discard"):
+            queue.discard_dead_letters(ids)
+            st.rerun()
+
 tab1, tab2 = st.tabs(["🆕 Phê Duyệt User (Pending)", "👥 Danh Sách & Phân Quyền"])
 
 # --- TAB 1: APPROVAL ---
@@ -65,7 +117,7 @@ with tab1:
     st.subheader("Danh sách tài khoản chờ duyệt")
     
     if st.button("🔄 Refresh List", key="ref_tab1"):
-        st.cache_data.clear()
+        invalidate(USERS)
         st.rerun()
         
     all_users = load_users()
@@ -98,7 +150,7 @@ with tab1:
                                 success, msg = approve_user(row['username'])
                                 if success:
                                     st.success(f"Đã duyệt {row['username']}")
-                                    st.cache_data.clear()
+                                    invalidate(USERS)
                                     st.rerun()
                                 else: st.error(msg)
                                 
@@ -106,7 +158,7 @@ with tab1:
                                 success, msg = reject_user(row['username'])
                                 if success:
                                     st.warning(f"Đã từ chối {row['username']}")
-                                    st.cache_data.clear()
+                                    invalidate(USERS)
                                     st.rerun()
                                 else: st.error(msg)
             else:
@@ -139,7 +191,7 @@ with tab2:
         )
     with col_ref:
         if st.button("🔄 Refresh Data", key="ref_tab2"):
-            st.cache_data.clear()
+            invalidate(USERS)
             st.rerun()
 
     if not df.empty:
@@ -212,6 +264,6 @@ with tab2:
                              success, msg = update_user_details(row['username'], new_role_key, new_dept_key)
                              if success:
                                  st.success(msg)
-                                 st.cache_data.clear()
+                                 invalidate(USERS)
                                  st.rerun()
                              else: st.error(msg)
@@ -11,10 +11,13 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.ncr_helpers import (
     init_gspread,
     calculate_stuck_time,
+    parse_sheet_datetime,
+    get_now_vn,
     get_status_display_name,
     get_status_color,
     COLUMN_MAPPING,
     load_ncr_dataframe_v2,
+    load_ncr_tickets,
     load_pending_corrective_actions
 )
 
@@ -23,6 +26,8 @@ st.set_page_config(page_title="Dashboard Giám Đốc", page_icon="👑", layout
 
 # --- AUTHENTICATION CHECK ---
 from core.auth import require_roles
+from core.cache_tags import invalidate, NCR_DATA
+from core.search_index import get_ticket_search_index
 user_info = require_roles(['director'])
 user_role = user_info.get("role")
 
@@ -47,24 +52,10 @@ if df_raw.empty:
     st.info("Chưa có dữ liệu NCR.")
     st.stop()
 
-# --- DATA PREPROCESSING: GROUP BY TICKET ---
-# Raw data has 1 row per Error. We need 1 row per Ticket for stats.
+# --- DATA PREPROCESSING: 1 ROW PER TICKET ---
+# Raw data has 1 row per Error. Bảng phiếu dựng sẵn trong repository (không groupby mỗi lần render).
 if 'so_phieu' in df_raw.columns:
-    group_cols = {
-        'ngay_lap': 'first',
-        'nguoi_lap_phieu': 'first',
-        'trang_thai': 'first',
-        'thoi_gian_cap_nhat': 'first',
-        'hours_stuck': 'first',
-        'sl_loi': 'sum',
-        'bo_phan': 'first'
-    }
-    # Add optional cols if exist
-    for col in df_raw.columns:
-        if col not in group_cols and col != 'so_phieu':
-            group_cols[col] = 'first'
-            
-    df_all = df_raw.groupby('so_phieu', as_index=False).agg(group_cols)
+    df_all = load_ncr_tickets()
 else:
     df_all = df_raw.copy()
 
@@ -98,10 +89,10 @@ if selected_depts:
     active_filters_msg.append(f"Bộ phận: {', '.join(selected_depts)}")
 
 if search_contract:
-    term = search_contract.strip().lower()
     # "Smart" filter: contains logic handles both partial (suffix) and full match
-    mask = df_all['hop_dong'].astype(str).str.lower().str.contains(term, na=False)
-    df_all = df_all[mask]
+    # Tra index theo phiếu (không dấu, không phân biệt hoa thường) thay vì quét cả cột mỗi lần rerun
+    hits = get_ticket_search_index().search(search_contract, ['hop_dong'])
+    df_all = df_all[df_all['so_phieu'].isin(hits)]
     active_filters_msg.append(f"Hợp đồng: '{search_contract}'")
 
 if active_filters_msg:
@@ -124,15 +115,17 @@ if not df_tracking.empty:
     
     # Display as a nice table with Deadline check
     track_display = []
-    today = datetime.now().date()
+    # Cùng quy ước parse + giờ VN với snapshot (hours_stuck)
+    today = get_now_vn().date()
+    deadlines = parse_sheet_datetime(df_tracking['kp_deadline'])
     
-    for _, row in df_tracking.iterrows():
+    for idx, row in df_tracking.iterrows():
         # Deadline Status
-        deadline_str = row.get('kp_deadline', '')
+        dl_value = deadlines.loc[idx]
         dl_status = "⚪ N/A"
-        if deadline_str:
+        if pd.notna(dl_value):
             try:
-                dl_date = pd.to_datetime(deadline_str).date()
+                dl_date = dl_value.date()
                 days_left = (dl_date - today).days
                 if days_left < 0:
                     dl_status = f"🔴 Quá hạn {abs(days_left)} ngày"
@@ -346,7 +339,7 @@ st.subheader("🏢 Phân bổ theo bộ phận")
 
 if 'bo_phan' in df_all.columns:
     # Group by department and status
-    df_dept_status = df_all.groupby(['bo_phan', 'trang_thai']).size().reset_index(name='count')
+    df_dept_status = df_all.groupby(['bo_phan', 'trang_thai'], observed=True).size().reset_index(name='count')
     
     # Pivot for better display
     df_pivot = df_dept_status.pivot(index='bo_phan', columns='trang_thai', values='count').fillna(0)
@@ -396,7 +389,7 @@ st.divider()
 col_refresh, col_back = st.columns(2)
 with col_refresh:
     if st.button("🔄 Làm mới dữ liệu", use_container_width=True):
-        st.cache_data.clear()
+        invalidate(NCR_DATA)
         st.rerun()
 
 with col_back:
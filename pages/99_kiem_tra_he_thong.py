@@ -9,6 +9,7 @@ import json
 import cloudinary
 import cloudinary.uploader
 from utils.ncr_helpers import COLUMN_MAPPING, init_gspread
+from core.gsheets import get_worksheet
 
 st.set_page_config(page_title="🔍 Kiểm Tra Hệ Thống", page_icon="🔍", layout="wide")
 
@@ -26,8 +27,7 @@ st.header("📊 1. Kiểm Tra Google Sheet")
 try:
     gc = init_gspread()
     if gc:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
+        ws = get_worksheet("NCR_DATA")
         
         # Lấy headers
         headers_raw = ws.row_values(1)
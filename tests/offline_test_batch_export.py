@@ -0,0 +1,119 @@
+import sys
+import os
+import io
+import zipfile
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.services import batch_export_service as batch
+
+
+class FakePool:
+    """ProcessPoolExecutor giả: chạy ngay trong process; job thuộc `broken` trả BrokenProcessPool."""
+
+    def __init__(self, broken, *args, **kwargs):
+        self.broken = broken
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, job):
+        future = Future()
+        if (job[0], job[1]) in self.broken:
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        else:
+            future.set_result(fn(job))
+        return future
+
+
+class TestBatchExport(unittest.TestCase):
+    """export_tickets_zip: pool hỏng -> job thiếu render lại tuần tự đúng một lần; cache chứng từ giới hạn theo byte."""
+
+    def setUp(self):
+        batch._doc_cache.clear()
+        batch._doc_cache_bytes = 0
+        self.addCleanup(batch._doc_cache.clear)
+        export_helper = MagicMock()
+        export_helper.get_template_path.side_effect = lambda doc_type: f"/nonexistent/{doc_type}.docx"
+        patcher = patch.dict(sys.modules, {'utils.export_helper': export_helper})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rendered = []
+
+        def fake_render(job):
+            self.rendered.append((job[0], job[1]))
+            return f"{job[1]}_{job[0]}.pdf", f"{job[1]}:{job[0]}".encode()
+
+        patcher = patch.object(batch, 'render_document', side_effect=fake_render)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.df = pd.DataFrame({
+            'so_phieu': ['FI-01-001', 'FI-01-001', 'FI-01-002', 'FI-01-003'],
+            'ten_loi': ['Bẩn', 'Rách', 'Bong keo', 'Sai màu'],
+            'sl_loi': [1, 2, 3, 4],
+        })
+
+    def test_broken_pool_job_rendered_once_sequentially(self):
+        broken = {('FI-01-002', 'NCR')}
+        progress = []
+        with patch.object(batch, 'ProcessPoolExecutor', lambda *a, **k: FakePool(broken)):
+            data, errors = batch.export_tickets_zip(self.df, progress=lambda d, t, label: progress.append((d, t)),
+                                                    max_workers=4)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.rendered.count(('FI-01-002', 'NCR')), 1)
+        self.assertEqual(len(self.rendered), 6)
+        self.assertEqual(len(set(self.rendered)), 6)
+        names = zipfile.ZipFile(io.BytesIO(data)).namelist()
+        self.assertIn('NCR/NCR_FI-01-002.pdf', names)
+        self.assertNotIn('_loi_xuat_file.txt', names)
+        self.assertEqual(len(names), 6)
+        done = [d for d, _ in progress]
+        self.assertEqual(done, sorted(done))
+        self.assertEqual(progress[-1], (6, 6))
+        print("✅ A job lost to a broken pool is rendered sequentially exactly once, with no error.")
+
+    def test_cached_documents_skip_render(self):
+        with patch.object(batch, 'ProcessPoolExecutor', lambda *a, **k: FakePool(set())):
+            first, _ = batch.export_tickets_zip(self.df, max_workers=4)
+            self.rendered.clear()
+            second, errors = batch.export_tickets_zip(self.df, max_workers=4)
+        self.assertEqual(self.rendered, [])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(zipfile.ZipFile(io.BytesIO(second)).namelist()),
+                         sorted(zipfile.ZipFile(io.BytesIO(first)).namelist()))
+        print("✅ Re-exporting unchanged tickets is served from the document cache.")
+
+    def test_doc_cache_capped_by_bytes(self):
+        with patch.object(batch, 'DOC_CACHE_MAX_BYTES', 10):
+            batch._store_document('a', ('a.pdf', b'1234'))
+            batch._store_document('b', ('b.pdf', b'1234'))
+            self.assertIsNotNone(batch.get_cached_document('a'))  # 'a' vừa dùng -> 'b' cũ nhất
+            batch._store_document('c', ('c.pdf', b'1234'))
+            self.assertIsNone(batch.get_cached_document('b'))
+            self.assertEqual(set(batch._doc_cache), {'a', 'c'})
+            self.assertEqual(batch._doc_cache_bytes, 8)
+            batch._store_document('a', ('a.pdf', b'12'))  # ghi đè không cộng dồn dung lượng
+            self.assertEqual(batch._doc_cache_bytes, 6)
+            batch._store_document('big', ('big.pdf', b'x' * 11))  # lớn hơn cả giới hạn -> không giữ
+            self.assertIsNone(batch.get_cached_document('big'))
+            self.assertEqual(batch._doc_cache_bytes, 6)
+        print("✅ The rendered-document cache is bounded by total bytes.")
+
+
+if __name__ == '__main__':
+    unittest.main()
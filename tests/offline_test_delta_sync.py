@@ -0,0 +1,133 @@
+import sys
+import os
+import re
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+HEADER = ['so_phieu_ncr', 'ngay_lap', 'hop_dong', 'ten_loi', 'so_luong_loi', 'so_luong_kiem',
+          'nguon_goc', 'trang_thai', 'thoi_gian_cap_nhat']
+
+
+def _row(so_phieu, ten_loi, sl_loi, stamp, hop_dong='HD-725-ABC', ngay='2025-01-02',
+         sl_kiem=100, nguon_goc='NCC A', trang_thai='cho_truong_ca'):
+    return [so_phieu, ngay, hop_dong, ten_loi, str(sl_loi), str(sl_kiem), nguon_goc, trang_thai, stamp]
+
+
+class FakeWorksheet:
+    """Worksheet giả: giữ toàn bộ giá trị (dòng đầu là header), trả batch_get như Sheets API."""
+
+    def __init__(self, values):
+        self.values = values
+        self.batch_calls = []
+        self.full_reads = 0
+
+    def get_all_values(self):
+        self.full_reads += 1
+        return [list(r) for r in self.values]
+
+    def _cell_range(self, rng):
+        if rng == "1:1":
+            return [list(self.values[0])]
+        m = re.match(r'^([A-Z]+)(\d+):([A-Z]+)(\d*)$', rng)
+        c1, r1, c2, r2 = m.groups()
+        col = lambda letters: sum((ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(letters))) - 1
+        last = int(r2) if r2 else len(self.values)
+        rows = [r[col(c1):col(c2) + 1] for r in self.values[int(r1) - 1:last]]
+        # Sheets bỏ ô trống cuối dòng / dòng trống cuối vùng
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+    def batch_get(self, ranges):
+        self.batch_calls.append(list(ranges))
+        return [self._cell_range(rng) for rng in ranges]
+
+
+class TestDeltaSync(unittest.TestCase):
+    """NcrRepository: delta sync chỉ tải dòng đổi / dòng mới, kết quả khớp tải toàn bộ."""
+
+    def setUp(self):
+        from core.ncr_repository import NcrRepository
+        self.ws = FakeWorksheet([HEADER] + [
+            _row('FI-01-001', 'Bẩn', 2, '2025-01-02 08:00:00'),
+            _row('FI-01-001', 'Rách', 3, '2025-01-02 08:00:00'),
+            _row('FI-01-002', 'Bong keo', 5, '2025-01-02 09:00:00', hop_dong='HD-118-XYZ'),
+        ])
+        self.repo = NcrRepository()
+        self.repo._open_ws = lambda: self.ws
+        for name in ('_save_mirror', '_apply_pending_writes'):
+            patcher = patch.object(NcrRepository, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.repo._sync()
+
+    def _full_frame(self):
+        from core.ncr_repository import NcrRepository
+        fresh = NcrRepository()
+        fresh._apply_values(self.ws.get_all_values())
+        return fresh
+
+    def _assert_same_as_full(self):
+        fresh = self._full_frame()
+        cols = ['so_phieu', 'ten_loi', 'sl_loi', 'hop_dong', 'trang_thai']
+        pd.testing.assert_frame_equal(
+            self.repo._snapshot[cols].astype(str).reset_index(drop=True),
+            fresh._snapshot[cols].astype(str).reset_index(drop=True),
+        )
+        tcols = ['so_phieu', 'sl_loi', 'so_dong_loi', 'ten_loi']
+        pd.testing.assert_frame_equal(
+            self.repo._tickets[tcols].astype(str).reset_index(drop=True),
+            fresh._tickets[tcols].astype(str).reset_index(drop=True),
+        )
+
+    def test_changed_and_appended_rows(self):
+        self.ws.values[2] = _row('FI-01-001', 'Rách', 7, '2025-01-03 10:00:00', trang_thai='cho_truong_bp')
+        self.ws.values.append(_row('FI-01-003', 'Sai màu', 1, '2025-01-03 11:00:00'))
+        self.ws.full_reads = 0
+        version = self.repo.version
+
+        self.repo._sync()
+
+        self.assertEqual(self.ws.full_reads, 0)
+        # Lần gọi thứ 2 chỉ gồm dòng đổi (dòng 3) + khối dòng mới (dòng 5)
+        self.assertEqual(self.ws.batch_calls[-1], ['A3:I3', 'A5:I5'])
+        self.assertGreater(self.repo.version, version)
+        self._assert_same_as_full()
+        ticket = self.repo._tickets.set_index('so_phieu').loc['FI-01-001']
+        self.assertEqual(int(ticket['sl_loi']), 9)
+        print("✅ Delta sync merges changed + appended rows like a full reload.")
+
+    def test_no_change_keeps_version(self):
+        version = self.repo.version
+        self.repo._sync()
+        self.assertEqual(self.repo.version, version)
+        self.assertEqual(len(self.ws.batch_calls), 1)  # chỉ đọc header + 2 cột theo dõi
+        print("✅ Delta sync without changes does not rebuild the snapshot.")
+
+    def test_deleted_row_falls_back_to_full(self):
+        del self.ws.values[1]
+        self.ws.full_reads = 0
+        self.repo._sync()
+        self.assertEqual(self.ws.full_reads, 1)
+        self._assert_same_as_full()
+        print("✅ Row deletion forces a full reload.")
+
+    def test_patch_cells_overlay(self):
+        # I2 = thoi_gian_cap_nhat, H2 = trang_thai của dòng đầu
+        self.repo._patch_cells([{'range': 'H2', 'values': [['da_huy']]}])
+        self.assertEqual(self.repo._snapshot.loc[0, 'trang_thai'], 'da_huy')
+        self.assertEqual(self.repo._snapshot.loc[1, 'trang_thai'], 'cho_truong_ca')
+        print("✅ Pending cell updates patch the snapshot in place.")
+
+if __name__ == '__main__':
+    unittest.main()
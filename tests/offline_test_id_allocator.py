@@ -0,0 +1,99 @@
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class TestIdAllocator(unittest.TestCase):
+    """IdAllocator: compare-and-set bộ đếm, giữ chỗ không trùng, giữ chỗ hết hạn."""
+
+    def setUp(self):
+        from core.id_allocator import IdAllocator
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.db_path = os.path.join(self.tmp, 'ids.sqlite3')
+        self.existing = ({'FI-01-01', 'FI-01-02'}, {'FI-01-': 2})
+        patcher = patch.object(IdAllocator, '_index', lambda _self: self.existing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.allocator = IdAllocator(self.db_path)
+
+    def test_allocate_after_sheet_max(self):
+        self.assertEqual(self.allocator.peek('FI-01-'), 3)
+        self.assertEqual(self.allocator.allocate('FI-01-'), (True, 'FI-01-03'))
+        self.assertEqual(self.allocator.allocate('FI-01-'), (True, 'FI-01-04'))
+        self.assertEqual(self.allocator.allocate('FIKD-01-'), (True, 'FIKD-01-01'))
+        print("✅ Allocation continues after the highest number on the sheet.")
+
+    def test_cas_rejects_stale_expected(self):
+        conn = self.allocator._connect()
+        try:
+            self.assertTrue(self.allocator._cas(conn, 'FI-01-', None, 5))
+            self.assertFalse(self.allocator._cas(conn, 'FI-01-', None, 6))
+            self.assertFalse(self.allocator._cas(conn, 'FI-01-', 4, 6))
+            self.assertTrue(self.allocator._cas(conn, 'FI-01-', 5, 6))
+            self.assertEqual(self.allocator._last(conn, 'FI-01-'), 6)
+        finally:
+            conn.close()
+        print("✅ Compare-and-set only moves the counter from the expected value.")
+
+    def test_concurrent_allocations_unique(self):
+        results = []
+
+        def worker():
+            for _ in range(5):
+                results.append(self.allocator.allocate('FI-01-', owner=threading.current_thread().name))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [ncr_id for ok, ncr_id in results if ok]
+        self.assertEqual(len(ids), 40)
+        self.assertEqual(len(set(ids)), 40)
+        self.assertTrue(all(ncr_id not in self.existing[0] for ncr_id in ids))
+        print("✅ Concurrent allocations never hand out the same number.")
+
+    def test_reserve_conflicts_and_bumps_counter(self):
+        self.assertEqual(self.allocator.reserve('FI-01-02'), (False, "Mã phiếu FI-01-02 đã tồn tại"))
+        self.assertEqual(self.allocator.reserve('FI-01-07', owner='a'), (True, 'FI-01-07'))
+        ok, msg = self.allocator.reserve('FI-01-07', owner='b')
+        self.assertFalse(ok)
+        self.assertIn('đang được người khác lưu', msg)
+        self.assertTrue(self.allocator.exists('FI-01-07'))
+        self.assertEqual(self.allocator.allocate('FI-01-'), (True, 'FI-01-08'))
+        print("✅ Manual reservations block duplicates and push the counter forward.")
+
+    def test_release_returns_last_number(self):
+        ok, ncr_id = self.allocator.allocate('FI-01-')
+        self.allocator.release(ncr_id)
+        self.assertFalse(self.allocator.exists(ncr_id))
+        self.assertEqual(self.allocator.allocate('FI-01-'), (True, ncr_id))
+        print("✅ Releasing the last allocated number hands it out again.")
+
+    def test_expired_reservation_pruned(self):
+        from core.id_allocator import RESERVATION_TTL
+        self.allocator.reserve('FI-01-09', owner='a')
+        conn = self.allocator._connect()
+        try:
+            conn.execute("UPDATE reservations SET reserved_at = ? WHERE ncr_id = 'FI-01-09'",
+                         (time.time() - RESERVATION_TTL - 1,))
+        finally:
+            conn.close()
+        self.assertEqual(self.allocator.reserve('FI-01-09', owner='b'), (True, 'FI-01-09'))
+        print("✅ Expired reservations are pruned and can be taken again.")
+
+if __name__ == '__main__':
+    unittest.main()
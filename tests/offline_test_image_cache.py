@@ -0,0 +1,62 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.services import image_fetch_service as images
+
+
+class TestImageDiskCache(unittest.TestCase):
+    """ImageDiskCache: dung lượng đúng khi ghi đè file, không giữ lock theo URL sau khi tải xong."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.session = MagicMock()
+        self.session.get.return_value = MagicMock(status_code=200, content=b'x' * 100)
+        patcher = patch.object(images, 'get_http_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _disk_bytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.tmp) if entry.is_file())
+
+    def test_overwrite_does_not_grow_size(self):
+        cache = images.ImageDiskCache(self.tmp, max_bytes=10_000)
+        path = cache.get('https://example.com/a.jpg')
+        self.assertEqual(cache._size, 100)
+        cache._store(path, b'y' * 40)  # vd bản thu nhỏ dựng lại sau khi bị dọn
+        self.assertEqual(cache._size, 40)
+        self.assertEqual(cache._size, self._disk_bytes())
+        print("✅ Overwriting a cached file replaces its size instead of adding to it.")
+
+    def test_eviction_keeps_size_in_sync(self):
+        cache = images.ImageDiskCache(self.tmp, max_bytes=250)
+        for i in range(5):
+            cache.get(f'https://example.com/{i}.jpg')
+        self.assertLessEqual(cache._size, 250)
+        self.assertEqual(cache._size, self._disk_bytes())
+        print("✅ Eviction keeps the tracked size equal to disk usage.")
+
+    def test_key_locks_released(self):
+        cache = images.ImageDiskCache(self.tmp)
+        for i in range(3):
+            cache.get(f'https://example.com/{i}.jpg')
+        cache.get('https://example.com/0.jpg')  # hit
+        self.session.get.return_value = MagicMock(status_code=404, content=b'')
+        self.assertIsNone(cache.get('https://example.com/missing.jpg'))
+        self.assertEqual(cache._key_locks, {})
+        print("✅ Per-URL locks are dropped once get() finishes.")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import sys
+import os
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+
+def _api_error(code):
+    response = MagicMock(status_code=code)
+    response.json.return_value = {'error': {'code': code, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}}
+    return APIError(response)
+
+
+class TestQuotaGovernor(unittest.TestCase):
+    """QuotaGovernor: thứ tự ưu tiên, token giữ lại cho request ưu tiên cao, 429 -> penalize + thử lại."""
+
+    def _governor(self, burst=2, reserve=1):
+        from core.quota_governor import QuotaGovernor
+        # per_minute = burst + 1 -> nạp lại 1 token / 60s: gần như không nạp trong lúc test
+        return QuotaGovernor(reads_per_minute=burst + 1, writes_per_minute=burst + 1,
+                             burst=burst, background_reserve=reserve)
+
+    def _add_token(self, governor, kind):
+        with governor._cond:
+            governor._buckets[kind].tokens += 1
+            governor._cond.notify_all()
+
+    def _wait_for_waiters(self, governor, kind, count):
+        deadline = time.time() + 5
+        while len(governor._waiters[kind]) < count:
+            self.assertLess(time.time(), deadline, "waiters never queued")
+            time.sleep(0.01)
+
+    def test_background_keeps_reserve(self):
+        from core.quota_governor import READ, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+        governor = self._governor(burst=2, reserve=1)
+        self.assertLess(governor.acquire(READ, PRIORITY_BACKGROUND), 0.1)  # 2 token -> còn 1
+
+        done = threading.Event()
+        worker = threading.Thread(target=lambda: (governor.acquire(READ, PRIORITY_BACKGROUND), done.set()),
+                                  daemon=True)
+        worker.start()
+        # Token cuối là phần giữ lại: background phải chờ
+        self.assertFalse(done.wait(0.3))
+        # ... nhưng request tương tác vẫn lấy được ngay (không xếp sau background đang chờ)
+        self.assertLess(governor.acquire(READ, PRIORITY_INTERACTIVE), 0.1)
+        self._add_token(governor, READ)
+        self._add_token(governor, READ)
+        self.assertTrue(done.wait(5))
+        print("✅ Background requests never use the reserved tokens.")
+
+    def test_priority_order(self):
+        from core.quota_governor import READ, PRIORITY_BACKGROUND, PRIORITY_NORMAL, PRIORITY_INTERACTIVE
+        governor = self._governor(burst=2, reserve=0)
+        governor.acquire(READ, PRIORITY_INTERACTIVE)
+        governor.acquire(READ, PRIORITY_INTERACTIVE)  # bucket cạn
+
+        order = []
+
+        def request(name, priority):
+            governor.acquire(READ, priority)
+            order.append(name)
+
+        threads = []
+        for name, priority in [('background', PRIORITY_BACKGROUND), ('normal', PRIORITY_NORMAL),
+                               ('interactive', PRIORITY_INTERACTIVE)]:
+            t = threading.Thread(target=request, args=(name, priority), daemon=True)
+            t.start()
+            threads.append(t)
+            self._wait_for_waiters(governor, READ, len(threads))
+
+        for expected in range(1, 4):
+            self._add_token(governor, READ)
+            deadline = time.time() + 5
+            while len(order) < expected and time.time() < deadline:
+                time.sleep(0.01)
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, ['interactive', 'normal', 'background'])
+        print("✅ Waiting requests are served by priority, not arrival order.")
+
+    def test_429_penalizes_and_retries(self):
+        from core.quota_governor import GovernedHTTPClient, QuotaGovernor, WRITE, MAX_RETRIES_429
+        governor = QuotaGovernor(reads_per_minute=6000, writes_per_minute=6000, burst=100)
+        penalize = MagicMock(wraps=governor.penalize)
+        responses = [_api_error(429), _api_error(429), 'ok']
+        client = GovernedHTTPClient.__new__(GovernedHTTPClient)  # không cần auth / session thật
+
+        with patch('core.quota_governor.get_quota_governor', return_value=governor), \
+                patch.object(governor, 'penalize', penalize), \
+                patch.object(HTTPClient, 'request', side_effect=responses) as send:
+            self.assertEqual(client.request('post', 'spreadsheets/x/values:batchUpdate'), 'ok')
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual([c.args for c in penalize.call_args_list], [(WRITE, 1), (WRITE, 2)])
+        self.assertEqual(governor.usage()['throttled_429'], 2)
+
+        with patch('core.quota_governor.get_quota_governor', return_value=governor), \
+                patch.object(HTTPClient, 'request', side_effect=_api_error(429)) as send:
+            with self.assertRaises(APIError):
+                client.request('get', 'spreadsheets/x/values/A1')
+        self.assertEqual(send.call_count, MAX_RETRIES_429 + 1)
+
+        with patch('core.quota_governor.get_quota_governor', return_value=governor), \
+                patch.object(HTTPClient, 'request', side_effect=_api_error(400)) as send:
+            with self.assertRaises(APIError):
+                client.request('get', 'spreadsheets/x/values/A1')
+        self.assertEqual(send.call_count, 1)  # lỗi khác 429 không thử lại
+        print("✅ A 429 drains the bucket and retries a bounded number of times.")
+
+    def test_penalize_drains_bucket(self):
+        from core.quota_governor import READ
+        governor = self._governor(burst=2, reserve=0)
+        governor.penalize(READ, 2)
+        self.assertLessEqual(governor._buckets[READ].tokens, -3 + 0.01)
+        self.assertEqual(governor.usage()[READ]['tokens'], 0.0)
+        print("✅ penalize() leaves the bucket in debt so the next request waits longer.")
+
+
+if __name__ == '__main__':
+    unittest.main()
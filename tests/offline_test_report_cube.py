@@ -0,0 +1,117 @@
+import sys
+import os
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+HEADER = ['so_phieu_ncr', 'ngay_lap', 'hop_dong', 'ten_loi', 'so_luong_loi', 'so_luong_kiem',
+          'nguon_goc', 'trang_thai', 'thoi_gian_cap_nhat']
+
+
+def _row(so_phieu, ten_loi, sl_loi, stamp, hop_dong='HD-725-ABC', ngay='2025-01-02',
+         sl_kiem=100, nguon_goc='NCC A', trang_thai='cho_truong_ca'):
+    return [so_phieu, ngay, hop_dong, ten_loi, str(sl_loi), str(sl_kiem), nguon_goc, trang_thai, stamp]
+
+
+class TestReportCube(unittest.TestCase):
+    """Công cụ AI trên cube trả kết quả như cách tính cũ (lọc + đếm từng dòng)."""
+
+    def setUp(self):
+        from core.ncr_repository import normalize_ncr_frame, build_ticket_frame
+        from core.services.report_cube import build_report_cube
+        rows = []
+        defects = ['Bẩn', 'Rách', 'Bong keo', 'Sai màu']
+        contracts = ['HD-725-ABC', 'HD-118-XYZ', 'HD-725-QQQ', 'HD']
+        prefixes = ['FI', 'X2-TR', 'XA']
+        for t in range(60):
+            so_phieu = f"{prefixes[t % 3]}-{1 + t % 2:02d}-{t:03d}"
+            ngay = f"2025-{1 + t % 3:02d}-{1 + t % 27:02d}"
+            status = 'da_huy' if t % 11 == 0 else 'hoan_thanh'
+            for j in range(1 + t % 3):
+                rows.append(_row(so_phieu, defects[(t + j) % 4], 1 + (t * j) % 5, f"{ngay} 08:00:00",
+                                 hop_dong=contracts[t % 4], ngay=ngay, sl_kiem=50 + t, trang_thai=status))
+        raw = pd.DataFrame(rows, columns=HEADER)
+        for col in ('so_luong_loi', 'so_luong_kiem'):
+            raw[col] = raw[col].astype(int)
+        self.snapshot = normalize_ncr_frame(raw)
+        self.tickets = build_ticket_frame(self.snapshot)
+        self.cube = build_report_cube(self.snapshot, self.tickets)
+        # Dữ liệu cũ: get_report_data() = snapshot bỏ phiếu đã hủy
+        self.df = self.snapshot[self.snapshot['trang_thai'] != 'da_huy'].copy()
+
+    def _patched(self):
+        import core.services.ai_tools as ai_tools
+        return patch.multiple(ai_tools, get_report_cube=lambda: self.cube,
+                              get_report_data=lambda: self.df.copy())
+
+    def _old_filter(self, contract=None, department=None, year=None, month=None, defect_name=None):
+        df = self.df
+        if contract:
+            df = df[df['hop_dong'].astype(str).str.contains(contract, case=False, na=False)]
+        if department:
+            df = df[df['bo_phan_full'].astype(str).str.contains(department, case=False, na=False)]
+        if year:
+            df = df[df['year'] == int(year)]
+        if month:
+            df = df[df['month'] == int(month)]
+        if defect_name:
+            df = df[df['ten_loi'].astype(str).str.contains(defect_name, case=False, na=False)]
+        return df
+
+    def test_filter_data(self):
+        from core.services.ai_tools import filter_data
+        cases = [{}, {'contract': '725'}, {'department': 'Tráng', 'month': 2},
+                 {'year': 2025, 'month': 1, 'defect_name': 'keo'}, {'contract': 'zzz'}]
+        with self._patched():
+            for kwargs in cases:
+                result = json.loads(filter_data(**kwargs))
+                df = self._old_filter(**kwargs)
+                self.assertEqual(result['total_errors'], len(df), kwargs)
+                self.assertEqual(result['total_tickets'], df['so_phieu'].nunique(), kwargs)
+                counts = df['ten_loi'].astype(str).value_counts()
+                self.assertEqual(
+                    {k: counts[k] for k in result['top_3_defects']},
+                    result['top_3_defects'], kwargs,
+                )
+                self.assertEqual(sorted(result['top_3_defects'].values(), reverse=True),
+                                 sorted(counts.head(3).tolist(), reverse=True), kwargs)
+        print("✅ filter_data on the cube matches per-row filtering.")
+
+    def test_top_defects_and_periods(self):
+        from core.services.ai_tools import get_top_defects, compare_periods, get_department_ranking
+        with self._patched():
+            result = json.loads(get_top_defects(top_n=10, contract='725'))
+            df = self._old_filter(contract='725')
+            expected = df.groupby('ten_loi', observed=True)['sl_loi'].sum()
+            self.assertEqual(result, {k: int(v) for k, v in expected[expected.index.isin(result.keys())].items()})
+            self.assertEqual(len(result), len(expected))
+
+            result = json.loads(compare_periods('2025-01', '2025-02'))
+            self.assertEqual(result['count1'], len(self._old_filter(year=2025, month=1)))
+            self.assertEqual(result['count2'], len(self._old_filter(year=2025, month=2)))
+
+            ranking = json.loads(get_department_ranking())
+            expected = self.df['bo_phan_full'].astype(str).value_counts()
+            self.assertEqual(ranking, {k: int(v) for k, v in expected.items() if v})
+        print("✅ Top defects, period comparison and department ranking match per-row aggregation.")
+
+    def test_contract_ranking_counts_tickets_once(self):
+        from core.services.ai_tools import get_contract_ranking
+        with self._patched():
+            ranking = json.loads(get_contract_ranking(top_n=10))
+        expected = self.df.groupby('hop_dong', observed=True)['so_phieu'].nunique()
+        self.assertEqual(ranking, {k: int(v) for k, v in expected.items() if v})
+        print("✅ Contract ranking counts each ticket once.")
+
+if __name__ == '__main__':
+    unittest.main()
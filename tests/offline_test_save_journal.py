@@ -0,0 +1,130 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.save_journal import SaveJournal, STATUS_DONE, STATUS_PENDING
+
+HEADER = ['so_phieu_ncr', 'ten_loi', 'so_luong_loi', 'hinh_anh']
+
+
+class FakeWorksheet:
+    """Worksheet giả: append_rows có thể lỗi trước hoặc sau khi dòng đã vào Sheet (timeout)."""
+
+    def __init__(self):
+        self.rows = [list(HEADER)]
+        self.append_calls = 0
+        self.fail_append = None   # 'before' | 'after' | None
+        self.fail_read = False
+
+    def row_values(self, row):
+        return list(self.rows[row - 1])
+
+    def col_values(self, col):
+        if self.fail_read:
+            raise ConnectionError("read timed out")
+        return [r[col - 1] for r in self.rows]
+
+    def find(self, value):
+        return None
+
+    def append_rows(self, rows, value_input_option=None):
+        self.append_calls += 1
+        if self.fail_append == 'before':
+            raise ConnectionError("connection reset")
+        self.rows.extend(rows)
+        if self.fail_append == 'after':
+            raise TimeoutError("response lost after the rows were written")
+
+
+class TestSaveJournal(unittest.TestCase):
+    """SaveJournal: retry sau khi append lỗi không bao giờ ghi trùng; đọc lỗi -> thử lại sau, không append."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.ws = FakeWorksheet()
+        for target, value in [('core.gsheets.get_worksheet', lambda *a, **k: self.ws),
+                              ('core.cache_tags.invalidate', MagicMock())]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(SaveJournal, '_ensure_worker')  # drain đồng bộ trong test
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.journal = SaveJournal(self.tmp)
+        self.key = self.journal.submit(
+            'qc1', 'sess', 'FI-01-07', 'sheet-id', 'NCR_DATA',
+            [{'so_phieu_ncr': 'FI-01-07', 'ten_loi': 'Bẩn', 'so_luong_loi': 2},
+             {'so_phieu_ncr': 'FI-01-07', 'ten_loi': 'Rách', 'so_luong_loi': 1}],
+        )
+
+    def _entry(self):
+        df = self.journal.entries()
+        return df[df['key'] == self.key].iloc[0]
+
+    def _retry_now(self):
+        self.journal._update(self.key, next_attempt=0)
+        return self.journal.drain()
+
+    def _sheet_rows(self):
+        return [r for r in self.ws.rows[1:] if r[0] == 'FI-01-07']
+
+    def test_lost_response_not_appended_twice(self):
+        self.ws.fail_append = 'after'
+        self.assertEqual(self.journal.drain(), 0)
+        self.assertEqual(self._entry()['status'], STATUS_PENDING)
+
+        self.ws.fail_append = None
+        self.assertEqual(self._retry_now(), 1)
+        self.assertEqual(self.ws.append_calls, 1)
+        self.assertEqual(len(self._sheet_rows()), 2)
+        self.assertEqual(self._entry()['status'], STATUS_DONE)
+        print("✅ A retry after a lost append response does not append the ticket again.")
+
+    def test_failed_append_is_retried_once(self):
+        self.ws.fail_append = 'before'
+        self.journal.drain()
+        self.ws.fail_append = None
+        self.assertEqual(self._retry_now(), 1)
+        self.assertEqual(self.ws.append_calls, 2)
+        self.assertEqual(len(self._sheet_rows()), 2)
+        self.assertEqual(self._retry_now(), 0)  # đã xong -> không drain lại
+        self.assertEqual(len(self._sheet_rows()), 2)
+        print("✅ An append that never reached the sheet is retried exactly once.")
+
+    def test_read_error_raises_instead_of_appending(self):
+        self.ws.fail_append = 'before'
+        self.journal.drain()
+        self.ws.fail_append = None
+        self.ws.fail_read = True
+        self.assertEqual(self._retry_now(), 0)
+        self.assertEqual(self.ws.append_calls, 1)
+        entry = self._entry()
+        self.assertEqual(entry['status'], STATUS_PENDING)
+        self.assertIn('read timed out', entry['last_error'])
+
+        self.ws.fail_read = False
+        self.assertEqual(self._retry_now(), 1)
+        self.assertEqual(len(self._sheet_rows()), 2)
+        print("✅ A failed duplicate check is retried later instead of appending blindly.")
+
+    def test_restart_requeues_draining_entries(self):
+        self.journal._update(self.key, status='draining')
+        reopened = SaveJournal(self.tmp)
+        self.assertEqual(reopened.drain(), 1)
+        self.assertEqual(len(self._sheet_rows()), 2)
+        print("✅ Entries left draining by a killed process are drained after restart.")
+
+
+if __name__ == '__main__':
+    unittest.main()
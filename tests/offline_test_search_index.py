@@ -0,0 +1,72 @@
+import sys
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class TestSearchIndex(unittest.TestCase):
+    """search_index: bỏ dấu tiếng Việt, tìm qua index khớp quét trực tiếp."""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'so_phieu': ['A', 'B', 'C', 'D', 'E'],
+            'ten_loi': ['Bông keo', 'BONG  KEO', 'Rách', 'Đường may lệch', None],
+            'hop_dong': ['HD-725', 'HD-118', 'HD-725', 'HD-900', 'HD-900'],
+        }, index=[10, 11, 12, 13, 14])
+
+    def test_fold_text(self):
+        from core.search_index import fold_text
+        self.assertEqual(fold_text('Bông  Keo '), 'bong keo')
+        self.assertEqual(fold_text('Đường may LỆCH'), 'duong may lech')
+        self.assertEqual(fold_text('Rách'), 'rach')
+        print("✅ fold_text lowercases, strips diacritics and collapses spaces.")
+
+    def test_search_without_diacritics(self):
+        from core.search_index import TextIndex
+        index = TextIndex(self.df)
+        self.assertEqual(list(index.search('bong keo')), [10, 11])
+        self.assertEqual(list(index.search('duong')), [13])
+        self.assertEqual(list(index.search('RACH', ['ten_loi'])), [12])
+        self.assertEqual(list(index.search('ch')), [12, 13])  # từ khóa ngắn hơn n-gram
+        self.assertEqual(list(index.search('725', ['ten_loi'])), [])
+        self.assertEqual(list(index.search('725')), [10, 12])
+        print("✅ Search matches Vietnamese text regardless of diacritics.")
+
+    def test_index_matches_brute_force(self):
+        import core.search_index as si
+        rows = 2000
+        df = pd.DataFrame({
+            'ten_loi': [f"Lỗi số {i % 700} đợt {i % 7}" for i in range(rows)],
+            'hop_dong': [f"HD-{i % 300:03d}" for i in range(rows)],
+        })
+        index = si.TextIndex(df)
+        for term in ['loi so 1', 'DOT 3', 'hd-0', '9', 'không có']:
+            expected = df.index[df['ten_loi'].map(si.fold_text).str.contains(si.fold_text(term), regex=False)
+                                | df['hop_dong'].map(si.fold_text).str.contains(si.fold_text(term), regex=False)]
+            self.assertEqual(list(index.search(term)), list(expected), term)
+        print("✅ Index search agrees with a full scan (slice and mask paths).")
+
+    def test_search_rows_ignores_other_snapshot_version(self):
+        import core.search_index as si
+        from core.ncr_repository import SNAPSHOT_VERSION
+        current = self.df.copy()
+        current.attrs[SNAPSHOT_VERSION] = 2
+        shared = si.TextIndex(current.reset_index(drop=True), version=1)  # nhãn của version khác
+        with patch.object(si, 'get_row_search_index', return_value=shared):
+            self.assertEqual(si.search_rows(current, 'bong keo')['so_phieu'].tolist(), ['A', 'B'])
+        same = si.TextIndex(current, version=2)
+        with patch.object(si, 'get_row_search_index', return_value=same):
+            self.assertEqual(si.search_rows(current[current['so_phieu'] != 'A'], 'bong')['so_phieu'].tolist(), ['B'])
+        print("✅ search_rows only reuses index labels from the same snapshot version.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+# Chạy offline: mock streamlit trước khi import core (không cần secrets / Google Sheets)
+sys.modules["streamlit"] = MagicMock()
+sys.modules["streamlit.components.v1"] = MagicMock()
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from gspread.exceptions import APIError
+
+
+class TestWriteQueue(unittest.TestCase):
+    """SheetWriteQueue: gộp ghi cùng ô, overlay khi đọc, lưu đĩa, dead-letter khi 4xx."""
+
+    def setUp(self):
+        from core.write_queue import SheetWriteQueue
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.db_path = os.path.join(self.tmp, 'wq.sqlite3')
+        patcher = patch.object(SheetWriteQueue, '_ensure_worker')  # flush đồng bộ trong test
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = SheetWriteQueue(db_path=self.db_path)
+
+    def test_coalesce_same_cell(self):
+        self.queue.enqueue('NCR_DATA', [{'range': 'B5', 'values': [['a']]}])
+        self.queue.enqueue('NCR_DATA', [{'range': 'C5', 'values': [['x']]}, {'range': 'B5', 'values': [['b']]}])
+        self.assertEqual(self.queue.pending_count(), 2)
+        self.assertEqual(self.queue.pending_value('NCR_DATA', 'B5'), 'b')
+        # Ghi mới nhất xếp cuối
+        self.assertEqual([u['range'] for u in self.queue.pending('NCR_DATA')], ['C5', 'B5'])
+        print("✅ Writes to the same cell are coalesced (latest wins).")
+
+    def test_overlay(self):
+        self.queue.enqueue('DNXL', [{'range': 'B3', 'values': [['moi']]}, {'range': 'A1:B1', 'values': [['x', 'y']]}])
+        df = pd.DataFrame({'a': [1, 2], 'b': ['cu', 'cu']})
+        out = self.queue.overlay_frame('DNXL', df)
+        self.assertEqual(out['b'].tolist(), ['cu', 'moi'])
+        self.assertEqual(df['b'].tolist(), ['cu', 'cu'])  # không sửa frame gốc
+        rows = self.queue.overlay_rows('DNXL', [(3, ['1', 'cu']), (4, ['2', 'cu'])])
+        self.assertEqual(rows, [(3, ['1', 'moi']), (4, ['2', 'cu'])])
+        print("✅ Pending values overlay frames and rows read from Sheets.")
+
+    def test_persisted_across_restart(self):
+        from core.write_queue import SheetWriteQueue
+        self.queue.enqueue('NCR_DATA', [{'range': 'B5', 'values': [['a']]}])
+        self.queue.enqueue('NCR_DATA', [{'range': 'B5', 'values': [['b']]}])
+        reloaded = SheetWriteQueue(db_path=self.db_path)
+        self.assertEqual(reloaded.pending('NCR_DATA'), [{'range': 'B5', 'values': [['b']]}])
+        print("✅ Pending writes survive a restart.")
+
+    def test_flush_sends_one_batch(self):
+        self.queue.enqueue('NCR_DATA', [{'range': 'B5', 'values': [['a']]}])
+        self.queue.enqueue('DNXL', [{'range': 'C2', 'values': [['b']]}])
+        with patch.object(self.queue, '_send') as send:
+            self.assertTrue(self.queue.flush())
+        send.assert_called_once()
+        self.assertEqual(len(send.call_args[0][0]), 2)
+        self.assertEqual(self.queue.pending_count(), 0)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0], 0)
+        print("✅ Flush sends every sheet in one batch and clears the disk queue.")
+
+    def test_permanent_error_dead_letters_only_bad_range(self):
+        response = MagicMock(status_code=400)
+        response.json.return_value = {'error': {'code': 400, 'message': 'Unable to parse range', 'status': 'INVALID_ARGUMENT'}}
+        sent = []
+
+        def fake_send(items):
+            if any(rng == 'ZZ9' for _, rng, _ in items):
+                raise APIError(response)
+            sent.extend(items)
+
+        self.queue.enqueue('DNXL', [{'range': 'B2', 'values': [['ok']]}, {'range': 'ZZ9', 'values': [['bad']]}])
+        with patch.object(self.queue, '_send', side_effect=fake_send), patch('core.cache_tags.invalidate'):
+            self.assertTrue(self.queue.flush())
+        self.assertEqual([rng for _, rng, _ in sent], ['B2'])
+        dead = self.queue.dead_letters()
+        self.assertEqual([(d['sheet'], d['range'], d['values']) for d in dead], [('DNXL', 'ZZ9', [['bad']])])
+        self.assertEqual(self.queue.stats()['dead_letters'], 1)
+
+        self.queue.requeue_dead_letters([dead[0]['id']])
+        self.assertEqual(self.queue.pending_value('DNXL', 'ZZ9'), 'bad')
+        self.assertEqual(self.queue.dead_letters(), [])
+        print("✅ A permanently rejected range is dead-lettered without blocking the rest.")
+
+    def test_transient_error_keeps_queue(self):
+        response = MagicMock(status_code=429)
+        response.json.return_value = {'error': {'code': 429, 'message': 'Quota', 'status': 'RESOURCE_EXHAUSTED'}}
+        self.queue.enqueue('DNXL', [{'range': 'B2', 'values': [['ok']]}])
+        with patch.object(self.queue, '_send', side_effect=APIError(response)):
+            with self.assertRaises(APIError):
+                self.queue.flush()
+        self.assertEqual(self.queue.pending_count(), 1)
+        self.assertEqual(self.queue.dead_letters(), [])
+        print("✅ Retryable errors (429) keep the write queued.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,8 @@ from datetime import datetime
 from docxtpl import DocxTemplate, InlineImage
 from docx.shared import Mm
 import tempfile
-import requests
-import shutil
+import zipfile
+from functools import lru_cache
 
 def get_temp_file_path(filename):
     return os.path.join(tempfile.gettempdir(), filename)
@@ -26,21 +26,100 @@ def format_date_vn(date_str):
     except:
         return str(date_str)
 
+# Template Word theo loại chứng từ (trong folder templates/)
+EXPORT_TEMPLATES = {
+    'BBK': "Template BBK FI.docx",
+    'NCR': "Template NCR FI.docx",
+}
+
+def get_template_path(doc_type):
+    """Đường dẫn template Word của loại chứng từ (BBK / NCR)"""
+    return os.path.join(os.getcwd(), "templates", EXPORT_TEMPLATES[doc_type])
+
+def enrich_export_context(ticket_info):
+    """
+    Bổ sung context cho template BBK/NCR (dùng chung cho xuất từng phiếu và xuất hàng loạt):
+    map key code -> key sheet, biến AQL, khách hàng suy ra từ hợp đồng, các trường mặc định.
+    """
+    # Map code keys back to sheet keys for template compatibility
+    # e.g. 'sl_lo_hang' (in logic) -> 'so_luong_lo_hang' (in template)
+    from utils.ncr_helpers import COLUMN_MAPPING
+    from utils.aql_manager import get_aql_standard
+    
+    # 1. Map Keys
+    for code_key, sheet_key in COLUMN_MAPPING.items():
+        if code_key in ticket_info:
+            ticket_info[sheet_key] = ticket_info[code_key]
+    
+    # 2. Inject AQL Variables
+    try:
+        # 'sl_lo_hang' is the internal key
+        sl_lo = int(float(str(ticket_info.get('sl_lo_hang', 0) or 0)))
+        aql_info = get_aql_standard(sl_lo)
+        
+        if aql_info:
+            ticket_info['ac_major'] = aql_info['ac_major']
+            ticket_info['ac_minor'] = aql_info['ac_minor']
+            ticket_info['sample_size'] = aql_info['sample_size']
+            ticket_info['aql_code'] = aql_info['code']
+        else:
+            ticket_info['ac_major'] = ""
+            ticket_info['ac_minor'] = ""
+    except:
+        ticket_info['ac_major'] = ""
+        ticket_info['ac_minor'] = ""
+        
+    # 3. Ensure New Fields Exist (Empty if missing) & Fallback Logic
+    # Khach Hang: Derive from Hop Dong if missing (Old tickets support)
+    if not ticket_info.get('khach_hang') and ticket_info.get('hop_dong'):
+        hd = str(ticket_info.get('hop_dong', '')).strip()
+        if hd and len(hd) >= 3:
+            parts = hd.split('-')
+            potential_cust = parts[-1] if not parts[-1].isdigit() else (parts[-2] if len(parts) > 1 else "")
+            derived_kh = ''.join(filter(str.isalpha, potential_cust))
+            if not derived_kh and len(parts) >= 2:
+                 derived_kh = ''.join(filter(str.isalpha, parts[-2]))
+            if not derived_kh: derived_kh = hd[-3:]
+            ticket_info['khach_hang'] = derived_kh
+    
+    # Defauts for others
+    for f in ['so_po', 'khach_hang', 'don_vi_kiem']:
+        if f not in ticket_info or not ticket_info[f]:
+            ticket_info[f] = ""
+    return ticket_info
+
+# Ảnh chèn vào template (biến danh_sach_anh): chiều rộng trên giấy + độ phân giải thu nhỏ trước khi chèn
+IMAGE_WIDTH_MM = 80
+IMAGE_WIDTH_PX = 1000
+
 def download_image(url):
-    """Tải ảnh từ URL về file tạm để chèn vào Word"""
+    """Tải ảnh từ URL (qua cache ảnh trên đĩa) để chèn vào Word"""
+    from core.services.image_fetch_service import fetch_image
+    return fetch_image(url)
+
+@lru_cache(maxsize=16)
+def _template_variables(template_path, mtime):
+    # Nội dung XML của template (chỉ đọc để kiểm tra biến có được dùng hay không)
+    with zipfile.ZipFile(template_path) as zf:
+        return "".join(
+            zf.read(name).decode('utf-8', errors='ignore')
+            for name in zf.namelist() if name.startswith('word/') and name.endswith('.xml')
+        )
+
+def template_uses(template_path, variable):
+    """Template có tham chiếu biến `variable` không (để bỏ qua tải ảnh khi không cần)"""
     try:
-        if not url: return None
-        res = requests.get(url, stream=True)
-        if res.status_code == 200:
-            tmp_name = f"img_{int(datetime.now().timestamp())}_{os.urandom(4).hex()}.jpg"
-            tmp_path = get_temp_file_path(tmp_name)
-            with open(tmp_path, 'wb') as f:
-                shutil.copyfileobj(res.raw, f)
-            return tmp_path
-        return None
-    except Exception as e:
-        print(f"Lỗi tải ảnh: {e}")
-        return None
+        return variable in _template_variables(template_path, os.path.getmtime(template_path))
+    except Exception:
+        return False
+
+def collect_image_urls(ticket_data, df_errors):
+    """URL ảnh của phiếu (cột hinh_anh của phiếu + các dòng lỗi), không trùng"""
+    from core.services.image_fetch_service import parse_image_urls
+    values = [ticket_data.get('hinh_anh', '')]
+    if not df_errors.empty and 'hinh_anh' in df_errors.columns:
+        values += df_errors['hinh_anh'].dropna().astype(str).unique().tolist()
+    return list(dict.fromkeys(url for v in values for url in parse_image_urls(v)))
 
 def generate_ncr_pdf(template_path, ticket_data, df_errors, output_filename_prefix):
     """
@@ -253,6 +332,15 @@ def generate_ncr_pdf(template_path, ticket_data, df_errors, output_filename_pref
         if list_errors:
             context['tong_loi_chi_tiet'] = sum([float(e['sl']) for e in list_errors if str(e['sl']).replace('.','',1).isdigit()])
         
+        # --- ẢNH MINH HỌA (chỉ khi template dùng danh_sach_anh) ---
+        # Tải song song qua cache đĩa, thu nhỏ về độ rộng chèn trước khi đưa vào InlineImage
+        if template_uses(template_path, 'danh_sach_anh'):
+            from core.services.image_fetch_service import fetch_images
+            image_paths = fetch_images(collect_image_urls(ticket_data, df_errors), width_px=IMAGE_WIDTH_PX)
+            context['danh_sach_anh'] = [
+                InlineImage(doc, path, width=Mm(IMAGE_WIDTH_MM)) for path in image_paths if path
+            ]
+        
         # 3. FILL TEMPLATE
         doc.render(context)
         
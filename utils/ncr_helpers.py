@@ -2,11 +2,13 @@ import pandas as pd
 from datetime import datetime, timedelta
 import streamlit as st
 import gspread
-import cloudinary
-import cloudinary.uploader
 import io
 import json
+import re
+from functools import lru_cache
 from utils.security import hash_password, verify_password
+from core.cache_tags import tagged_cache, USERS
+from core.gsheets import get_client, get_worksheet
 
 def get_now_vn():
     """Lấy thời gian hiện tại theo múi giờ Việt Nam (GMT+7)"""
@@ -16,20 +18,9 @@ def get_now_vn_str():
     """Lấy chuỗi thời gian hiện tại VN định dạng chuẩn"""
     return get_now_vn().strftime("%Y-%m-%d %H:%M:%S")
 
-@st.cache_resource
 def init_gspread():
-    """Khởi tạo gspread client từ secrets (Dùng chung toàn hệ thống)"""
-    try:
-        creds_str = st.secrets["connections"]["gsheets"]["service_account"]
-        if isinstance(creds_str, str):
-            creds_dict = json.loads(creds_str, strict=False)
-        else:
-            creds_dict = creds_str
-        gc = gspread.service_account_from_dict(creds_dict)
-        return gc
-    except Exception as e:
-        st.error(f"Lỗi khởi tạo gspread: {e}")
-        return None
+    """Khởi tạo gspread client (Dùng chung toàn hệ thống - cùng client với core.gsheets.get_client)"""
+    return get_client()
 
 # --- CONFIGURATION ---
 LIST_DON_VI_TINH = ["Cái", "Kg", "Mét", "Bịch", "Sợi", "Cuộn", "Bộ"]
@@ -171,42 +162,62 @@ ROLE_TO_STATUS = {
     'bgd_tan_phu': 'cho_bgd_tan_phu'
 }
 
-# --- CACHED DATA FETCH ---
-@st.cache_data(ttl=300, show_spinner=False)
+# --- SHARED DATA FETCH ---
 def _get_ncr_data_cached():
+    """Dữ liệu NCR_DATA thô (tên cột như trên Sheet) từ NcrRepository dùng chung."""
     try:
-        gc = init_gspread()
-        if not gc: return pd.DataFrame()
-        
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sh = gc.open_by_key(spreadsheet_id)
-        ws = sh.worksheet("NCR_DATA")
-        records = ws.get_all_records()
-        df = pd.DataFrame(records)
-        return df
+        from core.ncr_repository import get_ncr_repository
+        return get_ncr_repository().raw()
     except Exception as e:
-        # st.error(f"❌ Lỗi khi tải dữ liệu: {e}")
         return pd.DataFrame()
 
 
+def _fetch_ticket_rows(ws, so_phieu):
+    """
+    Các dòng hiện tại của một phiếu trên NCR_DATA qua index của NcrRepository.
+    Returns: (headers_lowercase, [(sheet_row, row_values), ...])
+    """
+    from core.ncr_repository import get_ncr_repository
+    return get_ncr_repository().fetch_ticket_rows(ws, so_phieu)
+
+
+def _queue_ncr_updates(range_updates):
+    """
+    Ghi cập nhật NCR_DATA qua write-behind queue (gộp ô trùng, flush nền có retry)
+    và vá ngay snapshot cục bộ để UI thấy kết quả mà không chờ flush.
+    """
+    from core.ncr_repository import get_ncr_repository
+    from core.write_queue import get_write_queue
+    get_write_queue().enqueue("NCR_DATA", range_updates)
+    get_ncr_repository().apply_cell_updates(range_updates)
+
+
 # --- DATA LOADING & GROUPING ---
+# Cột của bảng phiếu trả về cho các trang phê duyệt/giám sát
+GROUPED_TICKET_COLS = [
+    'so_phieu', 'ngay_lap', 'nguoi_lap_phieu', 'trang_thai', 'sl_loi', 'ten_loi',
+    'hop_dong', 'ma_vat_tu', 'ten_sp', 'phan_loai', 'nguon_goc',
+    'sl_kiem', 'mo_ta_loi', 'sl_lo_hang', 'hinh_anh',
+    'thoi_gian_cap_nhat', 'nguoi_duyet_1', 'nguoi_duyet_2',
+    'nguoi_duyet_3', 'nguoi_duyet_4', 'nguoi_duyet_5',
+    'bien_phap_truong_bp', 'huong_giai_quyet', 'huong_xu_ly_gd', 'ly_do_tu_choi',
+    'kp_status', 'kp_assigned_by', 'kp_assigned_to', 'kp_message', 'kp_deadline', 'kp_response',
+    'don_vi_tinh'
+]
+
 def load_ncr_data_with_grouping(gc=None, filter_status=None, filter_department=None):
     try:
-        df_original = _get_ncr_data_cached()
+        # Snapshot đã chuẩn hóa tên cột (COLUMN_MAPPING) từ repository dùng chung
+        df_original = load_ncr_dataframe_v2()
         
         if df_original.empty:
             st.warning("📊 Sheet NCR_DATA trống. Chưa có dữ liệu để hiển thị.")
             return pd.DataFrame(), pd.DataFrame()
         
-        # Normalize column names (Lower case for robust mapping)
-        df_original.columns = df_original.columns.str.strip().str.lower()
-        
-        # Create reverse mapping
-        reverse_mapping = {v: k for k, v in COLUMN_MAPPING.items()}
-        df_original = df_original.rename(columns=reverse_mapping)
-        
-        # Apply filters
-        df_filtered = df_original.copy()
+        # Bảng phiếu dựng sẵn (một dòng / phiếu) -> lọc trực tiếp, không groupby lại
+        df_filtered = load_ncr_tickets()
+        if df_filtered.empty:
+            return df_original, pd.DataFrame()
         
         if filter_status:
             if 'trang_thai' in df_filtered.columns:
@@ -217,21 +228,13 @@ def load_ncr_data_with_grouping(gc=None, filter_status=None, filter_department=N
         
         if filter_department:
             if 'so_phieu' in df_filtered.columns:
-                def extract_dept(so_phieu):
-                    parts = str(so_phieu).split('-')
-                    if len(parts) >= 2:
-                        return '-'.join(parts[:2]).lower().replace('-', '_')
-                    elif len(parts) == 1:
-                        return parts[0].lower()
-                    return ''
-                
-                df_filtered['bo_phan'] = df_filtered['so_phieu'].apply(extract_dept)
+                dept_key = extract_dept_key(df_filtered['so_phieu'])
                 
                 # Normalize filter_department for comparison
                 filter_dept_norm = str(filter_department).lower().strip()
                 
                 # Condition 1: Origin Department (Standard)
-                condition_origin = df_filtered['bo_phan'] == filter_dept_norm
+                condition_origin = dept_key == filter_dept_norm
                 
                 # Condition 2: Cross-Department Assignment
                 # Logic: Status starts with 'khac_phuc_' AND kp_message contains [BP: Department]
@@ -254,36 +257,8 @@ def load_ncr_data_with_grouping(gc=None, filter_status=None, filter_department=N
         if df_filtered.empty:
             return df_original, pd.DataFrame()
         
-        # Grouping
-        group_cols = {
-            'ngay_lap': 'first',
-            'nguoi_lap_phieu': 'first',
-            'trang_thai': 'first',
-            'sl_loi': 'sum',
-            'ten_loi': lambda x: ', '.join(sorted(set(x.astype(str))))
-        }
-        
-        # Add optional columns if they exist
-        optional_cols = [
-            'hop_dong', 'ma_vat_tu', 'ten_sp', 'phan_loai', 'nguon_goc', 
-            'sl_kiem', 'mo_ta_loi', 'sl_lo_hang', 'hinh_anh',
-            'thoi_gian_cap_nhat', 'nguoi_duyet_1', 'nguoi_duyet_2', 
-            'nguoi_duyet_3', 'nguoi_duyet_4', 'nguoi_duyet_5', 
-            'bien_phap_truong_bp', 'huong_giai_quyet', 'huong_xu_ly_gd', 'ly_do_tu_choi',
-            'kp_status', 'kp_assigned_by', 'kp_assigned_to', 'kp_message', 'kp_deadline', 'kp_response',
-            'don_vi_tinh'
-        ]
-        
-        for col in optional_cols:
-            if col in df_filtered.columns:
-                group_cols[col] = 'first'
-        
-        # Robust groupby
-        if 'so_phieu' in df_filtered.columns:
-            grouped = df_filtered.groupby('so_phieu', as_index=False).agg(group_cols)
-            return df_original, grouped
-        else:
-             return df_original, pd.DataFrame()
+        cols = [c for c in GROUPED_TICKET_COLS if c in df_filtered.columns]
+        return df_original, df_filtered[cols].reset_index(drop=True)
 
     except Exception as e:
         st.error(f"Lỗi xử lý dữ liệu: {e}")
@@ -309,65 +284,74 @@ DEPT_PREFIX_MAP = {
     "CAT_BAN": ("Cắt", "Cắt Bàn"),
 }
 
-@st.cache_data(ttl=300)
+
+@lru_cache(maxsize=1)
+def _dept_prefix_matcher():
+    """
+    Regex prefix dựng một lần từ DEPT_PREFIX_MAP + NCR_DEPARTMENT_PREFIXES (prefix dài khớp trước).
+    Prefix chỉ có trong config (vd: CXA) lấy tên bộ phận theo key config (CAT_BAN).
+    Returns: (compiled_regex, {prefix: (bo_phan, bo_phan_full)})
+    """
+    from utils.config import NCR_DEPARTMENT_PREFIXES
+    table = dict(DEPT_PREFIX_MAP)
+    for key, prefix in NCR_DEPARTMENT_PREFIXES.items():
+        if prefix not in table and key in DEPT_PREFIX_MAP:
+            table[prefix] = DEPT_PREFIX_MAP[key]
+    alternation = '|'.join(re.escape(p) for p in sorted(table, key=len, reverse=True))
+    return re.compile(f"^({alternation})"), table
+
+
+def extract_dept_columns(so_phieu):
+    """
+    Tách bộ phận từ số phiếu (vectorized). Chỉ tính trên các số phiếu duy nhất
+    (mỗi phiếu có nhiều dòng lỗi) rồi map ngược lại.
+    Không khớp prefix nào -> phần trước dấu '-' đầu tiên.
+    Returns: DataFrame ['bo_phan', 'bo_phan_full'] cùng index với so_phieu.
+    """
+    pattern, table = _dept_prefix_matcher()
+    uniques = so_phieu.unique()
+    keys = pd.Series([str(v) for v in uniques], dtype=object).str.upper().str.strip()
+    matched = keys.str.extract(pattern, expand=False)
+    fallback = keys.str.split('-').str[0]
+    bo_phan = matched.map({p: v[0] for p, v in table.items()}).fillna(fallback)
+    bo_phan_full = matched.map({p: v[1] for p, v in table.items()}).fillna(fallback)
+    return pd.DataFrame({
+        'bo_phan': so_phieu.map(dict(zip(uniques, bo_phan))),
+        'bo_phan_full': so_phieu.map(dict(zip(uniques, bo_phan_full))),
+    }, index=so_phieu.index)
+
+
+def extract_dept_key(so_phieu):
+    """
+    Mã bộ phận dạng lọc (2 phần đầu số phiếu, lowercase, '-' -> '_'), vectorized theo số phiếu duy nhất.
+    Vd: 'X2-TR-0125-001' -> 'x2_tr'
+    """
+    uniques = so_phieu.unique()
+    keys = pd.Series([str(v) for v in uniques], dtype=object)
+    head = keys.str.extract(r'^([^-]*(?:-[^-]*)?)', expand=False)
+    return so_phieu.map(dict(zip(uniques, head.str.lower().str.replace('-', '_', regex=False))))
+
+def load_ncr_tickets():
+    """
+    Bảng phiếu dựng sẵn từ snapshot (một dòng / so_phieu: tổng sl_loi, danh sách ten_loi...).
+    Cập nhật tăng dần theo các dòng thay đổi, không cần groupby lại mỗi lần render.
+    """
+    try:
+        from core.ncr_repository import get_ncr_repository
+        return get_ncr_repository().tickets()
+    except Exception as e:
+        st.error(f"Lỗi load data chung: {e}")
+        return pd.DataFrame()
+
+
 def load_ncr_dataframe_v2():
+    """
+    Snapshot NCR_DATA đã chuẩn hóa (date_obj, bo_phan, hours_stuck tính sẵn).
+    Đọc từ NcrRepository: một lần tải Sheet cho mỗi cửa sổ làm mới, trả về bản sao.
+    """
     try:
-        gc = init_gspread()
-        if not gc: return pd.DataFrame()
-        
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        records = ws.get_all_records()
-        df = pd.DataFrame(records)
-        
-        if df.empty:
-            return pd.DataFrame()
-        
-        df.columns = df.columns.str.strip().str.lower()
-        inv_map = {v.lower(): k for k, v in COLUMN_MAPPING.items()}
-        df.rename(columns=inv_map, inplace=True)
-        
-        if 'ngay_lap' in df.columns:
-            # FORCE CACHE UPDATE 2026-01-29
-            # Handle mixed formats. 
-            # Google Sheets often returns MM/DD/YYYY or YYYY-MM-DD depending on locale.
-            # dayfirst=True causes issues if input is 04/12/2025 (Apr 12) -> Parsed as Dec 4.
-            # Changing to dayfirst=False to prioritize MM/DD format which seems to match GSheets output.
-            df['date_obj'] = pd.to_datetime(df['ngay_lap'], dayfirst=False, errors='coerce')
-            
-            # Debug: Check which rows failed parsing
-            # if df['date_obj'].isna().sum() > 0:
-            #     st.toast(f"⚠️ Cảnh báo: Có {df['date_obj'].isna().sum()} dòng ngày tháng không đọc được.", icon="📅")
-            
-            df['year'] = df['date_obj'].dt.year
-            df['month'] = df['date_obj'].dt.month
-            df['week'] = df['date_obj'].dt.isocalendar().week
-        
-        # Ensure hop_dong column exists (it should already be mapped from COLUMN_MAPPING)
-        if 'hop_dong' not in df.columns and 'so_hop_dong' in df.columns:
-            df['hop_dong'] = df['so_hop_dong']
-        
-        if 'so_phieu' in df.columns:
-            def extract_dept_info(so_phieu):
-                s = str(so_phieu).upper().strip()
-                sorted_prefixes = sorted(DEPT_PREFIX_MAP.keys(), key=len, reverse=True)
-                for prefix in sorted_prefixes:
-                    if s.startswith(prefix):
-                        bp, khau = DEPT_PREFIX_MAP[prefix]
-                        return pd.Series([bp, khau])
-                parts = s.split('-')
-                val = parts[0]
-                return pd.Series([val, val])
-
-            df[['bo_phan', 'bo_phan_full']] = df['so_phieu'].apply(extract_dept_info)
-
-        if 'thoi_gian_cap_nhat' in df.columns:
-            df['hours_stuck'] = df['thoi_gian_cap_nhat'].apply(calculate_stuck_time)
-        else:
-            df['hours_stuck'] = 0
-            
-        return df
-        
+        from core.ncr_repository import get_ncr_repository
+        return get_ncr_repository().snapshot()
     except Exception as e:
         st.error(f"Lỗi load data chung: {e}")
         return pd.DataFrame()
@@ -485,61 +469,67 @@ def render_input_buffer_mobile(buffer_list):
     return buffer_list
 
 
+# Định dạng ngày giờ gặp trong Sheet: app ghi YYYY-MM-DD HH:MM:SS, Sheets (USER_ENTERED) trả về MM/DD/YYYY
+SHEET_DATETIME_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y",
+)
+
+
+def parse_sheet_datetime(values):
+    """
+    Parse một cột ngày giờ từ Sheet (vectorized, chỉ parse các giá trị duy nhất).
+    Thử lần lượt SHEET_DATETIME_FORMATS, phần còn lại parse 'mixed' với dayfirst=False.
+    Giá trị rỗng / không hợp lệ -> NaT.
+    """
+    uniques = values.unique()
+    text = pd.Series([str(v).strip() for v in uniques], dtype=object)
+    text = text.where(~text.isin(['', 'nan', 'None', 'NaT']))
+    parsed = pd.Series(pd.NaT, index=text.index, dtype='datetime64[ns]')
+    for fmt in SHEET_DATETIME_FORMATS:
+        todo = parsed.isna() & text.notna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(text[todo], format=fmt, errors='coerce')
+    todo = parsed.isna() & text.notna()
+    if todo.any():
+        parsed[todo] = pd.to_datetime(text[todo], format='mixed', dayfirst=False, errors='coerce')
+    lookup = pd.Series(parsed.values, index=pd.Index(uniques, dtype=object))
+    return pd.Series(lookup.reindex(pd.Index(values.values, dtype=object)).values, index=values.index)
+
+
+def calculate_stuck_hours(last_updates, now=None):
+    """Số giờ kể từ lần cập nhật cuối (vectorized, cùng một mốc now). Không parse được -> 0."""
+    now = now or get_now_vn()
+    updated = last_updates if pd.api.types.is_datetime64_any_dtype(last_updates) else parse_sheet_datetime(last_updates)
+    return ((now - updated).dt.total_seconds() / 3600).fillna(0)
+
+
 def calculate_stuck_time(last_update_str):
+    """Phiên bản một giá trị của calculate_stuck_hours."""
     if not last_update_str:
         return 0
-    try:
-        last_update = pd.to_datetime(str(last_update_str), dayfirst=True)
-        if pd.isna(last_update):
-            return 0
-        delta = get_now_vn() - last_update
-        return delta.total_seconds() / 3600
-    except:
-        return 0
+    return float(calculate_stuck_hours(pd.Series([last_update_str])).iloc[0])
 
 # --- CLOUDINARY UPLOAD ---
-def upload_images_to_cloud(file_list, filename_prefix):
+def upload_images_to_cloud(file_list, filename_prefix, progress=None):
     """
     Upload images to Cloudinary.
     Requires [cloudinary] section in secrets.toml with cloud_name, api_key, api_secret.
+    Ảnh được thu nhỏ cục bộ rồi upload song song (core.services.image_upload_service);
+    progress(done, total, file_name) để hiển thị tiến độ từng file.
     """
     if not file_list:
         return ""
     
     try:
-        # Initialize Config
-        cld = st.secrets["cloudinary"]
-        cloudinary.config(
-            cloud_name=cld["cloud_name"],
-            api_key=cld["api_key"],
-            api_secret=cld["api_secret"],
-            secure=True
-        )
-        
-        urls = []
-        for idx, uploaded_file in enumerate(file_list):
-            try:
-                # Cloudinary uploader accepts file-like objects (BytesIO) directly
-                # folder='ncr_images' keeps things organized
-                # public_id ensure uniqueness
-                timestamp = int(get_now_vn().timestamp())
-                res = cloudinary.uploader.upload(
-                    uploaded_file, 
-                    folder="ncr_images",
-                    public_id=f"{filename_prefix}_{timestamp}_{idx}",
-                    resource_type="image",
-                    transformation={
-                        "quality": "auto",
-                        "fetch_format": "auto",
-                        "width": 1200,
-                        "crop": "limit"
-                    }
-                )
-                urls.append(res.get("secure_url"))
-            except Exception as e:
-                st.error(f"Lỗi upload ảnh {uploaded_file.name}: {e}")
-                
-        return "\n".join(urls)
+        from core.services.image_upload_service import upload_images
+        urls, errors = upload_images(file_list, filename_prefix, progress=progress)
+        for name, e in errors:
+            st.error(f"Lỗi upload ảnh {name}: {e}")
+        return "\n".join(url for url in urls if url)
         
     except Exception as e:
         st.error(f"Lỗi cấu hình Cloudinary: {e}")
@@ -590,10 +580,8 @@ def update_ncr_status(gc, so_phieu, new_status, approver_name, approver_role, so
         assignee: Tên người được chỉ định (nếu có), dùng cho việc Director cụ thể
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         # Tìm chỉ mục các cột cần thiết (Case-insensitive)
         idx_so_phieu = headers.index("so_phieu_ncr")
@@ -612,38 +600,37 @@ def update_ncr_status(gc, so_phieu, new_status, approver_name, approver_role, so
         now = get_now_vn_str()
         range_updates = []
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                # Trạng thái & Thời gian
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+        for i, row in ticket_rows:
+            # Trạng thái & Thời gian
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
                 
-                # Tên người duyệt
-                if idx_approver != -1:
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_approver + 1), 'values': [[approver_name]]})
+            # Tên người duyệt
+            if idx_approver != -1:
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_approver + 1), 'values': [[approver_name]]})
                 
-                # Biện pháp của Trưởng BP
-                if bp_solution and idx_bp_solution != -1:
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_bp_solution + 1), 'values': [[bp_solution]]})
+            # Biện pháp của Trưởng BP
+            if bp_solution and idx_bp_solution != -1:
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_bp_solution + 1), 'values': [[bp_solution]]})
                 
-                # Hướng giải quyết của QC Manager
-                if solution and idx_qc_solution != -1:
-                    full_solution = solution
-                    if assignee:
-                        full_solution = f"{full_solution}\n[Chỉ định: {assignee}]"
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_qc_solution + 1), 'values': [[full_solution]]})
+            # Hướng giải quyết của QC Manager
+            if solution and idx_qc_solution != -1:
+                full_solution = solution
+                if assignee:
+                    full_solution = f"{full_solution}\n[Chỉ định: {assignee}]"
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_qc_solution + 1), 'values': [[full_solution]]})
                 
-                # Hướng xử lý của Giám đốc
-                if director_solution and idx_director_solution != -1:
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_director_solution + 1), 'values': [[director_solution]]})
+            # Hướng xử lý của Giám đốc
+            if director_solution and idx_director_solution != -1:
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_director_solution + 1), 'values': [[director_solution]]})
                 
-                # Lý do từ chối (Nếu có)
-                if reject_reason and idx_reject != -1:
-                    full_reject = f"[{approver_name} ({approver_role.upper()})] {reject_reason}"
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_reject + 1), 'values': [[full_reject]]})
+            # Lý do từ chối (Nếu có)
+            if reject_reason and idx_reject != -1:
+                full_reject = f"[{approver_name} ({approver_role.upper()})] {reject_reason}"
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_reject + 1), 'values': [[full_reject]]})
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             return True, "Cập nhật trạng thái thành công"
         return False, "Không tìm thấy số phiếu NCR này"
         
@@ -657,10 +644,8 @@ def restart_ncr(gc, so_phieu, target_status, user_name, note=""):
     Dùng trong trang Giám sát.
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
@@ -670,66 +655,41 @@ def restart_ncr(gc, so_phieu, target_status, user_name, note=""):
         now = get_now_vn_str()
         range_updates = []
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[target_status]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+        for i, row in ticket_rows:
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[target_status]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
                 
-                if idx_reject != -1:
-                    msg = f"[RESTART BY {user_name}] {note}"
-                    range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_reject + 1), 'values': [[msg]]})
+            if idx_reject != -1:
+                msg = f"[RESTART BY {user_name}] {note}"
+                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_reject + 1), 'values': [[msg]]})
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             return True, f"Đã khôi phục phiếu {so_phieu} về {target_status}"
         return False, "Không tìm thấy phiếu"
     except Exception as e:
         return False, f"Lỗi: {str(e)}"
 
-def generate_next_pass_id(dept_prefix):
+def generate_next_pass_id(dept_prefix, owner=""):
     """
     Tạo mã phiếu tự động cho trường hợp Kiểm Đạt (Pass).
     Format: [PREFIX]KD-[MM]-[ID] (Ví dụ: FIKD-01-01)
+    Mã được cấp + giữ chỗ qua core.id_allocator (không trùng khi nhiều người lưu cùng lúc).
     """
+    now = get_now_vn()
+    month_str = now.strftime("%m")
+    search_prefix = f"{dept_prefix}KD-{month_str}-"
     try:
-        # 1. Xác định Prefix tìm kiếm
-        now = get_now_vn()
-        month_str = now.strftime("%m")
-        search_prefix = f"{dept_prefix}KD-{month_str}-"
-        
-        # 2. Lấy danh sách ID hiện có từ Sheet
-        # (Dùng cache function có sẵn để giảm quota read)
-        df_ncr = _get_ncr_data_cached()
-        
-        existing_ids = []
-        if not df_ncr.empty and 'so_phieu_ncr' in df_ncr.columns:
-            # Lọc các phiếu bắt đầu bằng search_prefix
-            mask = df_ncr['so_phieu_ncr'].astype(str).str.startswith(search_prefix)
-            existing_ids = df_ncr.loc[mask, 'so_phieu_ncr'].tolist()
-            
-        # 3. Tìm số lớn nhất
-        max_id = 0
-        for pid in existing_ids:
-            try:
-                # Tách phần đuôi số: FIKD-01-05 -> 05
-                suffix = pid.replace(search_prefix, "")
-                val = int(suffix)
-                if val > max_id:
-                    max_id = val
-            except:
-                continue
-                
-        # 4. Sinh mã mới
-        next_id = max_id + 1
-        final_id = f"{search_prefix}{next_id:02d}"
-        
-        return final_id
-        
+        from core.id_allocator import get_id_allocator
+        ok, result = get_id_allocator().allocate(search_prefix, owner=owner)
+        if ok:
+            return result
+        print(f"Error generating pass ID: {result}")
     except Exception as e:
         print(f"Error generating pass ID: {e}")
-        # Fallback an toàn: Dùng timestamp để không bị trùng
-        fallback_suffix = now.strftime("%d%H%M")
-        return f"{dept_prefix}KD-{month_str}-{fallback_suffix}"
+    # Fallback an toàn: Dùng timestamp để không bị trùng
+    fallback_suffix = now.strftime("%d%H%M")
+    return f"{dept_prefix}KD-{month_str}-{fallback_suffix}"
 
 def assign_corrective_action(gc, so_phieu, assigned_by_role, assign_to_role, message, deadline, target_department=None, target_person=None):
     """
@@ -738,10 +698,8 @@ def assign_corrective_action(gc, so_phieu, assigned_by_role, assign_to_role, mes
     Nếu không, ghi role vào kp_assigned_to (legacy behavior).
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
@@ -762,31 +720,30 @@ def assign_corrective_action(gc, so_phieu, assigned_by_role, assign_to_role, mes
         now = get_now_vn_str()
         range_updates = []
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+        for i, row in ticket_rows:
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
                 
-                final_message = message
-                prefix_info = []
-                if target_department:
-                    prefix_info.append(f"BP: {target_department}")
-                if target_person:
-                     prefix_info.append(f"Người nhận: {target_person}")
+            final_message = message
+            prefix_info = []
+            if target_department:
+                prefix_info.append(f"BP: {target_department}")
+            if target_person:
+                 prefix_info.append(f"Người nhận: {target_person}")
                 
-                if prefix_info:
-                    final_message = f"[{' | '.join(prefix_info)}] {final_message}"
+            if prefix_info:
+                final_message = f"[{' | '.join(prefix_info)}] {final_message}"
 
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['active']]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_by + 1), 'values': [[assigned_by_role]]})
-                # CRITICAL: Write username if provided, else write role
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_to + 1), 'values': [[assignee]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_msg + 1), 'values': [[final_message]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_dl + 1), 'values': [[str(deadline)]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_res + 1), 'values': [['']]}) # Reset response
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['active']]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_by + 1), 'values': [[assigned_by_role]]})
+            # CRITICAL: Write username if provided, else write role
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_to + 1), 'values': [[assignee]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_msg + 1), 'values': [[final_message]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_dl + 1), 'values': [[str(deadline)]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_res + 1), 'values': [['']]}) # Reset response
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             recipient_display = f"user {target_person}" if target_person else f"role {assign_to_role.upper()}"
             return True, f"Đã giao hành động khắc phục cho {recipient_display}"
         return False, "Không tìm thấy số phiếu"
@@ -798,10 +755,8 @@ def complete_corrective_action(gc, so_phieu, response):
     Người nhận hoàn thành hành động khắc phục và gửi lại cho người giao.
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
@@ -815,10 +770,8 @@ def complete_corrective_action(gc, so_phieu, response):
         
         # Lấy thông tin người giao từ dòng đầu tiên tìm thấy
         assigned_by = ""
-        for row in data[1:]:
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                assigned_by = str(row[idx_kp_by]).strip()
-                break
+        if ticket_rows:
+            assigned_by = str(ticket_rows[0][1][idx_kp_by]).strip()
         
         if not assigned_by:
             return False, "Không xác định được người giao task"
@@ -826,15 +779,14 @@ def complete_corrective_action(gc, so_phieu, response):
         # Trạng thái chờ xác nhận
         new_status = f"xac_nhan_kp_{assigned_by}"
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['completed']]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_res + 1), 'values': [[response]]})
+        for i, row in ticket_rows:
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['completed']]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_res + 1), 'values': [[response]]})
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             return True, f"Đã gửi phản hồi khắc phục cho {assigned_by.upper()}"
         return False, "Không tìm thấy số phiếu"
     except Exception as e:
@@ -845,10 +797,8 @@ def accept_corrective_action(gc, so_phieu, approver_role):
     Người giao chấp nhận hành động khắc phục, phiếu quay lại trạng thái chờ duyệt của họ.
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
@@ -860,14 +810,13 @@ def accept_corrective_action(gc, so_phieu, approver_role):
         now = get_now_vn_str()
         range_updates = []
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['accepted']]})
+        for i, row in ticket_rows:
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [[new_status]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_kp_status + 1), 'values': [['accepted']]})
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             return True, "Đã chấp nhận hành động khắc phục. Phiếu đã quay lại danh sách chờ duyệt."
         return False, "Không tìm thấy số phiếu"
     except Exception as e:
@@ -930,19 +879,16 @@ def load_pending_corrective_actions(gc, role_name):
     except Exception as e:
         return pd.DataFrame()
 
-@st.cache_data(ttl=300)
+@tagged_cache(USERS, ttl=300)
 def get_all_users():
     """
     Lấy danh sách toàn bộ nhân viên từ sheet USERS.
     Now normalized and robust.
     """
     try:
-        gc = init_gspread()
-        if not gc: return []
-        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        sh = gc.open_by_key(spreadsheet_id)
-        ws = sh.worksheet("USERS")
-        data = ws.get_all_records()
+        # Cold start đọc từ mirror cục bộ, làm mới nền
+        from core.local_mirror import read_sheet_frame
+        data = read_sheet_frame("USERS", on_refresh=get_all_users.clear).to_dict('records')
         
         # Clean data keys
         cleaned_data = []
@@ -961,11 +907,7 @@ def migrate_user_passwords():
     Sử dụng batch update để tối ưu tốc độ.
     """
     try:
-        gc = init_gspread()
-        if not gc: return False, "Lỗi kết nối database"
-        
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         data = ws.get_all_values()
         if not data: return True, "Sheet rỗng"
         
@@ -1020,9 +962,7 @@ def reset_user_password(username, new_password):
     Lưu hash và xóa plain-text (nếu còn).
     """
     try:
-        gc = init_gspread()
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         
         cell = ws.find(username)
         if not cell: return False, "Không tìm thấy user."
@@ -1056,11 +996,7 @@ def register_user(username, password, full_name, department, role="staff"):
     Đăng ký user mới. Hash password ngay khi tạo.
     """
     try:
-        gc = init_gspread()
-        if not gc: return False, "Lỗi kết nối Database"
-        
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         
         headers = [str(h).strip().lower() for h in ws.row_values(1)]
         
@@ -1104,9 +1040,7 @@ def update_user_status(username, new_status):
     new_status: 'active' | 'rejected'
     """
     try:
-        gc = init_gspread()
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         
         # Find User Row
         cell = ws.find(username)
@@ -1133,9 +1067,7 @@ def update_user_info(target_username, new_role=None, new_dept=None):
     Cập nhật Role và Department cho User.
     """
     try:
-        gc = init_gspread()
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("USERS")
+        ws = get_worksheet("USERS")
         
         cell = ws.find(target_username)
         if not cell:
@@ -1165,10 +1097,8 @@ def cancel_ncr(gc, so_phieu, reason):
     Hủy phiếu NCR: Chuyển trạng thái sang 'da_huy'
     """
     try:
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        ws = sh.worksheet("NCR_DATA")
-        data = ws.get_all_values()
-        headers = [str(h).strip().lower() for h in data[0]]
+        ws = get_worksheet("NCR_DATA")
+        headers, ticket_rows = _fetch_ticket_rows(ws, so_phieu)
         
         idx_so_phieu = headers.index("so_phieu_ncr")
         idx_status = headers.index("trang_thai")
@@ -1178,16 +1108,15 @@ def cancel_ncr(gc, so_phieu, reason):
         now = get_now_vn_str()
         range_updates = []
         
-        for i, row in enumerate(data[1:], start=2):
-            if str(row[idx_so_phieu]).strip() == str(so_phieu).strip():
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [['da_huy']]})
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
-                current_note = row[idx_note]
-                new_note = f"{current_note} | [Lý do hủy: {reason}]" if current_note else f"[Lý do hủy: {reason}]"
-                range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_note + 1), 'values': [[new_note]]})
+        for i, row in ticket_rows:
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_status + 1), 'values': [['da_huy']]})
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_update + 1), 'values': [[now]]})
+            current_note = row[idx_note]
+            new_note = f"{current_note} | [Lý do hủy: {reason}]" if current_note else f"[Lý do hủy: {reason}]"
+            range_updates.append({'range': gspread.utils.rowcol_to_a1(i, idx_note + 1), 'values': [[new_note]]})
         
         if range_updates:
-            ws.batch_update(range_updates)
+            _queue_ncr_updates(range_updates)
             return True, f"Đã hủy phiếu {so_phieu}"
         return False, "Không tìm thấy số phiếu"
     except Exception as e:
@@ -1198,33 +1127,15 @@ def generate_next_ncr_id(dept_prefix):
     Tạo/Gợi ý số đuôi phiếu NCR tiếp theo cho tháng hiện tại.
     Format: [PREFIX]-[MM]-[XX] (Ví dụ: FI-01-01)
     Trả về: (next_full_id, next_suffix)
+    Chỉ là gợi ý: mã được giữ chỗ khi lưu (reserve_ncr_id).
     """
     try:
         now = get_now_vn()
         month_str = now.strftime("%m")
         search_prefix = f"{dept_prefix}-{month_str}-"
         
-        # Lấy dữ liệu cached
-        df_ncr = _get_ncr_data_cached()
-        
-        existing_suffixes = []
-        if not df_ncr.empty and 'so_phieu_ncr' in df_ncr.columns:
-            # Lọc phiếu bắt đầu bằng prefix
-            mask = df_ncr['so_phieu_ncr'].astype(str).str.startswith(search_prefix)
-            # Lấy list các suffix
-            ids = df_ncr.loc[mask, 'so_phieu_ncr'].tolist()
-            for pid in ids:
-                try:
-                    suffix = pid.replace(search_prefix, "")
-                    if suffix.isdigit():
-                        existing_suffixes.append(int(suffix))
-                except:
-                    continue
-        
-        # Tìm max
-        next_num = 1
-        if existing_suffixes:
-            next_num = max(existing_suffixes) + 1
+        from core.id_allocator import get_id_allocator
+        next_num = get_id_allocator().peek(search_prefix)
             
         next_suffix = f"{next_num:02d}"
         next_full_id = f"{search_prefix}{next_suffix}"
@@ -1236,14 +1147,29 @@ def generate_next_ncr_id(dept_prefix):
         return "", "01"
 
 def is_ncr_id_exists(id_to_check):
-    """Kiểm tra xem mã phiếu NCR đã tồn tại chưa"""
+    """Kiểm tra xem mã phiếu NCR đã tồn tại (hoặc đang được giữ chỗ) chưa - tra tập hash, O(1)"""
     try:
-        df_ncr = _get_ncr_data_cached()
-        if df_ncr.empty or 'so_phieu_ncr' not in df_ncr.columns:
-            return False
-        
-        # Check stripping whitespace
-        all_ids = df_ncr['so_phieu_ncr'].astype(str).str.strip().tolist()
-        return str(id_to_check).strip() in all_ids
+        from core.id_allocator import get_id_allocator
+        return get_id_allocator().exists(id_to_check)
     except:
         return False
+
+def reserve_ncr_id(ncr_id, owner=""):
+    """Giữ chỗ mã phiếu trước khi ghi Sheet. Returns: (bool, ncr_id | message)"""
+    try:
+        from core.id_allocator import get_id_allocator
+        return get_id_allocator().reserve(ncr_id, owner=owner)
+    except Exception as e:
+        # Không mở được store cục bộ -> quay về kiểm tra trùng theo snapshot
+        print(f"ID reservation error: {e}")
+        if is_ncr_id_exists(ncr_id):
+            return False, f"Mã phiếu {ncr_id} đã tồn tại"
+        return True, ncr_id
+
+def release_ncr_id(ncr_id):
+    """Bỏ giữ chỗ khi lưu phiếu thất bại"""
+    try:
+        from core.id_allocator import get_id_allocator
+        get_id_allocator().release(ncr_id)
+    except Exception as e:
+        print(f"ID release error: {e}")
@@ -1,6 +1,5 @@
 import streamlit as st
 import time
-from utils.ncr_helpers import init_gspread
 
 # ==========================================
 # 1. CENTRAL MENU CONFIGURATION
@@ -127,29 +126,23 @@ MENU_STRUCTURE = [
 ]
 
 # ==========================================
-# 2. CACHED DATA FETCHING
+# 2. BADGE DATA (SHARED SNAPSHOT)
 # ==========================================
-@st.cache_data(ttl=60)
 def fetch_badge_counts(username, role, department):
     """
-    Fetch counts for badges. Cached for 60 seconds to reduce DB load.
+    Fetch counts for badges from the shared NcrRepository snapshot (no extra sheet read).
     Returns: dict {'my_ncr': 0, 'approval': 0}
     """
     counts = {"my_ncr": 0, "approval": 0}
     
     try:
-        gc = init_gspread()
-        if not gc: return counts
-        
-        sh = gc.open_by_key(st.secrets["connections"]["gsheets"]["spreadsheet"])
-        
         # 1. Count My NCR (Draft/Rejected)
-        # Use simple filter if possible, or fetch all and filter df
-        # For performance on mobile, we try to be efficient. 
-        # Here we mock efficient fetching by loading full data (cached elsewhere usually)
-        # In production, we assume `utils.ncr_helpers._get_ncr_data_cached` handles caching.
+        # `_get_ncr_data_cached` returns a copy of the shared snapshot, safe to normalize in place.
         from utils.ncr_helpers import _get_ncr_data_cached
-        df = _get_ncr_data_cached()
+        from core.quota_governor import quota_priority, PRIORITY_BACKGROUND
+        # Badge sidebar không được chiếm quota của thao tác chính
+        with quota_priority(PRIORITY_BACKGROUND):
+            df = _get_ncr_data_cached()
         
         if not df.empty:
             # Normalize
@@ -274,6 +267,21 @@ def render_sidebar(user_info):
         # Header
         st.markdown("### 🧭 NCR Mobile")
         st.caption(f"User: **{user_info.get('name')}** | Role: `{user_role}`")
+        # Refresher nền (khởi động một lần / process) giữ NCR_DATA, DNXL, CONFIG luôn mới
+        from core.background_refresher import get_background_refresher
+        last_synced = get_background_refresher().last_synced()
+        if last_synced:
+            st.caption(f"🔄 Dữ liệu đồng bộ lúc {last_synced.strftime('%H:%M:%S')}")
+        # Nhật ký lưu phiếu: sau restart thread drain chạy ngay ở trang đầu tiên được mở,
+        # phiếu còn chờ đồng bộ không phải đợi lần lưu kế tiếp / trang NCR của tôi
+        from core.save_journal import get_save_journal
+        get_save_journal()
+        if user_role == "admin":
+            # Ô bị Sheets từ chối vĩnh viễn -> báo admin (chi tiết ở trang Quản lý User)
+            from core.write_queue import get_write_queue
+            dead = get_write_queue().stats()['dead_letters']
+            if dead:
+                st.warning(f"⚠️ {dead} ô ghi Sheets bị lỗi - xem trang Quản lý User")
         st.divider()
         
         # Render Menu